@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+import torch
+
+from modules import LatentIndex, IVFPQLatentIndex, load_latent_index
+
+def init_config():
+    parser = argparse.ArgumentParser(description='recall and query latency of the approximate latent index against exact search')
+
+    parser.add_argument('--mu_file', type=str, default='',
+                         help='mu.npy written by export_latents.py, synthetic clustered codes are used when empty')
+    parser.add_argument('--num_vectors', type=int, default=1000000, help='number of synthetic codes')
+    parser.add_argument('--nz', type=int, default=32, help='dimension of the synthetic codes')
+    parser.add_argument('--num_queries', type=int, default=1000,
+                         help='number of queries, held out from the indexed codes')
+    parser.add_argument('--k', type=int, default=10, help='number of neighbours')
+    parser.add_argument('--metric', choices=['l2', 'cosine'], default='l2', help='distance of the search')
+
+    parser.add_argument('--nlist', type=int, default=1024, help='number of clusters of the inverted file')
+    parser.add_argument('--m', type=int, default=8, help='number of sub-quantizers, divides nz')
+    parser.add_argument('--nprobe', type=str, default='1,4,16,64',
+                         help='comma separated numbers of scanned clusters')
+    parser.add_argument('--add_chunk_size', type=int, default=100000,
+                         help='the codes are added incrementally in chunks of this size')
+    parser.add_argument('--save_dir', type=str, default='',
+                         help='save both indexes here and check that the reloaded indexes give the same results')
+
+    parser.add_argument('--seed', type=int, default=783435, metavar='S', help='random seed')
+
+    args = parser.parse_args()
+    args.cuda = torch.cuda.is_available()
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    return args
+
+def synthetic_codes(num_vectors, nz, num_clusters=1000):
+    """codes drawn around random cluster centers, like the posterior
+    means of a corpus that cluster by topic
+    """
+    centers = torch.randn(num_clusters, nz)
+    assign = torch.randint(num_clusters, (num_vectors,))
+    return (centers[assign] + 0.3 * torch.randn(num_vectors, nz)).numpy()
+
+def recall(ids, true_ids):
+    """the fraction of the true neighbours that are found"""
+    k = true_ids.size(1)
+    hits = (ids.unsqueeze(2) == true_ids.unsqueeze(1)).any(dim=1).sum().item()
+    return hits / (true_ids.size(0) * k)
+
+def timed_search(index, queries, k, **kwargs):
+    start = time.time()
+    dist, ids = index.search(queries, k, **kwargs)
+    return dist, ids, time.time() - start
+
+def main(args):
+    print(args)
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+
+    if args.mu_file != '':
+        codes = np.load(args.mu_file, mmap_mode='r')
+    else:
+        codes = synthetic_codes(args.num_vectors + args.num_queries, args.nz)
+    queries = torch.from_numpy(np.array(codes[:args.num_queries])).float()
+    num_vectors = codes.shape[0] - args.num_queries
+    nz = codes.shape[1]
+    print('%d codes, %d queries, nz = %d' % (num_vectors, args.num_queries, nz))
+
+    exact = LatentIndex(nz, args.metric, device)
+    approx = IVFPQLatentIndex(nz, args.nlist, args.m, metric=args.metric, device=device)
+
+    start = time.time()
+    # train on a sample of the indexed codes
+    sample_idx = np.sort(np.random.choice(num_vectors, min(num_vectors, 256 * args.nlist), replace=False))
+    approx.train(np.array(codes[args.num_queries:][sample_idx]))
+    train_time = time.time() - start
+
+    exact_time = approx_time = 0.
+    for i in range(args.num_queries, codes.shape[0], args.add_chunk_size):
+        chunk = np.array(codes[i:i + args.add_chunk_size])
+        start = time.time()
+        exact.add(chunk)
+        exact_time += time.time() - start
+        start = time.time()
+        approx.add(chunk)
+        approx_time += time.time() - start
+
+    print('exact --- add: %.2fs, memory: %.1fMB' % (exact_time, exact.memory_bytes() / 2 ** 20))
+    print('ivfpq --- train: %.2fs, add: %.2fs, memory: %.1fMB' % \
+          (train_time, approx_time, approx.memory_bytes() / 2 ** 20))
+    sys.stdout.flush()
+
+    true_dist, true_ids, search_time = timed_search(exact, queries, args.k)
+    print('exact search --- %.3fms per query' % (1000. * search_time / args.num_queries))
+
+    for nprobe in [int(n) for n in args.nprobe.split(',')]:
+        _, ids, search_time = timed_search(approx, queries, args.k, nprobe=nprobe)
+        print('ivfpq nprobe %d --- recall@%d: %.4f, %.3fms per query' % \
+              (nprobe, args.k, recall(ids, true_ids), 1000. * search_time / args.num_queries))
+        sys.stdout.flush()
+
+    if args.save_dir != '':
+        if not os.path.exists(args.save_dir):
+            os.makedirs(args.save_dir)
+        for name, index in [('exact', exact), ('ivfpq', approx)]:
+            path = os.path.join(args.save_dir, '%s.pt' % name)
+            index.save(path)
+            loaded = load_latent_index(path, device)
+            same = torch.equal(loaded.search(queries, args.k)[1], index.search(queries, args.k)[1])
+            print('%s index saved to %s, %.1fMB, reloaded results identical: %s' % \
+                  (name, path, os.path.getsize(path) / 2 ** 20, same))
+
+if __name__ == '__main__':
+    args = init_config()
+    main(args)
@@ -0,0 +1,116 @@
+import sys
+import time
+import importlib
+import argparse
+
+import numpy as np
+
+import torch
+
+from data import MonoTextData, SyntheticTextData
+
+from text import init_model
+
+def init_config():
+    parser = argparse.ArgumentParser(description='variance of the iw nll estimate with i.i.d. and quasi-Monte Carlo noise')
+
+    parser.add_argument('--dataset', type=str, default='synthetic', help='dataset to use')
+    parser.add_argument('--load_path', type=str, default='',
+                         help='checkpoint to load, a randomly initialized model is used when empty')
+    parser.add_argument('--gen_data', action='store_true', default=False,
+                         help='sample the examples in process from a random synthetic LSTM language \
+                         instead of reading the test data of dataset')
+
+    parser.add_argument('--num_examples', type=int, default=20,
+                         help='number of sampled test examples')
+    parser.add_argument('--nrepeats', type=int, default=20,
+                         help='number of independent estimates per example to measure the variance')
+    parser.add_argument('--nsamples', type=str, default='16,32,64,128,256',
+                         help='comma separated numbers of importance samples, powers of 2 suit qmc best')
+    parser.add_argument('--ref_nsamples', type=int, default=500,
+                         help='number of i.i.d. importance samples the qmc estimates are compared with')
+
+    parser.add_argument('--seed', type=int, default=783435, metavar='S', help='random seed')
+
+    args = parser.parse_args()
+    args.cuda = torch.cuda.is_available()
+
+    # load config file into args
+    config_file = "config.config_%s" % args.dataset
+    params = importlib.import_module(config_file).params
+    args = argparse.Namespace(**vars(args), **params)
+
+    if 'label' in params:
+        args.label = params['label']
+    else:
+        args.label = False
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    return args
+
+def estimate_variance(vae, x, nsamples, qmc, nrepeats):
+    """repeat the iw nll estimate of every example
+    Returns: Float, Float
+        Float: the variance across repeats, averaged over examples
+        Float: the time of one estimate of all examples
+    """
+    vae.encoder.qmc = qmc
+
+    start = time.time()
+    estimates = []
+    for _ in range(nrepeats):
+        # chunks of 100 samples like text.py, nll_iw splits one qmc point set
+        estimates.append(torch.cat([vae.nll_iw(x[i:i+1], nsamples, ns=100)
+                                    for i in range(x.size(0))]))
+
+    # [nrepeats, num_examples]
+    estimates = torch.stack(estimates)
+
+    return estimates.var(dim=0).mean().item(), (time.time() - start) / nrepeats
+
+def main(args):
+    print(args)
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+    args.device = device
+
+    if args.gen_data:
+        test_data = SyntheticTextData(args.num_examples, seed=args.seed, model_seed=args.seed)
+        vocab = test_data.vocab
+    else:
+        train_data = MonoTextData(args.train_data, label=args.label)
+        vocab = train_data.vocab
+        test_data = MonoTextData(args.test_data, label=args.label, vocab=vocab)
+
+    vae = init_model(args, vocab)
+    if args.load_path != '':
+        vae.load_state_dict(torch.load(args.load_path, map_location=device))
+    vae.eval()
+
+    x, _ = test_data.data_sample(nsample=args.num_examples, device=device, batch_first=True)
+
+    with torch.no_grad():
+        ref_var, ref_time = estimate_variance(vae, x, args.ref_nsamples, False, args.nrepeats)
+        print('iid %d samples --- var: %.6f, std: %.4f, time: %.2fs' % \
+              (args.ref_nsamples, ref_var, np.sqrt(ref_var), ref_time))
+
+        matched = None
+        for nsamples in [int(n) for n in args.nsamples.split(',')]:
+            iid_var, _ = estimate_variance(vae, x, nsamples, False, args.nrepeats)
+            qmc_var, qmc_time = estimate_variance(vae, x, nsamples, True, args.nrepeats)
+            print('%d samples --- iid var: %.6f, qmc var: %.6f, variance reduction: %.2fx, qmc time: %.2fs' % \
+                  (nsamples, iid_var, qmc_var, iid_var / max(qmc_var, 1e-12), qmc_time))
+            if matched is None and qmc_var <= ref_var:
+                matched = nsamples
+            sys.stdout.flush()
+
+    if matched is not None:
+        print('qmc reaches the variance of %d iid samples with %d samples' % (args.ref_nsamples, matched))
+    else:
+        print('qmc does not reach the variance of %d iid samples in the tested range' % args.ref_nsamples)
+
+if __name__ == '__main__':
+    args = init_config()
+    main(args)
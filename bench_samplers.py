@@ -0,0 +1,134 @@
+import sys
+import time
+import importlib
+import argparse
+
+import numpy as np
+
+import torch
+
+from data import MonoTextData, SyntheticTextData
+from modules import effective_sample_size
+
+from text import init_model
+
+def init_config():
+    parser = argparse.ArgumentParser(description='benchmark of model posterior samplers')
+
+    parser.add_argument('--dataset', type=str, default='synthetic', help='dataset to use')
+    parser.add_argument('--load_path', type=str, default='',
+                         help='checkpoint to load, a randomly initialized model is used when empty')
+    parser.add_argument('--gen_data', action='store_true', default=False,
+                         help='sample the examples in process from a random synthetic LSTM language \
+                         instead of reading the test data of dataset')
+    parser.add_argument('--samplers', type=str, default='mh,mh_multichain,mala,hmc',
+                         help='comma separated samplers to benchmark')
+
+    parser.add_argument('--num_examples', type=int, default=50,
+                         help='number of sampled test examples')
+    parser.add_argument('--nsamples', type=int, default=200, help='number of samples kept per chain')
+    parser.add_argument('--nchains', type=int, default=4, help='number of chains per example')
+    parser.add_argument('--burn_in', type=int, default=100, help='number of burn-in iterations')
+    parser.add_argument('--thin', type=int, default=1, help='keep one sample every thin iterations')
+    parser.add_argument('--mh_std', type=float, default=0.1, help='initial std of the MH proposal')
+    parser.add_argument('--step_size', type=float, default=0.1, help='initial leapfrog step size')
+    parser.add_argument('--nleapfrog', type=int, default=5, help='number of leapfrog steps of hmc')
+
+    parser.add_argument('--seed', type=int, default=783435, metavar='S', help='random seed')
+
+    args = parser.parse_args()
+    args.cuda = torch.cuda.is_available()
+
+    # load config file into args
+    config_file = "config.config_%s" % args.dataset
+    params = importlib.import_module(config_file).params
+    args = argparse.Namespace(**vars(args), **params)
+
+    if 'label' in params:
+        args.label = params['label']
+    else:
+        args.label = False
+
+    # the single chain sampler VAE.sample_from_posterior reads these
+    args.mh_burn_in = args.burn_in
+    args.mh_thin = args.thin
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    return args
+
+def run_sampler(vae, x, name, args):
+    if name == 'mh':
+        # one chain per example, the chains run one after another
+        samples = []
+        for _ in range(args.nchains):
+            # [batch, nsamples, 1, nz] --> [batch, 1, nsamples, nz]
+            samples.append(vae.sample_from_posterior(x, args.nsamples).transpose(1, 2))
+        samples = torch.cat(samples, dim=1)
+        # the single chain sampler neither reports nor adapts these
+        stats = {'accept_rate': None,
+                 'ess': effective_sample_size(samples),
+                 'num_evals': args.nchains * (args.burn_in + args.nsamples * args.thin + 1)}
+    elif name == 'mh_multichain':
+        _, stats = vae.sample_from_posterior_multichain(x, args.nsamples, nchains=args.nchains,
+            burn_in=args.burn_in, thin=args.thin, mh_std=args.mh_std)
+    elif name == 'mala':
+        _, stats = vae.sample_from_posterior_hmc(x, args.nsamples, nchains=args.nchains,
+            burn_in=args.burn_in, thin=args.thin, step_size=args.step_size, nleapfrog=1,
+            target_accept=0.574)
+    elif name == 'hmc':
+        _, stats = vae.sample_from_posterior_hmc(x, args.nsamples, nchains=args.nchains,
+            burn_in=args.burn_in, thin=args.thin, step_size=args.step_size,
+            nleapfrog=args.nleapfrog)
+    else:
+        raise ValueError('unknown sampler: %s' % name)
+
+    return stats
+
+def main(args):
+    print(args)
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+    args.device = device
+
+    if args.gen_data:
+        test_data = SyntheticTextData(args.num_examples, seed=args.seed, model_seed=args.seed)
+        vocab = test_data.vocab
+    else:
+        train_data = MonoTextData(args.train_data, label=args.label)
+        vocab = train_data.vocab
+        test_data = MonoTextData(args.test_data, label=args.label, vocab=vocab)
+
+    vae = init_model(args, vocab)
+    if args.load_path != '':
+        vae.load_state_dict(torch.load(args.load_path, map_location=device))
+    vae.eval()
+
+    x, _ = test_data.data_sample(nsample=args.num_examples, device=device, batch_first=True)
+
+    for name in args.samplers.split(','):
+        torch.manual_seed(args.seed)
+        if args.cuda:
+            torch.cuda.synchronize()
+        start = time.time()
+        with torch.no_grad():
+            stats = run_sampler(vae, x, name, args)
+        if args.cuda:
+            torch.cuda.synchronize()
+        elapsed = time.time() - start
+
+        # the smallest ESS over latent dimensions, averaged over examples
+        ess = stats['ess'].min(dim=1)[0].mean().item()
+        # the adapted proposal std of MH or leapfrog step size, averaged over examples
+        step = stats.get('mh_std', stats.get('step_size'))
+        accept = 'n/a' if stats['accept_rate'] is None else '%.3f' % stats['accept_rate'].mean().item()
+        step = 'n/a' if step is None else '%.4f' % step.mean().item()
+        print('%s --- accept: %s, step: %s, ess: %.1f, time: %.2fs, ess/s: %.1f, decoder evals: %d, ess/eval: %.4f' % \
+              (name, accept, step, ess, elapsed, ess / elapsed,
+               stats['num_evals'], ess / stats['num_evals']))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    args = init_config()
+    main(args)
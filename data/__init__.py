@@ -1 +1,2 @@
-from .text_data import *
\ No newline at end of file
+from .text_data import *
+from .synthetic_data import *
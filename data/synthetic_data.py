@@ -0,0 +1,146 @@
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .text_data import MonoTextData, VocabEntry
+
+from modules import LSTMDecoder
+
+
+class SyntheticTextData(MonoTextData):
+    """Text data sampled in process from a randomly initialized
+    LSTMDecoder with a standard normal prior, no corpus file is read.
+    The generating decoder only depends on model_seed, so datasets
+    created with the same model_seed and different seeds are splits of
+    the same synthetic language. The sentences only depend on seed.
+    Args:
+        num_examples: the number of sentences held in self.data
+        seed: the seed of the latent codes and the sampled words
+        model_seed: the seed of the generating decoder parameters
+        vocab_size: the number of words besides the special symbols
+        nz: the dimension of the latent code
+        max_length: sentences are cut at this many words
+        init_scale: the decoder parameters are drawn from
+            U(-init_scale, init_scale)
+        gen_batch_size: the number of sentences sampled at once
+    """
+    def __init__(self, num_examples, seed=0, model_seed=783435, vocab_size=1000,
+                 nz=2, ni=50, nh=50, max_length=20, init_scale=1.0, gen_batch_size=500):
+        # the corpus reading of MonoTextData.__init__ is replaced by sampling
+        word2id = {'<pad>': 0, '<s>': 1, '</s>': 2, '<unk>': 3}
+        for i in range(vocab_size):
+            word2id['w%d' % i] = len(word2id)
+        self.vocab = VocabEntry(word2id)
+
+        self.nz = nz
+        self.max_length = max_length
+        self.gen_batch_size = gen_batch_size
+
+        # build the decoder without touching the global random state
+        with torch.random.fork_rng():
+            torch.manual_seed(model_seed)
+            dec_args = argparse.Namespace(ni=ni, dec_nh=nh, nz=nz,
+                                          dec_dropout_in=0., dec_dropout_out=0.)
+            init = lambda tensor: nn.init.uniform_(tensor, -init_scale, init_scale)
+            self.decoder = LSTMDecoder(dec_args, self.vocab, init, init)
+        self.decoder.eval()
+
+        # the special symbols are never sampled, </s> ends a sentence
+        self.logit_mask = torch.zeros(len(self.vocab))
+        for word in ['<pad>', '<s>', '<unk>']:
+            self.logit_mask[self.vocab[word]] = -float('inf')
+
+        self.generator = torch.Generator().manual_seed(seed)
+
+        self.data = []
+        self.latents = []
+        for batch_data, z in self.stream(self.gen_batch_size):
+            self.data.extend(batch_data[:num_examples - len(self.data)])
+            self.latents.append(z)
+            if len(self.data) == num_examples:
+                break
+
+        # (num_examples, nz), the latent code of every sentence
+        self.latents = torch.cat(self.latents, dim=0)[:num_examples]
+        self.dropped = 0
+        self.labels = None
+
+    def sample_batch(self, batch_size):
+        """sample one batch of sentences with the generating decoder
+        Returns: List, Tensor
+            List: the sentences, lists of word ids without start and stop
+                symbols
+            Tensor: the latent codes with shape (batch_size, nz)
+        """
+        decoder = self.decoder
+        eos = self.vocab['</s>']
+
+        with torch.no_grad():
+            z = torch.randn(batch_size, self.nz, generator=self.generator)
+
+            c = decoder.trans_linear(z).unsqueeze(0)
+            hidden = (torch.tanh(c), c)
+
+            input_word = torch.full((batch_size, 1), self.vocab['<s>'], dtype=torch.long)
+            finished = torch.zeros(batch_size, dtype=torch.bool)
+            words = []
+            for t in range(self.max_length):
+                # (batch_size, 1, ni + nz)
+                word_embed = torch.cat((decoder.embed(input_word), z.unsqueeze(1)), -1)
+                output, hidden = decoder.lstm(word_embed, hidden)
+
+                # (batch_size, vocab_size)
+                logits = decoder.pred_linear(output.squeeze(1)) + self.logit_mask
+                if t == 0:
+                    # no empty sentence
+                    logits[:, eos] = -float('inf')
+
+                word = torch.multinomial(F.softmax(logits, dim=-1), 1, generator=self.generator)
+                word = word.squeeze(1).masked_fill(finished, eos)
+                words.append(word)
+
+                finished = finished | (word == eos)
+                if finished.all():
+                    break
+
+                input_word = word.unsqueeze(1)
+
+        # (batch_size, seq_len)
+        words = torch.stack(words, dim=1).tolist()
+        sentences = []
+        for sent in words:
+            sentences.append(sent[:sent.index(eos)] if eos in sent else sent)
+
+        return sentences, z
+
+    def stream(self, batch_size):
+        """endless stream of freshly sampled batches, see sample_batch
+        """
+        while True:
+            yield self.sample_batch(batch_size)
+
+    def stream_data_batch(self, batch_size, device, batch_first=False):
+        """endless stream of fresh padded batches, in the format of
+        data_iter
+        Returns:
+            batch_data: LongTensor with shape (seq_len, batch_size)
+            sents_len: list of data length, this is the data length
+                       after counting start and stop symbols
+        """
+        for batch_data, _ in self.stream(batch_size):
+            batch_data.sort(key=lambda e: -len(e))
+            yield self._to_tensor(batch_data, batch_first, device)
+
+
+def synthetic_splits(sizes, seed=783435, **kwargs):
+    """create splits of the same synthetic language, each split gets
+    its own sentence seed
+    Args:
+        sizes: the number of sentences of every split
+    Returns: List
+        List: SyntheticTextData of every split, the vocabs are identical
+    """
+    return [SyntheticTextData(size, seed=seed + i, model_seed=seed, **kwargs)
+            for i, size in enumerate(sizes)]
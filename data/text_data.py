@@ -215,6 +215,34 @@ class MonoTextData(object):
         assert(total == len(self.data))
         return batch_data_list, batch_label_list
 
+    def iter_data_batch(self, batch_size, device, batch_first=False, indices=None):
+        """lazily batch the data w.r.t. the sentence length like
+        create_data_batch, so that the whole corpus is never held as
+        tensors at once
+        Args:
+            indices: only batch these sentences, all when None
+        Returns: Generator
+            ndarray: the indices of the batch sentences in self.data
+            Tensor: the batch data with shape (seq_len, batch_size)
+        """
+        if indices is None:
+            indices = np.arange(len(self.data))
+        indices = np.asarray(indices)
+        sents_len = np.array([len(self.data[id_]) for id_ in indices])
+        # stable so that sentences of the same length keep their order
+        sort_idx = indices[np.argsort(sents_len, kind='stable')]
+        sort_len = np.sort(sents_len, kind='stable')
+
+        curr = 0
+        while curr < len(sort_idx):
+            next = min(curr + batch_size, len(sort_idx))
+            # batches never cross a length change
+            next = curr + np.searchsorted(sort_len[curr:next], sort_len[curr], side='right')
+            idx = sort_idx[curr:next]
+            batch_data, _ = self._to_tensor([self.data[id_] for id_ in idx], batch_first, device)
+            curr = next
+            yield idx, batch_data
+
     def create_data_batch(self, batch_size, device, batch_first=False):
         """pad data with start and stop symbol, batching is performerd w.r.t.
         the sentence length, so that each returned batch has the same length,
@@ -0,0 +1,180 @@
+import sys
+import os
+import glob
+import time
+import importlib
+import argparse
+
+import numpy as np
+
+import torch
+import torch.multiprocessing as mp
+
+from data import MonoTextData, VocabEntry
+
+from text import init_model, test, calc_au, calc_iwnll
+
+# the per-process state of the pool workers, filled by init_worker
+worker_state = {}
+
+def init_config():
+    parser = argparse.ArgumentParser(description='evaluate many checkpoints in parallel')
+
+    parser.add_argument('--dataset', type=str, required=True, help='dataset to use')
+    parser.add_argument('--ckpt_dir', type=str, default='',
+                         help='folder of the checkpoints, models/<dataset> by default')
+    parser.add_argument('--pattern', type=str, default='*.pt', help='glob pattern of the checkpoints')
+    parser.add_argument('--output', type=str, default='',
+                         help='path of the results table, <ckpt_dir>/eval_results.tsv by default')
+
+    parser.add_argument('--nworkers', type=int, default=4, help='number of worker processes')
+    parser.add_argument('--nthreads', type=int, default=1, help='number of torch threads per worker')
+
+    parser.add_argument('--nsamples', type=int, default=1, help='number of samples for test loss')
+    parser.add_argument('--iw_nsamples', type=int, default=500,
+                         help='number of samples to compute importance weighted estimate, skipped when 0')
+    parser.add_argument('--iw_target_err', type=float, default=0,
+                         help='target standard error of the adaptive importance weighted estimate, \
+                         disabled when 0')
+    parser.add_argument('--qmc', action='store_true', default=False,
+                         help='draw the importance samples from randomized quasi-Monte Carlo points, \
+                         a power of 2 for iw_nsamples balances them best')
+
+    parser.add_argument('--seed', type=int, default=783435, metavar='S', help='random seed')
+
+    args = parser.parse_args()
+    args.cuda = torch.cuda.is_available()
+
+    if args.ckpt_dir == '':
+        args.ckpt_dir = "models/%s" % args.dataset
+
+    if args.output == '':
+        args.output = os.path.join(args.ckpt_dir, 'eval_results.tsv')
+
+    # load config file into args
+    config_file = "config.config_%s" % args.dataset
+    params = importlib.import_module(config_file).params
+    args = argparse.Namespace(**vars(args), **params)
+
+    if 'label' in params:
+        args.label = params['label']
+    else:
+        args.label = False
+
+    return args
+
+
+def pack_batches(data_batch):
+    """pack a list of batched tensors into one flat tensor so that the
+    whole list is shared with the workers through a single storage
+    Returns: Tensor, List
+        Tensor: flat long tensor that holds all the batches
+        List: the shape of every batch
+    """
+    shapes = [tuple(batch_data.size()) for batch_data in data_batch]
+    flat = torch.cat([batch_data.view(-1) for batch_data in data_batch])
+
+    return flat.share_memory_(), shapes
+
+def unpack_batches(flat, shapes, device):
+    flat = flat.to(device)
+    data_batch = []
+    offset = 0
+    for shape in shapes:
+        numel = int(np.prod(shape))
+        data_batch.append(flat[offset:offset + numel].view(*shape))
+        offset += numel
+
+    return data_batch
+
+
+def init_worker(args, word2id, packed_batch, packed_batch_iw):
+    torch.set_num_threads(args.nthreads)
+    vocab = VocabEntry(word2id)
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+    args.device = device
+
+    worker_state['args'] = args
+    worker_state['vae'] = init_model(args, vocab)
+    worker_state['vae'].encoder.qmc = args.qmc
+    worker_state['test_data_batch'] = unpack_batches(*packed_batch, device)
+    worker_state['test_data_batch_iw'] = unpack_batches(*packed_batch_iw, device)
+
+def eval_checkpoint(ckpt_path):
+    args = worker_state['args']
+    vae = worker_state['vae']
+    test_data_batch = worker_state['test_data_batch']
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    start = time.time()
+    vae.load_state_dict(torch.load(ckpt_path, map_location=args.device))
+    vae.eval()
+    with torch.no_grad():
+        loss, nll, kl, ppl, mi = test(vae, test_data_batch, "TEST", args, verbose=False)
+        au, _ = calc_au(vae, test_data_batch)
+        iw_nll = iw_ppl = float('nan')
+        if args.iw_nsamples > 0:
+            iw_nll, iw_ppl = calc_iwnll(vae, worker_state['test_data_batch_iw'], args)
+
+    return {'checkpoint': os.path.basename(ckpt_path), 'loss': loss, 'kl': kl,
+            'mi': mi, 'au': au, 'ppl': ppl, 'iw_nll': iw_nll, 'iw_ppl': iw_ppl,
+            'time': time.time() - start}
+
+
+def main(args):
+    ckpt_paths = sorted(glob.glob(os.path.join(args.ckpt_dir, args.pattern)))
+    if len(ckpt_paths) == 0:
+        raise ValueError("no checkpoint matches %s" % os.path.join(args.ckpt_dir, args.pattern))
+
+    print('%d checkpoints to evaluate' % len(ckpt_paths))
+
+    # the corpus is read and batched only once, the batches stay on
+    # cpu shared memory and every worker moves them to its device
+    train_data = MonoTextData(args.train_data, label=args.label)
+    vocab = train_data.vocab
+    test_data = MonoTextData(args.test_data, label=args.label, vocab=vocab)
+    del train_data
+
+    cpu = torch.device("cpu")
+    test_data_batch = test_data.create_data_batch(batch_size=args.batch_size,
+                                                  device=cpu,
+                                                  batch_first=True)
+    iw_batch_size = args.batch_size if args.iw_target_err > 0 else 1
+    test_data_batch_iw = test_data.create_data_batch(batch_size=iw_batch_size,
+                                                     device=cpu,
+                                                     batch_first=True)
+    packed_batch = pack_batches(test_data_batch)
+    packed_batch_iw = pack_batches(test_data_batch_iw)
+    del test_data_batch, test_data_batch_iw
+
+    print('finish reading datasets, vocab size is %d' % len(vocab))
+    sys.stdout.flush()
+
+    start = time.time()
+    fields = ['checkpoint', 'loss', 'kl', 'mi', 'au', 'ppl', 'iw_nll', 'iw_ppl', 'time']
+    results = []
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(args.nworkers, initializer=init_worker,
+                  initargs=(args, dict(vocab.word2id), packed_batch, packed_batch_iw)) as pool:
+        for res in pool.imap_unordered(eval_checkpoint, ckpt_paths):
+            results.append(res)
+            print('[%d/%d] %s --- loss: %.4f, kl: %.4f, mi: %.4f, au: %d, iw nll: %.4f, time %.2fs' % \
+                  (len(results), len(ckpt_paths), res['checkpoint'], res['loss'],
+                   res['kl'], res['mi'], res['au'], res['iw_nll'], res['time']))
+            sys.stdout.flush()
+
+    results.sort(key=lambda res: res['checkpoint'])
+    with open(args.output, 'w') as fout:
+        fout.write('\t'.join(fields) + '\n')
+        for res in results:
+            fout.write('\t'.join(str(res[field]) for field in fields) + '\n')
+
+    print('results of %d checkpoints written to %s, time elapsed %.2fs' % \
+          (len(results), args.output, time.time() - start))
+
+if __name__ == '__main__':
+    args = init_config()
+    main(args)
@@ -0,0 +1,107 @@
+import sys
+import time
+import importlib
+import argparse
+
+import numpy as np
+
+import torch
+
+from data import MonoTextData
+
+from modules import quantize_vae, model_size
+
+from text import init_model, test, calc_au
+
+def init_config():
+    parser = argparse.ArgumentParser(description='compare dynamic int8 quantized CPU inference of a text VAE with fp32')
+
+    parser.add_argument('--dataset', type=str, required=True, help='dataset to use')
+    parser.add_argument('--load_path', type=str, required=True, help='checkpoint to load')
+
+    parser.add_argument('--nsamples', type=int, default=1, help='number of samples for test loss')
+    parser.add_argument('--eval_batch_size', type=int, default=50, help='batch size of the test metrics')
+    parser.add_argument('--num_decode', type=int, default=1000,
+                         help='number of sentences greedily decoded from the prior to time decoding')
+    parser.add_argument('--nthreads', type=int, default=0, help='number of torch threads, torch default when 0')
+
+    parser.add_argument('--seed', type=int, default=783435, metavar='S', help='random seed')
+
+    args = parser.parse_args()
+
+    # load config file into args
+    config_file = "config.config_%s" % args.dataset
+    params = importlib.import_module(config_file).params
+    args = argparse.Namespace(**vars(args), **params)
+
+    if 'label' in params:
+        args.label = params['label']
+    else:
+        args.label = False
+
+    return args
+
+def evaluate(vae, test_data_batch, vocab, args):
+    """the metrics of test() and calc_au, and the timings of the test
+    pass and of greedy decoding, with the same seeds for every model
+    Returns: Dict
+    """
+    results = {}
+    with torch.no_grad():
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+        start = time.time()
+        _, results['nll'], results['kl'], results['ppl'], results['mi'] = \
+            test(vae, test_data_batch, 'TEST', args, verbose=False)
+        results['test_time'] = time.time() - start
+        results['au'], _ = calc_au(vae, test_data_batch)
+
+        torch.manual_seed(args.seed)
+        start = time.time()
+        for i in range(0, args.num_decode, 100):
+            z = vae.sample_from_prior(min(100, args.num_decode - i))
+            vae.decoder.sample_text_batch(z, vocab['<s>'], vocab['</s>'], vocab['<pad>'], greedy=True)
+        results['decode_time'] = time.time() - start
+
+    results['size'] = model_size(vae)
+    return results
+
+def main(args):
+    print(args)
+
+    # dynamic quantization runs on CPU
+    device = torch.device("cpu")
+    args.device = device
+    if args.nthreads > 0:
+        torch.set_num_threads(args.nthreads)
+
+    train_data = MonoTextData(args.train_data, label=args.label)
+    vocab = train_data.vocab
+    del train_data
+    test_data = MonoTextData(args.test_data, label=args.label, vocab=vocab)
+    test_data_batch = test_data.create_data_batch(batch_size=args.eval_batch_size,
+                                                  device=device, batch_first=True)
+
+    vae = init_model(args, vocab)
+    vae.load_state_dict(torch.load(args.load_path, map_location=device))
+    vae.eval()
+
+    fp32 = evaluate(vae, test_data_batch, vocab, args)
+    int8 = evaluate(quantize_vae(vae), test_data_batch, vocab, args)
+
+    print('%-6s %12s %12s %12s' % ('', 'fp32', 'int8', 'change'))
+    for name in ['ppl', 'nll', 'kl', 'mi']:
+        print('%-6s %12.4f %12.4f %+12.4f' % (name, fp32[name], int8[name], int8[name] - fp32[name]))
+    print('%-6s %12d %12d %+12d' % ('au', fp32['au'], int8['au'], int8['au'] - fp32['au']))
+
+    print('test pass --- fp32: %.2fs, int8: %.2fs, speedup: %.2fx' % \
+          (fp32['test_time'], int8['test_time'], fp32['test_time'] / int8['test_time']))
+    print('greedy decoding of %d sentences --- fp32: %.2fs, int8: %.2fs, speedup: %.2fx' % \
+          (args.num_decode, fp32['decode_time'], int8['decode_time'], fp32['decode_time'] / int8['decode_time']))
+    print('model size --- fp32: %.1fMB, int8: %.1fMB, %.2fx smaller' % \
+          (fp32['size'] / 2 ** 20, int8['size'] / 2 ** 20, fp32['size'] / int8['size']))
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+    args = init_config()
+    main(args)
@@ -0,0 +1,172 @@
+import os
+import sys
+import time
+import importlib
+import argparse
+
+import numpy as np
+
+import torch
+
+from data import MonoTextData
+from modules import ResNetEncoderV2, PixelCNNDecoderV2
+from modules import VAE
+from modules import export_modules
+
+from text import init_model
+
+def init_config():
+    parser = argparse.ArgumentParser(description='export the encoder and the decoder step of a trained VAE as TorchScript')
+
+    parser.add_argument('--dataset', type=str, required=True, help='dataset to use, text or image')
+    parser.add_argument('--load_path', type=str, required=True, help='checkpoint to load')
+    parser.add_argument('--save_dir', type=str, default='',
+                         help='directory of the exported modules, exported/<dataset> by default')
+
+    # parity check
+    parser.add_argument('--num_examples', type=int, default=500,
+                         help='number of test examples the exported modules are compared on')
+    parser.add_argument('--atol', type=float, default=1e-5,
+                         help='maximum absolute difference to the eager outputs')
+
+    parser.add_argument('--seed', type=int, default=783435, metavar='S', help='random seed')
+
+    args = parser.parse_args()
+    args.cuda = torch.cuda.is_available()
+
+    # load config file into args
+    config_file = "config.config_%s" % args.dataset
+    params = importlib.import_module(config_file).params
+    args = argparse.Namespace(**vars(args), **params)
+
+    if 'label' in params:
+        args.label = params['label']
+    else:
+        args.label = False
+
+    if args.save_dir == '':
+        args.save_dir = 'exported/%s' % args.dataset
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    return args
+
+def check_text(vae, scripted, test_data, args):
+    """compare the scripted encoder and decoder step with the eager
+    model on test sentences, the decoder step is run with teacher forcing
+    from the posterior means
+    Returns: Float, Float
+        Float: the maximum absolute difference of mu and logvar
+        Float: the maximum absolute difference of the logits
+    """
+    encoder, decoder_step = scripted['encoder'], scripted['decoder_step']
+    enc_diff = dec_diff = 0.
+    eager_time = script_time = 0.
+    num_examples = 0
+
+    # batches of sentences with the same length
+    for batch_data in test_data.create_data_batch(100, args.device, batch_first=True):
+        if num_examples >= args.num_examples:
+            break
+        num_examples += batch_data.size(0)
+
+        mu, logvar = vae.encode_stats(batch_data)[:2]
+        mu_s, logvar_s = encoder(batch_data)
+        enc_diff = max(enc_diff, (mu - mu_s).abs().max().item(), (logvar - logvar_s).abs().max().item())
+
+        start = time.time()
+        # (batch_size, seq_len - 1, vocab_size)
+        logits = vae.decoder.decode(batch_data[:, :-1], mu.unsqueeze(1))
+        eager_time += time.time() - start
+
+        start = time.time()
+        h, c = decoder_step.init_state(mu)
+        logits_s = []
+        for t in range(batch_data.size(1) - 1):
+            logits_t, h, c = decoder_step(batch_data[:, t], h, c, mu)
+            logits_s.append(logits_t)
+        logits_s = torch.stack(logits_s, dim=1)
+        script_time += time.time() - start
+
+        dec_diff = max(dec_diff, (logits - logits_s).abs().max().item())
+
+    print('%d examples, eager decoding %.3fs, scripted step by step decoding %.3fs' % \
+          (num_examples, eager_time, script_time))
+
+    return enc_diff, dec_diff
+
+def check_image(vae, scripted, x_test, args):
+    """compare the scripted encoder with the eager model on test images
+    Returns: Float
+        Float: the maximum absolute difference of mu and logvar
+    """
+    encoder = scripted['encoder']
+    enc_diff = 0.
+    for i in range(0, min(args.num_examples, x_test.size(0)), 100):
+        batch_data = x_test[i:min(i + 100, args.num_examples)]
+        mu, logvar = vae.encode_stats(batch_data)[:2]
+        mu_s, logvar_s = encoder(batch_data)
+        enc_diff = max(enc_diff, (mu - mu_s).abs().max().item(), (logvar - logvar_s).abs().max().item())
+
+    return enc_diff
+
+def main(args):
+    print(args)
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+    args.device = device
+
+    is_image = 'img_size' in vars(args)
+    if is_image:
+        vae = VAE(ResNetEncoderV2(args), PixelCNNDecoderV2(args), args).to(device)
+    else:
+        train_data = MonoTextData(args.train_data, label=args.label)
+        vocab = train_data.vocab
+        del train_data
+        vae = init_model(args, vocab)
+
+    vae.load_state_dict(torch.load(args.load_path, map_location=device))
+
+    exported = export_modules(vae)
+
+    if not os.path.exists(args.save_dir):
+        os.makedirs(args.save_dir)
+
+    for name, module in exported.items():
+        path = os.path.join(args.save_dir, '%s.pt' % name)
+        module.save(path)
+        print('%s saved to %s' % (name, path))
+
+    if not is_image:
+        # the word of every id, one per line, for tokenizing without
+        # the training code
+        path = os.path.join(args.save_dir, 'vocab.txt')
+        with open(path, 'w') as fout:
+            for i in range(len(vocab)):
+                fout.write('%s\n' % vocab.id2word(i))
+        print('vocab saved to %s' % path)
+
+    # the parity check runs on the saved files
+    scripted = {name: torch.jit.load(os.path.join(args.save_dir, '%s.pt' % name), map_location=device)
+                for name in exported}
+
+    with torch.no_grad():
+        if is_image:
+            x_test = torch.load(args.data_file)[2].to(device)
+            enc_diff = check_image(vae, scripted, x_test, args)
+            dec_diff = 0.
+            print('the PixelCNN decoder is not exported, it has no per-step state')
+        else:
+            test_data = MonoTextData(args.test_data, label=args.label, vocab=vocab)
+            enc_diff, dec_diff = check_text(vae, scripted, test_data, args)
+
+    print('max abs diff --- encoder: %.3g, decoder step: %.3g' % (enc_diff, dec_diff))
+    if max(enc_diff, dec_diff) > args.atol:
+        print('parity check failed, the tolerance is %g' % args.atol)
+        sys.exit(1)
+    print('parity check passed')
+
+if __name__ == '__main__':
+    args = init_config()
+    main(args)
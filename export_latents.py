@@ -0,0 +1,81 @@
+import importlib
+import argparse
+
+import numpy as np
+
+import torch
+
+from data import MonoTextData
+
+from text import init_model, export_latents
+
+def init_config():
+    parser = argparse.ArgumentParser(description='encode a text corpus into memory-mapped .npy latent arrays')
+
+    parser.add_argument('--dataset', type=str, required=True, help='dataset to use')
+    parser.add_argument('--load_path', type=str, required=True, help='checkpoint to load')
+    parser.add_argument('--split', choices=['train', 'val', 'test'], default='test',
+                         help='split of the dataset to encode')
+    parser.add_argument('--data_file', type=str, default='',
+                         help='corpus to encode instead of the split, in the format of the dataset')
+    parser.add_argument('--output_dir', type=str, default='',
+                         help='directory of mu.npy, logvar.npy and labels.npy, latents/<dataset>/<split> by default')
+
+    parser.add_argument('--encode_batch_size', type=int, default=1000, help='number of sentences encoded at once')
+    parser.add_argument('--cache_dir', type=str, default='',
+                         help='read the posterior parameters from the posterior cache of the checkpoint in this \
+                         folder, the cache is filled on a miss, no caching when empty')
+    parser.add_argument('--report_interval', type=int, default=50, help='print progress every this many batches')
+
+    parser.add_argument('--seed', type=int, default=783435, metavar='S', help='random seed')
+
+    args = parser.parse_args()
+    args.cuda = torch.cuda.is_available()
+
+    # load config file into args
+    config_file = "config.config_%s" % args.dataset
+    params = importlib.import_module(config_file).params
+    args = argparse.Namespace(**vars(args), **params)
+
+    if 'label' in params:
+        args.label = params['label']
+    else:
+        args.label = False
+
+    if args.data_file == '':
+        args.data_file = vars(args)['%s_data' % args.split]
+
+    if args.output_dir == '':
+        args.output_dir = 'latents/%s/%s' % (args.dataset, args.split)
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    return args
+
+def main(args):
+    print(args)
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+    args.device = device
+
+    train_data = MonoTextData(args.train_data, label=args.label)
+    vocab = train_data.vocab
+    if args.data_file == args.train_data:
+        data = train_data
+    else:
+        del train_data
+        data = MonoTextData(args.data_file, label=args.label, vocab=vocab)
+    print('%d examples read from %s, dropped sentences: %d' % (len(data), args.data_file, data.dropped))
+
+    vae = init_model(args, vocab)
+    vae.load_state_dict(torch.load(args.load_path, map_location=device))
+    vae.eval()
+
+    export_latents(vae, data, args.output_dir, args.encode_batch_size, device,
+                   report_interval=args.report_interval, cache_dir=args.cache_dir,
+                   ckpt_path=args.load_path)
+
+if __name__ == '__main__':
+    args = init_config()
+    main(args)
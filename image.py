@@ -13,6 +13,9 @@ from torch import nn, optim
 
 from modules import ResNetEncoderV2, PixelCNNDecoderV2
 from modules import VAE
+from modules import DiagnosticSubset
+from modules import PosteriorCache, iter_batch_stats
+from modules import AsyncValidator
 
 clip_grad = 5.0
 decay_epoch = 20
@@ -29,10 +32,21 @@ def init_config():
     parser.add_argument('--nsamples', type=int, default=1, help='number of samples for training')
     parser.add_argument('--iw_nsamples', type=int, default=500,
                          help='number of samples to compute importance weighted estimate')
+    parser.add_argument('--iw_target_err', type=float, default=0,
+                         help='draw importance samples adaptively until the standard error of log p(x) \
+                         per example is below this value, iw_nsamples is the cap. Disabled when 0')
+
+    parser.add_argument('--qmc', action='store_true', default=False,
+                         help='draw the noise of multiple posterior samples from randomized quasi-Monte Carlo \
+                         points, reduces the variance of multi-sample training and iw nll, a power of 2 for \
+                         iw_nsamples balances the points best')
 
     # select mode
     parser.add_argument('--eval', action='store_true', default=False, help='compute iw nll')
     parser.add_argument('--load_path', type=str, default='')
+    parser.add_argument('--cache_dir', type=str, default='',
+                         help='cache the posterior parameters of the test data in this folder, \
+                         keyed by checkpoint and data, no caching when empty')
 
     # annealing paramters
     parser.add_argument('--warm_up', type=int, default=10)
@@ -41,6 +55,24 @@ def init_config():
     # inference parameters
     parser.add_argument('--aggressive', type=int, default=0,
                          help='apply aggressive training when nonzero, reduce to vanilla VAE when aggressive is 0')
+    parser.add_argument('--refine_nsteps', type=int, default=0,
+                         help='semi-amortized training when nonzero: refine the posterior of every batch with \
+                         this many gradient steps on the ELBO, the encoder is trained to match the refined posterior. \
+                         Cannot be combined with aggressive')
+    parser.add_argument('--refine_lr', type=float, default=1.0, help='step size of the posterior refinement')
+    parser.add_argument('--target_loss', type=float, default=0,
+                         help='report the time elapsed until the val loss first reaches this value, disabled when 0')
+
+    parser.add_argument('--async_val', action='store_true', default=False,
+                         help='evaluate on val/test data in a background process while training continues, \
+                         the results of each epoch are applied at the end of the next epoch')
+
+    parser.add_argument('--diag_budget', type=int, default=0,
+                         help='number of examples used for the mi/au diagnostics every log_niter \
+                         iterations, the whole val data is used when 0')
+    parser.add_argument('--diag_mode', choices=['fixed', 'rotate', 'train'], default='rotate',
+                         help='fixed: always the same val subset, rotate: the next val subset at every log, \
+                         train: the most recent training batches')
 
     # others
     parser.add_argument('--seed', type=int, default=783435, metavar='S', help='random seed')
@@ -62,9 +94,14 @@ def init_config():
     seed_set = [783435, 101, 202, 303, 404, 505, 606, 707, 808, 909]
     args.seed = seed_set[args.taskid]
 
+    if args.aggressive and args.refine_nsteps > 0:
+        raise ValueError("aggressive training and posterior refinement cannot be combined")
+
     id_ = "%s_aggressive%d_ns%d_kls%.1f_warm%d_%d_%d_%d" % \
             (args.dataset, args.aggressive, args.nsamples,
              args.kl_start, args.warm_up, args.jobid, args.taskid, args.seed)
+    if args.refine_nsteps > 0:
+        id_ += "_refine%d" % args.refine_nsteps
 
     save_path = os.path.join(save_dir, id_ + '.pt')
 
@@ -85,7 +122,7 @@ def init_config():
     return args
 
 
-def test(model, test_loader, mode, args):
+def test(model, test_loader, mode, args, stats=None):
 
     report_kl_loss = report_rec_loss = 0
     report_num_examples = 0
@@ -108,7 +145,7 @@ def test(model, test_loader, mode, args):
         report_rec_loss += loss_rc.item()
         report_kl_loss += loss_kl.item()
 
-    mutual_info = calc_mi(model, test_loader)
+    mutual_info = calc_mi(model, test_loader, stats=stats)
 
     test_loss = (report_rec_loss  + report_kl_loss) / report_num_examples
 
@@ -122,25 +159,42 @@ def test(model, test_loader, mode, args):
 
     return test_loss, nll, kl
 
-def calc_mi(model, test_loader):
+def calc_mi(model, test_loader, stats=None):
+    """stats are the cached posterior parameters from PosteriorCache of
+    the batches of an unshuffled test_loader, the encoder is not run when
+    they are provided
+    """
     mi = 0
     num_examples = 0
+    if stats is not None:
+        device = next(model.parameters()).device
+        stats_iter = iter_batch_stats(stats, [batch_data for batch_data, _ in test_loader], device)
     for datum in test_loader:
         batch_data, _ = datum
         batch_size = batch_data.size(0)
         num_examples += batch_size
-        mutual_info = model.calc_mi_q(batch_data)
+        if stats is not None:
+            mu, logvar = next(stats_iter)
+            mutual_info = model.encoder.calc_mi_from_stats(mu, logvar)
+        else:
+            mutual_info = model.calc_mi_q(batch_data)
         mi += mutual_info * batch_size
 
     return mi / num_examples
 
-def calc_au(model, test_loader, delta=0.01):
+def calc_au(model, test_loader, delta=0.01, stats=None):
     """compute the number of active units
     """
+    if stats is not None:
+        # (N, nz)
+        means = torch.from_numpy(np.array(stats[0]))
+        au_var = means.var(dim=0)
+        return (au_var >= delta).sum().item(), au_var
+
     means = []
     for datum in test_loader:
         batch_data, _ = datum
-        mean, _ = model.encode_stats(batch_data)
+        mean = model.encode_stats(batch_data)[0]
         means.append(mean)
 
     means = torch.cat(means, dim=0)
@@ -156,7 +210,7 @@ def calc_au(model, test_loader, delta=0.01):
 
 def calc_iwnll(model, test_loader, args):
 
-    report_nll_loss = 0
+    report_nll_loss = report_err = report_num_samples = 0
     report_num_examples = 0
     for id_, datum in enumerate(test_loader):
         batch_data, _ = datum
@@ -168,16 +222,64 @@ def calc_iwnll(model, test_loader, args):
             print('iw nll computing %d0%%' % (id_/(round(len(test_loader) / 10))))
             sys.stdout.flush()
 
-        loss = model.nll_iw(batch_data, nsamples=args.iw_nsamples)
+        if args.iw_target_err > 0:
+            loss, std_err, num_samples = model.nll_iw_adaptive(batch_data, args.iw_target_err,
+                                                               max_nsamples=args.iw_nsamples)
+            report_err += std_err.sum().item()
+            report_num_samples += num_samples.sum().item()
+        else:
+            loss = model.nll_iw(batch_data, nsamples=args.iw_nsamples)
 
         report_nll_loss += loss.sum().item()
 
     nll = report_nll_loss / report_num_examples
 
-    print('iw nll: %.4f' % nll)
+    if args.iw_target_err > 0:
+        print('iw nll: %.4f, avg std err: %.4f, avg samples: %.1f' % \
+              (nll, report_err / report_num_examples, report_num_samples / report_num_examples))
+    else:
+        print('iw nll: %.4f' % nll)
     sys.stdout.flush()
     return nll
 
+def async_val_init(args):
+    """build the model and the val/test data of the AsyncValidator process
+    """
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+    args.device = device
+    vae = VAE(ResNetEncoderV2(args), PixelCNNDecoderV2(args), args).to(device)
+    vae.encoder.qmc = args.qmc
+    vae.eval()
+
+    _, x_val, x_test = torch.load(args.data_file)
+    x_val = x_val.to(device)
+    x_test = x_test.to(device)
+    val_data = torch.utils.data.TensorDataset(x_val, x_val.new_zeros(x_val.size(0), 1))
+    test_data = torch.utils.data.TensorDataset(x_test, x_test.new_zeros(x_test.size(0), 1))
+    val_loader = torch.utils.data.DataLoader(val_data, batch_size=args.batch_size, shuffle=True)
+    test_loader = torch.utils.data.DataLoader(test_data, batch_size=args.batch_size, shuffle=True)
+
+    return vae, (args, val_loader, test_loader)
+
+def async_val_eval(vae, context, epoch, run_test, aggressive):
+    """evaluate a weight snapshot in the AsyncValidator process, the mi
+    is only needed by the stop burning decision of aggressive training
+    and is None otherwise
+    """
+    args, val_loader, test_loader = context
+    print('epoch: %d, async VAL' % epoch)
+    loss, nll, kl = test(vae, val_loader, "VAL", args)
+    au, _ = calc_au(vae, val_loader)
+    print("%d active units" % au)
+    mi = calc_mi(vae, val_loader) if aggressive else None
+    if run_test:
+        test(vae, test_loader, "TEST", args)
+
+    return loss, nll, kl, mi
+
 def main(args):
     if args.save_path == '':
         make_savepath(args)
@@ -222,6 +324,7 @@ def main(args):
     decoder = PixelCNNDecoderV2(args)
 
     vae = VAE(encoder, decoder, args).to(device)
+    vae.encoder.qmc = args.qmc
 
     if args.sample_from != '':
         save_dir = "samples/%s" % args.dataset
@@ -230,9 +333,12 @@ def main(args):
 
         vae.load_state_dict(torch.load(args.sample_from))
         vae.eval()
+        start = time.time()
         with torch.no_grad():
-            sample_z = vae.sample_from_prior(400).to(device)
+            sample_z = vae.prior.sample((400,))
             sample_x, sample_probs = vae.decode(sample_z, False)
+        elapsed = time.time() - start
+        print('sampled 400 images, time elapsed %.2fs, %.2f images/s' % (elapsed, 400 / elapsed))
         image_file = 'sample_binary_from_%s.png' % (args.sample_from.split('/')[-1][:-3])
         save_image(sample_x.data.cpu(), os.path.join(save_dir, image_file), nrow=20)
         image_file = 'sample_cont_from_%s.png' % (args.sample_from.split('/')[-1][:-3])
@@ -242,12 +348,19 @@ def main(args):
 
     if args.eval:
         print('begin evaluation')
-        test_loader = torch.utils.data.DataLoader(test_data, batch_size=50, shuffle=True)
+        # the cache rows follow the batches, which must keep their order
+        test_loader = torch.utils.data.DataLoader(test_data, batch_size=50, shuffle=not args.cache_dir)
         vae.load_state_dict(torch.load(args.load_path))
         vae.eval()
         with torch.no_grad():
-            test(vae, test_loader, "TEST", args)
-            au, au_var = calc_au(vae, test_loader)
+            stats = None
+            if args.cache_dir:
+                test_data_batch = [batch_data for batch_data, _ in test_loader]
+                stats = PosteriorCache.from_checkpoint(args.cache_dir, args.load_path,
+                                                       test_data_batch).get(vae, test_data_batch)
+
+            test(vae, test_loader, "TEST", args, stats=stats)
+            au, au_var = calc_au(vae, test_loader, stats=stats)
             print("%d active units" % au)
             # print(au_var)
 
@@ -264,165 +377,224 @@ def main(args):
     best_kl = best_nll = best_ppl = 0
     decay_cnt = pre_mi = best_mi = mi_not_improved =0
     aggressive_flag = True if args.aggressive else False
+    target_time = None
     vae.train()
     start = time.time()
 
     kl_weight = args.kl_start
     anneal_rate = (1.0 - args.kl_start) / (args.warm_up * len(train_loader))
 
-    for epoch in range(args.epochs):
-        report_kl_loss = report_rec_loss = 0
-        report_num_examples = 0
-        for datum in train_loader:
-            batch_data, _ = datum
-            batch_data = torch.bernoulli(batch_data)
-            batch_size = batch_data.size(0)
+    async_val = AsyncValidator(async_val_init, async_val_eval, (args,)) if args.async_val else None
+    diag_subset = None
+    if args.diag_budget > 0:
+        # the val batches are fixed once so that subsets can be selected
+        diag_subset = DiagnosticSubset(list(val_loader), args.diag_budget, args.diag_mode)
 
-            report_num_examples += batch_size
+    try:
+        for epoch in range(args.epochs):
+            report_kl_loss = report_rec_loss = 0
+            report_num_examples = 0
+            for datum in train_loader:
+                batch_data, _ = datum
+                batch_data = torch.bernoulli(batch_data)
+                batch_size = batch_data.size(0)
+                if diag_subset is not None:
+                    diag_subset.add((batch_data, None))
 
-            # kl_weight = 1.0
-            kl_weight = min(1.0, kl_weight + anneal_rate)
+                report_num_examples += batch_size
 
-            sub_iter = 1
-            batch_data_enc = batch_data
-            burn_num_examples = 0
-            burn_pre_loss = 1e4
-            burn_cur_loss = 0
-            while aggressive_flag and sub_iter < 100:
+                # kl_weight = 1.0
+                kl_weight = min(1.0, kl_weight + anneal_rate)
 
-                enc_optimizer.zero_grad()
-                dec_optimizer.zero_grad()
+                sub_iter = 1
+                batch_data_enc = batch_data
+                burn_num_examples = 0
+                burn_pre_loss = 1e4
+                burn_cur_loss = 0
+                while aggressive_flag and sub_iter < 100:
 
-                burn_num_examples += batch_data_enc.size(0)
-                loss, loss_rc, loss_kl = vae.loss(batch_data_enc, kl_weight, nsamples=args.nsamples)
+                    enc_optimizer.zero_grad()
+                    dec_optimizer.zero_grad()
 
-                burn_cur_loss += loss.sum().item()
-                loss = loss.mean(dim=-1)
+                    burn_num_examples += batch_data_enc.size(0)
+                    loss, loss_rc, loss_kl, _ = vae.loss(batch_data_enc, kl_weight, nsamples=args.nsamples)
 
-                loss.backward()
-                torch.nn.utils.clip_grad_norm_(vae.parameters(), clip_grad)
-
-                enc_optimizer.step()
-
-                id_ = np.random.choice(x_train.size(0), args.batch_size, replace=False)
-
-                batch_data_enc = torch.bernoulli(x_train[id_])
-
-                if sub_iter % 10 == 0:
-                    burn_cur_loss = burn_cur_loss / burn_num_examples
-                    if burn_pre_loss - burn_cur_loss < 0:
-                        break
-                    burn_pre_loss = burn_cur_loss
-                    burn_cur_loss = burn_num_examples = 0
-
-                sub_iter += 1
+                    burn_cur_loss += loss.sum().item()
+                    loss = loss.mean(dim=-1)
 
-            # print(sub_iter)
+                    loss.backward()
+                    torch.nn.utils.clip_grad_norm_(vae.parameters(), clip_grad)
 
-            enc_optimizer.zero_grad()
-            dec_optimizer.zero_grad()
+                    enc_optimizer.step()
 
+                    id_ = np.random.choice(x_train.size(0), args.batch_size, replace=False)
 
-            loss, loss_rc, loss_kl = vae.loss(batch_data, kl_weight, nsamples=args.nsamples)
+                    batch_data_enc = torch.bernoulli(x_train[id_])
 
-            loss = loss.mean(dim=-1)
+                    if sub_iter % 10 == 0:
+                        burn_cur_loss = burn_cur_loss / burn_num_examples
+                        if burn_pre_loss - burn_cur_loss < 0:
+                            break
+                        burn_pre_loss = burn_cur_loss
+                        burn_cur_loss = burn_num_examples = 0
 
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(vae.parameters(), clip_grad)
+                    sub_iter += 1
 
-            loss_rc = loss_rc.sum()
-            loss_kl = loss_kl.sum()
+                # print(sub_iter)
 
-            if not aggressive_flag:
-                enc_optimizer.step()
+                enc_optimizer.zero_grad()
+                dec_optimizer.zero_grad()
 
-            dec_optimizer.step()
 
-            report_rec_loss += loss_rc.item()
-            report_kl_loss += loss_kl.item()
+                if args.refine_nsteps > 0:
+                    loss, loss_rc, loss_kl, _ = vae.loss_refine(batch_data, kl_weight,
+                        nsteps=args.refine_nsteps, lr=args.refine_lr, nsamples=args.nsamples)
+                else:
+                    loss, loss_rc, loss_kl, _ = vae.loss(batch_data, kl_weight, nsamples=args.nsamples)
 
-            if iter_ % log_niter == 0:
-                train_loss = (report_rec_loss  + report_kl_loss) / report_num_examples
-                if aggressive_flag or epoch == 0:
-                    vae.eval()
-                    with torch.no_grad():
-                        mi = calc_mi(vae, val_loader)
-                        au, _ = calc_au(vae, val_loader)
+                loss = loss.mean(dim=-1)
 
-                    vae.train()
+                loss.backward()
+                torch.nn.utils.clip_grad_norm_(vae.parameters(), clip_grad)
 
-                    print('epoch: %d, iter: %d, avg_loss: %.4f, kl: %.4f, mi: %.4f, recon: %.4f,' \
-                           'au %d, time elapsed %.2fs' %
-                           (epoch, iter_, train_loss, report_kl_loss / report_num_examples, mi,
-                           report_rec_loss / report_num_examples, au, time.time() - start))
-                else:
-                     print('epoch: %d, iter: %d, avg_loss: %.4f, kl: %.4f, recon: %.4f,' \
-                           'time elapsed %.2fs' %
-                           (epoch, iter_, train_loss, report_kl_loss / report_num_examples,
-                           report_rec_loss / report_num_examples, time.time() - start))
-                sys.stdout.flush()
-
-                report_rec_loss = report_kl_loss = 0
-                report_num_examples = 0
-
-            iter_ += 1
-
-            if aggressive_flag and (iter_ % len(train_loader)) == 0:
-                vae.eval()
-                cur_mi = calc_mi(vae, val_loader)
-                vae.train()
-                if cur_mi - best_mi < 0:
-                    mi_not_improved += 1
-                    if mi_not_improved == 5:
-                        aggressive_flag = False
-                        print("STOP BURNING")
+                loss_rc = loss_rc.sum()
+                loss_kl = loss_kl.sum()
 
-                else:
-                    best_mi = cur_mi
+                if not aggressive_flag:
+                    enc_optimizer.step()
 
-                pre_mi = cur_mi
+                dec_optimizer.step()
 
-        print('kl weight %.4f' % kl_weight)
-        print('epoch: %d, VAL' % epoch)
+                report_rec_loss += loss_rc.item()
+                report_kl_loss += loss_kl.item()
 
-        vae.eval()
+                if iter_ % log_niter == 0:
+                    train_loss = (report_rec_loss  + report_kl_loss) / report_num_examples
+                    if aggressive_flag or epoch == 0:
+                        vae.eval()
+                        with torch.no_grad():
+                            diag_loader = val_loader if diag_subset is None else diag_subset.next()
+                            mi = calc_mi(vae, diag_loader)
+                            au, _ = calc_au(vae, diag_loader)
 
-        with torch.no_grad():
-            loss, nll, kl = test(vae, val_loader, "VAL", args)
-            au, au_var = calc_au(vae, val_loader)
-            print("%d active units" % au)
-            # print(au_var)
+                        vae.train()
 
-        if loss < best_loss:
-            print('update best loss')
-            best_loss = loss
-            best_nll = nll
-            best_kl = kl
-            torch.save(vae.state_dict(), args.save_path)
-
-        if loss > best_loss:
-            opt_dict["not_improved"] += 1
-            if opt_dict["not_improved"] >= decay_epoch:
-                opt_dict["best_loss"] = loss
-                opt_dict["not_improved"] = 0
-                opt_dict["lr"] = opt_dict["lr"] * lr_decay
-                vae.load_state_dict(torch.load(args.save_path))
-                decay_cnt += 1
-                print('new lr: %f' % opt_dict["lr"])
-                enc_optimizer = optim.Adam(vae.encoder.parameters(), lr=opt_dict["lr"])
-                dec_optimizer = optim.Adam(vae.decoder.parameters(), lr=opt_dict["lr"])
-        else:
-            opt_dict["not_improved"] = 0
-            opt_dict["best_loss"] = loss
+                        print('epoch: %d, iter: %d, avg_loss: %.4f, kl: %.4f, mi: %.4f, recon: %.4f,' \
+                               'au %d, time elapsed %.2fs' %
+                               (epoch, iter_, train_loss, report_kl_loss / report_num_examples, mi,
+                               report_rec_loss / report_num_examples, au, time.time() - start))
+                    else:
+                         print('epoch: %d, iter: %d, avg_loss: %.4f, kl: %.4f, recon: %.4f,' \
+                               'time elapsed %.2fs' %
+                               (epoch, iter_, train_loss, report_kl_loss / report_num_examples,
+                               report_rec_loss / report_num_examples, time.time() - start))
+                    sys.stdout.flush()
 
-        if decay_cnt == max_decay:
-            break
+                    report_rec_loss = report_kl_loss = 0
+                    report_num_examples = 0
 
-        if epoch % args.test_nepoch == 0:
-            with torch.no_grad():
-                loss, nll, kl = test(vae, test_loader, "TEST", args)
+                iter_ += 1
 
-        vae.train()
+                # in async mode the stop burning decision uses the mi of the
+                # background validation instead
+                if aggressive_flag and async_val is None and (iter_ % len(train_loader)) == 0:
+                    vae.eval()
+                    cur_mi = calc_mi(vae, val_loader)
+                    vae.train()
+                    if cur_mi - best_mi < 0:
+                        mi_not_improved += 1
+                        if mi_not_improved == 5:
+                            aggressive_flag = False
+                            print("STOP BURNING")
+
+                    else:
+                        best_mi = cur_mi
+
+                    pre_mi = cur_mi
+
+            print('kl weight %.4f' % kl_weight)
+
+            vae.eval()
+
+            if async_val is not None:
+                async_val.submit(epoch, vae, run_test=epoch % args.test_nepoch == 0,
+                                 aggressive=aggressive_flag)
+                val_results = async_val.collect()
+            else:
+                print('epoch: %d, VAL' % epoch)
+                with torch.no_grad():
+                    loss, nll, kl = test(vae, val_loader, "VAL", args)
+                    au, au_var = calc_au(vae, val_loader)
+                    print("%d active units" % au)
+                    # print(au_var)
+                val_results = [(epoch, None, (loss, nll, kl, None))]
+
+            # the validation results are applied in epoch order, in async
+            # mode the results of epoch e are applied at the end of epoch e+1
+            for val_epoch, snapshot, (loss, nll, kl, cur_mi) in val_results:
+                if async_val is not None and aggressive_flag:
+                    if cur_mi - best_mi < 0:
+                        mi_not_improved += 1
+                        if mi_not_improved == 5:
+                            aggressive_flag = False
+                            print("STOP BURNING")
+
+                    else:
+                        best_mi = cur_mi
+
+                    pre_mi = cur_mi
+
+                if args.target_loss > 0 and target_time is None and loss <= args.target_loss:
+                    target_time = time.time() - start
+                    print('reach target val loss %.4f at epoch %d, time elapsed %.2fs' % \
+                          (args.target_loss, val_epoch, target_time))
+
+                if loss < best_loss:
+                    print('update best loss')
+                    best_loss = loss
+                    best_nll = nll
+                    best_kl = kl
+                    torch.save(vae.state_dict() if snapshot is None else snapshot, args.save_path)
+
+                if loss > best_loss:
+                    opt_dict["not_improved"] += 1
+                    if opt_dict["not_improved"] >= decay_epoch:
+                        opt_dict["best_loss"] = loss
+                        opt_dict["not_improved"] = 0
+                        opt_dict["lr"] = opt_dict["lr"] * lr_decay
+                        vae.load_state_dict(torch.load(args.save_path))
+                        decay_cnt += 1
+                        print('new lr: %f' % opt_dict["lr"])
+                        enc_optimizer = optim.Adam(vae.encoder.parameters(), lr=opt_dict["lr"])
+                        dec_optimizer = optim.Adam(vae.decoder.parameters(), lr=opt_dict["lr"])
+                else:
+                    opt_dict["not_improved"] = 0
+                    opt_dict["best_loss"] = loss
+
+            if decay_cnt == max_decay:
+                break
+
+            if async_val is None and epoch % args.test_nepoch == 0:
+                with torch.no_grad():
+                    loss, nll, kl = test(vae, test_loader, "TEST", args)
+
+            vae.train()
+
+        if async_val is not None:
+            # the snapshots still in flight can only update the best checkpoint
+            for val_epoch, snapshot, (loss, nll, kl, cur_mi) in async_val.close():
+                if loss < best_loss:
+                    print('update best loss')
+                    best_loss = loss
+                    torch.save(snapshot, args.save_path)
+    finally:
+        # a failed run must not leave the validation process behind
+        if async_val is not None:
+            async_val.terminate()
+
+    if args.target_loss > 0 and target_time is None:
+        print('target val loss %.4f not reached, time elapsed %.2fs' % \
+              (args.target_loss, time.time() - start))
 
     # compute importance weighted estimate of log p(x)
     vae.load_state_dict(torch.load(args.save_path))
@@ -3,4 +3,9 @@ from .decoders import *
 from .vae import *
 from .lm import *
 # from .plotter import *
-from .utils import *
\ No newline at end of file
+from .utils import *
+from .posterior_cache import *
+from .async_val import *
+from .latent_index import *
+from .export import *
+from .quantize import *
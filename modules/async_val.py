@@ -0,0 +1,102 @@
+import sys
+import queue
+
+import torch
+import torch.multiprocessing as mp
+
+
+def async_val_worker(init_fn, eval_fn, init_args, request_queue, result_queue):
+    """evaluate the weight snapshots sent by AsyncValidator
+    """
+    model, context = init_fn(*init_args)
+
+    while True:
+        request = request_queue.get()
+        if request is None:
+            break
+
+        epoch, snapshot, options = request
+        model.load_state_dict(snapshot)
+        with torch.no_grad():
+            result = eval_fn(model, context, epoch, **options)
+
+        sys.stdout.flush()
+        result_queue.put((epoch, result))
+
+class AsyncValidator(object):
+    """Evaluate snapshots of the model weights on val (and test) data in
+    a background process while training continues. The results are
+    returned in submission order. init_fn and eval_fn are pickled by the
+    spawn context, they must be module level functions
+    Args:
+        init_fn: called once in the background process as
+            init_fn(*init_args), returns (model, context) where model is
+            in eval mode and context holds the evaluation data
+        eval_fn: called as eval_fn(model, context, epoch, **options) for
+            every submitted snapshot, returns the picklable val result
+        poll_interval: seconds between the checks that the background
+            process is still alive while waiting for a result
+    """
+    def __init__(self, init_fn, eval_fn, init_args=(), poll_interval=10.):
+        super(AsyncValidator, self).__init__()
+        ctx = mp.get_context('spawn')
+        self.request_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        # daemonic, so that the process is killed rather than joined when
+        # the training process exits without calling close
+        self.process = ctx.Process(target=async_val_worker,
+            args=(init_fn, eval_fn, init_args, self.request_queue, self.result_queue), daemon=True)
+        self.process.start()
+        self.poll_interval = poll_interval
+
+        # (epoch, snapshot) of the submitted requests without results
+        self.pending = []
+
+    def submit(self, epoch, model, **options):
+        """send a snapshot of the model weights, options are passed to
+        eval_fn
+        """
+        snapshot = {k: v.detach().cpu().clone() for k, v in model.state_dict().items()}
+        self.request_queue.put((epoch, snapshot, options))
+        self.pending.append((epoch, snapshot))
+
+    def _get_result(self):
+        while True:
+            # a worker that died before the get has flushed all its results
+            alive = self.process.is_alive()
+            try:
+                return self.result_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if not alive:
+                    raise RuntimeError('the async validation process died with exit code %s' % \
+                                       self.process.exitcode)
+
+    def collect(self, lag=1):
+        """wait until at most lag requests are pending
+        Returns: List
+            List: (epoch, snapshot, val_result) of the finished requests
+                in submission order
+        """
+        results = []
+        while len(self.pending) > lag:
+            epoch, snapshot = self.pending.pop(0)
+            res_epoch, val_result = self._get_result()
+            assert res_epoch == epoch
+            results.append((epoch, snapshot, val_result))
+
+        return results
+
+    def close(self):
+        results = self.collect(lag=0)
+        self.request_queue.put(None)
+        self.process.join()
+
+        return results
+
+    def terminate(self):
+        """stop the background process without waiting for the pending
+        requests, a no-op after close
+        """
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
@@ -12,6 +12,7 @@ from torch.nn.utils.rnn import pad_packed_sequence, pack_padded_sequence
 import numpy as np
 
 from .decoder import DecoderBase
+from ..utils import filter_logits
 
 class LSTMDecoder(DecoderBase):
     """LSTM decoder with constant-length data"""
@@ -39,6 +40,9 @@ class LSTMDecoder(DecoderBase):
         # prediction layer
         self.pred_linear = nn.Linear(args.dec_nh, len(vocab), bias=False)
 
+        # never generated by sample_text_batch and beam_search_decode
+        self.unk_id = vocab['<unk>']
+
         vocab_mask = torch.ones(len(vocab))
         # vocab_mask[vocab['<pad>']] = 0
         self.loss = nn.CrossEntropyLoss(weight=vocab_mask, reduce=False)
@@ -92,6 +96,173 @@ class LSTMDecoder(DecoderBase):
             sentence.append(max_index)
         return sentence
 
+    def sample_text_batch(self, z, start, eos, pad=0, max_length=100, greedy=False,
+                          temperature=1.0, top_k=0, top_p=1.0, seed=None):
+        """sample one sentence for every latent code at once, the LSTM
+        state is carried across steps and everything stays on the device.
+        The start, padding and unknown symbols are never generated
+        Args:
+            z: the latent codes with shape [batch, nz]
+            start, eos, pad: the ids of the start, stop and padding symbols
+            max_length: sentences without stop symbol are cut here
+            greedy: pick the most likely word instead of sampling
+            temperature: the logits are divided by temperature
+            top_k: sample from the top_k most likely words, no top-k
+                filtering when 0
+            top_p: sample from the smallest set of words whose probability
+                reaches top_p (nucleus sampling), no filtering when 1.0
+            seed: the samples are reproducible for a given seed, the
+                global random state is used when None. A list with one
+                seed per latent code makes every sentence independent of
+                the rest of the batch
+        Returns: Tensor1, Tensor2
+            Tensor1: the sampled ids with shape [batch, seq_len], padded
+                with pad after the stop symbol
+            Tensor2: the number of words before the stop symbol (or
+                max_length) of every sentence, shape [batch]
+        """
+        batch_size = z.size(0)
+
+        c_init = self.trans_linear(z).unsqueeze(0)
+        hidden = (torch.tanh(c_init), c_init)
+
+        # (batch_size, 1, nz)
+        z_ = z.unsqueeze(1)
+        input_word = torch.full((batch_size, 1), start, dtype=torch.long, device=z.device)
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=z.device)
+        lengths = torch.full((batch_size,), max_length, dtype=torch.long, device=z.device)
+
+        generator = generators = None
+        if isinstance(seed, int):
+            generator = torch.Generator(device=z.device).manual_seed(seed)
+        elif seed is not None:
+            generators = [torch.Generator(device=z.device).manual_seed(int(s)) for s in seed]
+
+        special = torch.tensor([start, pad, self.unk_id], device=z.device)
+
+        words = []
+        for t in range(max_length):
+            # (batch_size, 1, ni + nz)
+            word_embed = torch.cat((self.embed(input_word), z_), -1)
+            output, hidden = self.lstm(word_embed, hidden)
+
+            # (batch_size, vocab_size)
+            output_logits = self.pred_linear(output.squeeze(1))
+            output_logits = output_logits.index_fill(1, special, -float('inf'))
+            if greedy:
+                word = output_logits.argmax(dim=-1)
+            else:
+                output_logits = filter_logits(output_logits / temperature, top_k, top_p)
+                probs = F.softmax(output_logits, dim=-1)
+                if generators is None:
+                    word = torch.multinomial(probs, 1, generator=generator).squeeze(1)
+                else:
+                    # inverse CDF with one uniform draw per row from its own generator
+                    u = torch.cat([torch.rand(1, generator=g, device=z.device) for g in generators])
+                    cum_probs = probs.cumsum(dim=-1)
+                    word = (cum_probs <= u.unsqueeze(1) * cum_probs[:, -1:]).sum(dim=-1)
+            word = word.masked_fill(finished, pad)
+
+            end = (word == eos) & ~finished
+            lengths.masked_fill_(end, t)
+            finished = finished | end
+            words.append(word)
+
+            if finished.all():
+                break
+
+            input_word = word.unsqueeze(1)
+
+        return torch.stack(words, dim=1), lengths
+
+    def beam_search_decode(self, z, start, eos, pad=0, beam_size=5, max_length=100,
+                           length_penalty=1.0):
+        """beam search decoding of every latent code, the beams of the
+        whole batch are run as one flattened (batch * beam) LSTM state.
+        Unfinished beams never pick the start, padding or unknown symbols,
+        finished beams keep their score and are only extended with pad,
+        decoding stops when every beam has finished
+        Args:
+            z: the latent codes with shape [batch, nz]
+            start, eos, pad: the ids of the start, stop and padding symbols
+            beam_size: the number of beams per latent code, greedy
+                decoding when 1
+            length_penalty: the final scores are log p / len^length_penalty,
+                no length normalization when 0
+        Returns: Tensor1, Tensor2, Tensor3
+            Tensor1: the best decoded ids with shape [batch, seq_len], padded
+                with pad after the stop symbol
+            Tensor2: the number of words before the stop symbol (or
+                max_length), shape [batch]
+            Tensor3: the length normalized log probability, shape [batch]
+        """
+        batch_size = z.size(0)
+        device = z.device
+
+        # (batch_size * beam_size, nz)
+        z = z.repeat_interleave(beam_size, dim=0)
+        c_init = self.trans_linear(z).unsqueeze(0)
+        hidden = (torch.tanh(c_init), c_init)
+        z_ = z.unsqueeze(1)
+
+        # only the first beam is alive at the start so that the beams
+        # do not all expand the same prefix
+        scores = torch.full((batch_size, beam_size), -float('inf'), device=device)
+        scores[:, 0] = 0
+        finished = torch.zeros(batch_size, beam_size, dtype=torch.bool, device=device)
+        lengths = torch.zeros(batch_size, beam_size, dtype=torch.long, device=device)
+        # (batch_size, beam_size, t)
+        seqs = torch.zeros(batch_size, beam_size, 0, dtype=torch.long, device=device)
+
+        # offset of the first beam of every example in the flattened state
+        beam_offset = (torch.arange(batch_size, device=device) * beam_size).unsqueeze(1)
+
+        special = torch.tensor([start, pad, self.unk_id], device=device)
+
+        input_word = torch.full((batch_size * beam_size, 1), start, dtype=torch.long, device=device)
+        for t in range(max_length):
+            word_embed = torch.cat((self.embed(input_word), z_), -1)
+            output, hidden = self.lstm(word_embed, hidden)
+
+            # (batch_size, beam_size, vocab_size)
+            log_prob = F.log_softmax(self.pred_linear(output.squeeze(1)), dim=-1)
+            log_prob = log_prob.view(batch_size, beam_size, -1)
+            vocab_size = log_prob.size(2)
+
+            log_prob = log_prob.index_fill(2, special, -float('inf'))
+            # a finished beam can only be extended with pad at no cost
+            log_prob = log_prob.masked_fill(finished.unsqueeze(2), -float('inf'))
+            log_prob[..., pad] = log_prob[..., pad].masked_fill(finished, 0.)
+
+            # (batch_size, beam_size * vocab_size)
+            cand_scores = (scores.unsqueeze(2) + log_prob).view(batch_size, -1)
+            scores, index = cand_scores.topk(beam_size, dim=1)
+            beam_id = index // vocab_size
+            word = index % vocab_size
+
+            # reorder the beam states
+            flat_id = (beam_offset + beam_id).view(-1)
+            hidden = (hidden[0][:, flat_id], hidden[1][:, flat_id])
+            finished = finished.gather(1, beam_id)
+            lengths = lengths.gather(1, beam_id)
+            seqs = torch.cat([seqs.gather(1, beam_id.unsqueeze(2).expand(-1, -1, t)),
+                              word.unsqueeze(2)], dim=2)
+
+            finished = finished | (word == eos)
+            lengths = lengths + (~finished).long()
+
+            if finished.all():
+                break
+
+            input_word = word.view(-1, 1)
+
+        # the stop symbol counts in the length normalization
+        norm_scores = scores / (lengths + finished.long()).clamp(min=1).float().pow(length_penalty)
+        best_score, best = norm_scores.max(dim=1)
+        index = torch.arange(batch_size, device=device)
+
+        return seqs[index, best], lengths[index, best], best_score
+
     def decode(self, input, z):
         """
         Args:
@@ -3,7 +3,6 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
 
 import numpy as np
 
@@ -29,6 +28,44 @@ class MaskedConv2d(nn.Conv2d):
         self.weight.data.mul_(self.mask)
         return super(MaskedConv2d, self).forward(x)
 
+    def forward_row(self, x, i, j, cache):
+        """the output at row i, columns 0 to j, of the convolution during
+        generation. The mask never looks at rows below or, in row i, to
+        the right, so only the input rows i - kH // 2 to i - 1 are kept in
+        cache next to the current row. The rows above are final as long as
+        the input at a position does not depend on the pixel there, i.e.
+        after the first block
+        Args:
+            x: the input row i with shape [batch, in_channels, 1, j + 1]
+            i: the row index, every row is visited after the one above
+            j: the column index, the last call of a row has j = W - 1
+            cache: dict of the rows of every convolution
+        Returns: Tensor
+            Tensor: the output row with shape [batch, out_channels, 1, j + 1]
+        """
+        self.weight.data.mul_(self.mask)
+        pH, pW = self.padding
+
+        row, above, current = cache.get(self, (-1, None, None))
+        if row != i:
+            assert row == i - 1, 'rows must be generated top down'
+            if current is not None:
+                if above is None:
+                    # the zero padding above the image
+                    above = current.new_zeros(*current.size()[:2], pH, current.size(3))
+                above = torch.cat([above[:, :, 1:], current], dim=2)
+        cache[self] = (i, above, x)
+
+        if above is None:
+            above = x.new_zeros(*x.size()[:2], pH, x.size(3))
+        else:
+            above = above[:, :, :, :j + 1 + pW]
+
+        # the columns right of j in row i and the padding below are masked out
+        rows = torch.cat([above, F.pad(x, (0, above.size(3) - x.size(3)))], dim=2)
+        rows = F.pad(rows, (pW, j + 1 + pW - rows.size(3), 0, pH))
+        return F.conv2d(rows, self.weight, self.bias)
+
 class PixelCNNBlock(nn.Module):
     def __init__(self, in_channels, kernel_size):
         super(PixelCNNBlock, self).__init__()
@@ -61,6 +98,18 @@ class PixelCNNBlock(nn.Module):
     def forward(self, input):
         return self.activation(self.main(input) + input)
 
+    def forward_row(self, input, i, j, cache):
+        """the output at row i, columns 0 to j, during generation, see
+        MaskedConv2d.forward_row
+        """
+        output = input
+        for layer in self.main:
+            if isinstance(layer, MaskedConv2d):
+                output = layer.forward_row(output, i, j, cache)
+            else:
+                output = layer(output)
+        return self.activation(output + input)
+
 
 class MaskABlock(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size, masked_channels):
@@ -84,6 +133,57 @@ class MaskABlock(nn.Module):
     def forward(self, input):
         return self.main(input)
 
+    def latent_conv(self, z):
+        """the part of the masked convolution applied to the latent
+        feature maps z with shape [N, fm, H, W]
+        """
+        conv = self.main[0]
+        nc = conv.in_channels - z.size(1)
+        return F.conv2d(z, conv.weight[:, nc:], padding=conv.padding)
+
+    def forward_shared(self, img, z_out):
+        """the masked convolution is linear, so the image part is computed
+        once per example and added to the latent part of every sample
+        Args:
+            img: the image tensor with shape [batch, nc, H, W]
+            z_out: the latent part of the convolution, see latent_conv,
+                with shape [batch, nsamples, out_channels, H, W]
+        Returns: Tensor
+            Tensor: the block output with shape [batch * nsamples, out_channels, H, W]
+        """
+        conv = self.main[0]
+        conv.weight.data.mul_(conv.mask)
+        nc = img.size(1)
+
+        # [batch, out_channels, H, W]
+        img_out = F.conv2d(img, conv.weight[:, :nc], padding=conv.padding)
+
+        output = img_out.unsqueeze(1) + z_out
+
+        return self.main[2](self.main[1](output.view(-1, *output.size()[2:])))
+
+    def forward_row(self, img, z_out, i, j):
+        """the output at row i, columns 0 to j, during generation. The
+        image is read directly since its rows above i are final, the
+        latent channels are not masked and see the rows below, their part
+        of the convolution is computed on the whole image beforehand
+        Args:
+            img: the image being generated with shape [batch, nc, H, W]
+            z_out: row i, columns 0 to j, of the latent part of the
+                convolution, see latent_conv, with shape
+                [batch, out_channels, 1, j + 1]
+        """
+        conv = self.main[0]
+        conv.weight.data.mul_(conv.mask)
+        pH, pW = conv.padding
+
+        # zero padding above and right of the image, the columns right of
+        # j in row i and the padding below are masked out
+        rows = img[:, :, max(i - pH, 0):i + 1, :j + 1 + pW]
+        rows = F.pad(rows, (pW, j + 1 + pW - rows.size(3), pH + 1 - rows.size(2), pH))
+        output = F.conv2d(rows, conv.weight[:, :img.size(1)]) + z_out
+        return self.main[2](self.main[1](output))
+
 
 class PixelCNN(nn.Module):
     def __init__(self, in_channels, out_channels, num_blocks, kernel_sizes, masked_channels):
@@ -105,7 +205,15 @@ class PixelCNN(nn.Module):
 
         self.direct_connects = nn.ModuleList(self.direct_connects)
 
-    def forward(self, input):
+    def forward(self, input, z=None):
+        """
+        Args:
+            input: [batch, in_channels, H, W], or the image [batch, nc, H, W]
+                when z is given
+            z: the latent part of the first convolution with shape
+                [batch, nsamples, out_channels, H, W], combined with the
+                image inside the first block, see MaskABlock.forward_shared
+        """
         # [batch, out_channels, H, W]
         direct_inputs = []
         for i, layer in enumerate(self.main):
@@ -114,12 +222,42 @@ class PixelCNN(nn.Module):
                 direct_conncet = self.direct_connects[i - 3]
                 input = input + direct_conncet(direct_input)
 
-            input = layer(input)
+            if i == 0 and z is not None:
+                input = layer.forward_shared(input, z)
+            else:
+                input = layer(input)
             direct_inputs.append(input)
         assert len(direct_inputs) == 3, 'architecture error: %d' % len(direct_inputs)
         direct_conncet = self.direct_connects[-1]
         return input + direct_conncet(direct_inputs.pop(0))
 
+    def forward_row(self, img, z_out, i, j, cache):
+        """the output at row i, columns 0 to j, during generation, see
+        MaskABlock.forward_row and MaskedConv2d.forward_row
+        Args:
+            img: the image being generated with shape [batch, nc, H, W]
+            z_out: row i, columns 0 to j, of the latent part of the first
+                convolution
+            i: the row index
+            j: the column index
+            cache: dict of the rows of every convolution
+        Returns: Tensor
+            Tensor: the output with shape [batch, out_channels, 1, j + 1]
+        """
+        direct_inputs = []
+        input = img
+        for k, layer in enumerate(self.main):
+            if k > 2:
+                direct_input = direct_inputs.pop(0)
+                input = input + self.direct_connects[k - 3].forward_row(direct_input, i, j, cache)
+
+            if k == 0:
+                input = layer.forward_row(input, z_out, i, j)
+            else:
+                input = layer.forward_row(input, i, j, cache)
+            direct_inputs.append(input)
+        return input + self.direct_connects[-1].forward_row(direct_inputs.pop(0), i, j, cache)
+
 class PixelCNNDecoderV2(DecoderBase):
     def __init__(self, args, ngpu=1, mode='large'):
         super(PixelCNNDecoderV2, self).__init__()
@@ -169,11 +307,50 @@ class PixelCNNDecoderV2(DecoderBase):
             output = self.main(input)
         return output
 
+    def forward_shared(self, img, z):
+        """forward of every (image, latent sample) pair without expanding
+        the image, see MaskABlock.forward_shared
+        Args:
+            img: the image tensor with shape [batch, nc, H, W]
+            z: the latent samples with shape [batch, nsamples, nz]
+        Returns: Tensor
+            Tensor: the pixel probabilities with shape [batch * nsamples, nc, H, W]
+        """
+        batch_size, nsamples, nz = z.size()
+        first_block = self.main[0].main[0]
+        H = W = 28
+
+        if batch_size * nsamples > nz + 1:
+            # z_transform and the convolution are both linear, push the
+            # nz weight columns and the bias of z_transform through the
+            # convolution once, then every sample is one matrix product
+            linear = self.z_transform[0]
+            basis = torch.cat([linear.weight.t(), linear.bias.unsqueeze(0)], dim=0)
+            # [nz + 1, out_channels * H * W]
+            response = first_block.latent_conv(basis.view(nz + 1, self.fm_latent, H, W)).view(nz + 1, -1)
+            z_out = torch.addmm(response[nz], z.view(-1, nz), response[:nz])
+        else:
+            z_out = first_block.latent_conv(self.z_transform(z).view(-1, self.fm_latent, H, W))
+
+        # [batch, nsamples, out_channels, H, W]
+        z_out = z_out.view(batch_size, nsamples, -1, H, W)
+
+        output = self.main[0](img, z_out)
+        for layer in self.main[1:]:
+            output = layer(output)
+        return output
+
     def reconstruct_error(self, x, z):
         eps = 1e-12
         if type(z) == type(None):
             batch_size, nsampels, _, _ = x.size()
             img = x.unsqueeze(1).expand(batch_size, nsampels, *x.size()[1:])
+        elif z.size(1) > 1 and self.ngpu <= 1:
+            # multiple samples share the image part of the first layer,
+            # forward_shared does not split the batch over gpus, with
+            # ngpu > 1 the expanded input goes through data_parallel
+            batch_size, nsampels, nz = z.size()
+            img = None
         else:
             batch_size, nsampels, nz = z.size()
             # [batch, nsamples, -1] --> [batch, nsamples, fm, H, W]
@@ -184,10 +361,13 @@ class PixelCNNDecoderV2(DecoderBase):
             # [batch, nsample, nc+fm, H, W] --> [batch * nsamples, nc+fm, H, W]
             img = torch.cat([img, z], dim=2)
 
-        img = img.view(-1, *img.size()[2:])
+        if img is None:
+            recon_x = self.forward_shared(x, z).view(batch_size, nsampels, -1)
+        else:
+            img = img.view(-1, *img.size()[2:])
 
-        # [batch * nsamples, *] --> [batch, nsamples, -1]
-        recon_x = self.forward(img).view(batch_size, nsampels, -1)
+            # [batch * nsamples, *] --> [batch, nsamples, -1]
+            recon_x = self.forward(img).view(batch_size, nsampels, -1)
         # [batch, -1]
         x_flat = x.view(batch_size, -1)
         BCE = (recon_x + eps).log() * x_flat.unsqueeze(1) + (1.0 - recon_x + eps).log() * (1. - x_flat).unsqueeze(1)
@@ -198,7 +378,7 @@ class PixelCNNDecoderV2(DecoderBase):
         bce = self.reconstruct_error(x, z)
         return bce * -1.
 
-    def decode(self, z, deterministic):
+    def decode(self, z, deterministic, fast=True):
         '''
 
         Args:
@@ -206,6 +386,13 @@ class PixelCNNDecoderV2(DecoderBase):
                 the tensor of latent z shape=[batch, nz]
             deterministic: boolean
                 randomly sample of decode via argmaximizing probability
+            fast: boolean
+                for each pixel only recompute the current row of every
+                layer up to that pixel, the rows above are cached, see
+                PixelCNN.forward_row. It gives the same samples
+                as running the whole network once per pixel, which is
+                used in training mode since batch norm needs the whole
+                image then
 
         Returns: Tensor
             the tensor of decoded x shape=[batch, *]
@@ -214,19 +401,35 @@ class PixelCNNDecoderV2(DecoderBase):
         H = W = 28
         batch_size, nz = z.size()
 
-        # [batch, -1] --> [batch, fm, H, W]
-        z = self.z_transform(z).view(batch_size, self.fm_latent, H, W)
-        img = Variable(z.data.new(batch_size, self.nc, H, W).zero_(), volatile=True)
-        # [batch, nc+fm, H, W]
-        img = torch.cat([img, z], dim=1)
-        for i in range(H):
-            for j in range(W):
-                # [batch, nc, H, W]
-                recon_img = self.forward(img)
-                # [batch, nc]
-                img[:, :self.nc, i, j] = torch.ge(recon_img[:, :, i, j], 0.5).float() if deterministic else torch.bernoulli(recon_img[:, :, i, j])
-                # img[:, :self.nc, i, j] = torch.bernoulli(recon_img[:, :, i, j])
-
-        # [batch, nc, H, W]
-        img_probs = self.forward(img)
+        with torch.no_grad():
+            # [batch, -1] --> [batch, fm, H, W]
+            z = self.z_transform(z).view(batch_size, self.fm_latent, H, W)
+            img = z.new_zeros(batch_size, self.nc, H, W)
+
+            if fast and not self.training:
+                # [batch, out_channels, H, W]
+                z_out = self.main[0].main[0].latent_conv(z)
+                cache = {}
+                for i in range(H):
+                    for j in range(W):
+                        # [batch, nc, 1, j + 1]
+                        output = self.main[0].forward_row(img, z_out[:, :, i:i+1, :j+1], i, j, cache)
+                        for layer in self.main[1:]:
+                            output = layer(output)
+                        # [batch, nc]
+                        probs = output[:, :, 0, j]
+                        img[:, :, i, j] = torch.ge(probs, 0.5).float() if deterministic else torch.bernoulli(probs)
+                img = torch.cat([img, z], dim=1)
+            else:
+                # [batch, nc+fm, H, W]
+                img = torch.cat([img, z], dim=1)
+                for i in range(H):
+                    for j in range(W):
+                        # [batch, nc, H, W]
+                        recon_img = self.forward(img)
+                        # [batch, nc]
+                        img[:, :self.nc, i, j] = torch.ge(recon_img[:, :, i, j], 0.5).float() if deterministic else torch.bernoulli(recon_img[:, :, i, j])
+
+            # [batch, nc, H, W]
+            img_probs = self.forward(img)
         return img[:, :self.nc], img_probs
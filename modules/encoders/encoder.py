@@ -2,13 +2,17 @@ import math
 import torch
 import torch.nn as nn
 
-from ..utils import log_sum_exp
+from ..utils import log_sum_exp, qmc_normal
 
 class GaussianEncoderBase(nn.Module):
     """docstring for EncoderBase"""
     def __init__(self):
         super(GaussianEncoderBase, self).__init__()
 
+        # draw the reparameterization noise of multiple samples from
+        # randomized quasi-Monte Carlo points instead of i.i.d. normals
+        self.qmc = False
+
     def forward(self, x):
         """
         Args:
@@ -21,8 +25,10 @@ class GaussianEncoderBase(nn.Module):
 
         raise NotImplementedError
 
-    def sample(self, input, nsamples):
+    def sample(self, input, nsamples, eps=None):
         """sampling from the encoder
+        Args:
+            eps: the standard normal noise, see reparameterize
         Returns: Tensor1, Tuple
             Tensor1: the tensor latent z with shape [batch, nsamples, nz]
             Tuple: contains the tensor mu [batch, nz] and
@@ -33,7 +39,7 @@ class GaussianEncoderBase(nn.Module):
         mu, logvar,_,_ = self.forward(input)
 
         # (batch, nsamples, nz)
-        z = self.reparameterize(mu, logvar, nsamples)
+        z = self.reparameterize(mu, logvar, nsamples, eps=eps)
 
         return z, (mu, logvar)
 
@@ -56,7 +62,7 @@ class GaussianEncoderBase(nn.Module):
 
         return z, KL, 0
 
-    def reparameterize(self, mu, logvar, nsamples=1):
+    def reparameterize(self, mu, logvar, nsamples=1, eps=None):
         """sample from posterior Gaussian family
         Args:
             mu: Tensor
@@ -65,6 +71,10 @@ class GaussianEncoderBase(nn.Module):
             logvar: Tensor
                 logvar of gaussian distibution with shape (batch, nz)
 
+            eps: Tensor
+                the standard normal noise with shape (batch, nsamples, nz),
+                drawn here when None
+
         Returns: Tensor
             Sampled z with shape (batch, nsamples, nz)
         """
@@ -74,7 +84,11 @@ class GaussianEncoderBase(nn.Module):
         mu_expd = mu.unsqueeze(1).expand(batch_size, nsamples, nz)
         std_expd = std.unsqueeze(1).expand(batch_size, nsamples, nz)
 
-        eps = torch.zeros_like(std_expd).normal_()
+        if eps is None:
+            if self.qmc and nsamples > 1:
+                eps = qmc_normal(batch_size, nsamples, nz, mu.device)
+            else:
+                eps = torch.zeros_like(std_expd).normal_()
 
         return mu_expd + torch.mul(eps, std_expd)
 
@@ -87,7 +101,7 @@ class GaussianEncoderBase(nn.Module):
 
         """
         # (batch_size, nz)
-        mu, logvar = self.forward(x)
+        mu, logvar, _, _ = self.forward(x)
         # std = logvar.mul(0.5).exp()
 
         # batch_size = mu.size(0)
@@ -118,7 +132,7 @@ class GaussianEncoderBase(nn.Module):
         nz = z.size(2)
 
         if not param:
-            mu, logvar = self.forward(x)
+            mu, logvar, _, _ = self.forward(x)
         else:
             mu, logvar = param
 
@@ -146,6 +160,20 @@ class GaussianEncoderBase(nn.Module):
         # [x_batch, nz]
         mu, logvar,_,_ = self.forward(x)
 
+        return self.calc_mi_from_stats(mu, logvar)
+
+    def calc_mi_from_stats(self, mu, logvar):
+        """Approximate the mutual information from precomputed
+        posterior parameters, see calc_mi
+
+        Args:
+            mu: the mean tensor, shape (x_batch, nz)
+            logvar: the logvar tensor, shape (x_batch, nz)
+
+        Returns: Float
+
+        """
+
         x_batch, nz = mu.size()
 
         # E_{q(z|x)}log(q(z|x)) = -0.5*nz*log(2*\pi) - 0.5*(1+logvar).sum(-1)
@@ -0,0 +1,122 @@
+from typing import Tuple
+
+import torch
+import torch.nn as nn
+
+from .encoders import LSTMEncoder, ResNetEncoderV2
+from .decoders import LSTMDecoder
+
+class LSTMEncoderExport(nn.Module):
+    """the inference part of LSTMEncoder without args, ready for
+    torch.jit.script. The submodules are shared with the encoder
+    """
+    def __init__(self, encoder):
+        super(LSTMEncoderExport, self).__init__()
+        self.embed = encoder.embed
+        self.lstm = encoder.lstm
+        self.mu_fc = encoder.mu_fc
+        self.logvar_fc = encoder.logvar_fc
+
+    def forward(self, input: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            input: the word ids with start and stop symbols, shape
+                (batch_size, seq_len), see LSTMEncoder.forward
+
+        Returns: Tensor1, Tensor2
+            Tensor1: the mean tensor, shape (batch, nz)
+            Tensor2: the logvar tensor, shape (batch, nz)
+        """
+        word_embed = self.embed(input)
+        _, (last_state, _) = self.lstm(word_embed)
+        last_state = last_state.squeeze(0)
+
+        return self.mu_fc(last_state), self.logvar_fc(last_state)
+
+class ResNetEncoderExport(nn.Module):
+    """the inference part of ResNetEncoderV2 without args, ready for
+    torch.jit.script. The submodules are shared with the encoder
+    """
+    def __init__(self, encoder):
+        super(ResNetEncoderExport, self).__init__()
+        self.main = encoder.main
+        self.mu_fc = encoder.mu_fc
+        self.mu_bn = encoder.mu_bn
+        self.logvar_fc = encoder.logvar_fc
+
+    def forward(self, input: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            input: the images with shape (batch_size, nc, H, W)
+
+        Returns: Tensor1, Tensor2
+            Tensor1: the mean tensor, shape (batch, nz)
+            Tensor2: the logvar tensor, shape (batch, nz)
+        """
+        output = self.main(input)
+        output = output.view(output.size(0), output.size(1))
+
+        return self.mu_bn(self.mu_fc(output)), self.logvar_fc(output)
+
+class LSTMDecoderStepExport(nn.Module):
+    """one step of LSTMDecoder without args, ready for torch.jit.script,
+    the decoding loop is left to the caller. The submodules are shared
+    with the decoder
+    """
+    def __init__(self, decoder):
+        super(LSTMDecoderStepExport, self).__init__()
+        self.embed = decoder.embed
+        self.trans_linear = decoder.trans_linear
+        self.lstm = decoder.lstm
+        self.pred_linear = decoder.pred_linear
+
+    @torch.jit.export
+    def init_state(self, z: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            z: the latent codes with shape (batch_size, nz)
+
+        Returns: Tensor1, Tensor2
+            Tensor1: the initial hidden state, shape (1, batch_size, nh)
+            Tensor2: the initial cell, shape (1, batch_size, nh)
+        """
+        c_init = self.trans_linear(z).unsqueeze(0)
+        return torch.tanh(c_init), c_init
+
+    def forward(self, input: torch.Tensor, h: torch.Tensor, c: torch.Tensor,
+                z: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            input: the previous word ids with shape (batch_size)
+            h, c: the LSTM state, shape (1, batch_size, nh)
+            z: the latent codes with shape (batch_size, nz)
+
+        Returns: Tensor1, Tensor2, Tensor3
+            Tensor1: the logits of the next word, shape (batch_size, vocab_size)
+            Tensor2, Tensor3: the new LSTM state
+        """
+        # (batch_size, 1, ni + nz)
+        word_embed = torch.cat((self.embed(input), z), -1).unsqueeze(1)
+        output, (h, c) = self.lstm(word_embed, (h, c))
+
+        return self.pred_linear(output.squeeze(1)), h, c
+
+def export_modules(vae):
+    """script the encoder and, for LSTM decoders, the decoder step of a
+    trained vae, the vae is switched to eval mode
+    Returns: Dict
+        Dict: the ScriptModules by name, 'encoder' and 'decoder_step'
+    """
+    vae.eval()
+    modules = {}
+    if type(vae.encoder) is LSTMEncoder:
+        modules['encoder'] = torch.jit.script(LSTMEncoderExport(vae.encoder))
+    elif type(vae.encoder) is ResNetEncoderV2:
+        modules['encoder'] = torch.jit.script(ResNetEncoderExport(vae.encoder))
+    else:
+        raise ValueError('exporting %s is not supported' % type(vae.encoder).__name__)
+
+    if type(vae.decoder) is LSTMDecoder:
+        modules['decoder_step'] = torch.jit.script(LSTMDecoderStepExport(vae.decoder))
+
+    return modules
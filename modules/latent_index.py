@@ -0,0 +1,324 @@
+import torch
+
+
+def pairwise_sqdist(x, y):
+    """squared euclidean distances between the rows of x [N, D] and of
+    y [M, D], shape [N, M]
+    """
+    dist = torch.addmm((y * y).sum(dim=1).unsqueeze(0), x, y.t(), alpha=-2)
+    dist.add_((x * x).sum(dim=1, keepdim=True))
+    return dist.clamp_(min=0)
+
+
+def merge_topk(dist, ids, new_dist, new_ids, k):
+    """keep the k smallest distances of two candidate sets
+    Returns: Tensor1, Tensor2
+        Tensor1: the distances with shape [batch, k'], k' <= k
+        Tensor2: the ids of the distances
+    """
+    dist = torch.cat([dist, new_dist], dim=1)
+    ids = torch.cat([ids, new_ids], dim=1)
+    dist, idx = dist.topk(min(k, dist.size(1)), dim=1, largest=False)
+    return dist, ids.gather(1, idx)
+
+
+def kmeans(x, k, niter=20, seed=783435, chunk_size=65536):
+    """Lloyd's k-means with centroids initialized on random points, the
+    empty clusters are reseeded on random points
+    Returns: Tensor
+        Tensor: the centroids with shape [k, D]
+    """
+    if x.size(0) < k:
+        raise ValueError('k-means needs at least %d points, got %d' % (k, x.size(0)))
+
+    generator = torch.Generator().manual_seed(seed)
+    centroids = x[torch.randperm(x.size(0), generator=generator)[:k].to(x.device)].clone()
+    for _ in range(niter):
+        assign = torch.cat([pairwise_sqdist(x[i:i + chunk_size], centroids).argmin(dim=1)
+                            for i in range(0, x.size(0), chunk_size)])
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=k)
+
+        empty = counts == 0
+        counts[empty] = 1
+        centroids = sums / counts.unsqueeze(1).float()
+        if empty.any():
+            reseed = torch.randint(x.size(0), (int(empty.sum()),), generator=generator).to(x.device)
+            centroids[empty] = x[reseed]
+
+    return centroids
+
+
+class LatentIndex(object):
+    """exact nearest neighbour search over latent codes, e.g. the
+    posterior means of a corpus, with batched matrix products
+    Args:
+        nz: the dimension of the latent codes
+        metric: 'l2' or 'cosine', the cosine index stores normalized codes
+        device: the device of the stored codes and of the search
+    """
+    def __init__(self, nz, metric='l2', device='cpu'):
+        super(LatentIndex, self).__init__()
+        if metric not in ('l2', 'cosine'):
+            raise ValueError('unknown metric: %s' % metric)
+        self.nz = nz
+        self.metric = metric
+        self.device = torch.device(device)
+
+        self.vectors = torch.zeros(0, nz, device=self.device)
+        self.ids = torch.zeros(0, dtype=torch.long, device=self.device)
+        # the first id given when add is called without ids
+        self.next_id = 0
+
+    def __len__(self):
+        return self.ids.size(0)
+
+    def _prepare(self, x):
+        x = torch.as_tensor(x, dtype=torch.float, device=self.device)
+        if x.dim() != 2 or x.size(1) != self.nz:
+            raise ValueError('expected latent codes with shape [N, %d], got %s' % (self.nz, list(x.size())))
+        if self.metric == 'cosine':
+            x = x / x.norm(dim=1, keepdim=True).clamp(min=1e-12)
+        return x
+
+    def _new_ids(self, n, ids):
+        if ids is None:
+            ids = torch.arange(self.next_id, self.next_id + n, device=self.device)
+        else:
+            ids = torch.as_tensor(ids, dtype=torch.long, device=self.device)
+            assert ids.size(0) == n, 'one id per latent code'
+        if n > 0:
+            self.next_id = max(self.next_id, int(ids.max()) + 1)
+        return ids
+
+    def add(self, vectors, ids=None):
+        """add latent codes to the index, the index can be added to at any
+        time
+        Args:
+            vectors: the latent codes with shape [N, nz]
+            ids: the ids returned by search, consecutive integers after the
+                largest id so far when None
+        Returns: Tensor
+            Tensor: the ids of the added codes
+        """
+        vectors = self._prepare(vectors)
+        ids = self._new_ids(vectors.size(0), ids)
+        self.vectors = torch.cat([self.vectors, vectors], dim=0)
+        self.ids = torch.cat([self.ids, ids], dim=0)
+        return ids
+
+    def search(self, queries, k, batch_size=1024, chunk_size=16384):
+        """find the k nearest latent codes of every query
+        Args:
+            queries: the query codes with shape [B, nz]
+            batch_size: the number of queries searched at once
+            chunk_size: the number of stored codes compared at once
+        Returns: Tensor1, Tensor2
+            Tensor1: the squared euclidean distances, between normalized
+                codes for the cosine metric, with shape [B, k]
+            Tensor2: the ids of the neighbours with shape [B, k], -1 when
+                the index holds fewer than k codes
+        """
+        queries = self._prepare(queries)
+        all_dist, all_ids = [], []
+        with torch.no_grad():
+            for i in range(0, queries.size(0), batch_size):
+                query = queries[i:i + batch_size]
+                dist = query.new_full((query.size(0), k), float('inf'))
+                ids = torch.full((query.size(0), k), -1, dtype=torch.long, device=self.device)
+                for j in range(0, len(self), chunk_size):
+                    chunk_dist = pairwise_sqdist(query, self.vectors[j:j + chunk_size])
+                    chunk_ids = self.ids[j:j + chunk_size].unsqueeze(0).expand_as(chunk_dist)
+                    dist, ids = merge_topk(dist, ids, chunk_dist, chunk_ids, k)
+                all_dist.append(dist)
+                all_ids.append(ids)
+
+        return torch.cat(all_dist, dim=0), torch.cat(all_ids, dim=0)
+
+    def memory_bytes(self):
+        """the memory taken by the stored codes and ids"""
+        return self.vectors.numel() * self.vectors.element_size() + self.ids.numel() * 8
+
+    def state_dict(self):
+        return {'type': 'exact', 'nz': self.nz, 'metric': self.metric, 'next_id': self.next_id,
+                'vectors': self.vectors.cpu(), 'ids': self.ids.cpu()}
+
+    def load_state_dict(self, state):
+        self.vectors = state['vectors'].to(self.device)
+        self.ids = state['ids'].to(self.device)
+        self.next_id = state['next_id']
+
+    def save(self, path):
+        torch.save(self.state_dict(), path)
+
+
+class IVFPQLatentIndex(LatentIndex):
+    """approximate nearest neighbour search with an inverted file over
+    k-means clusters whose residuals are product quantized. A query only
+    scans the codes of its nprobe closest clusters, and a code takes m
+    bytes instead of 4 * nz
+    Args:
+        nlist: the number of k-means clusters
+        m: the number of sub-quantizers, divides nz
+        nbits: every sub-quantizer has 2 ** nbits centroids, at most 8
+        nprobe: the default number of clusters scanned by a query
+    """
+    def __init__(self, nz, nlist=1024, m=8, nbits=8, nprobe=8, metric='l2', device='cpu'):
+        super(IVFPQLatentIndex, self).__init__(nz, metric, device)
+        if nz % m != 0:
+            raise ValueError('m = %d does not divide nz = %d' % (m, nz))
+        if nbits > 8:
+            raise ValueError('codes are stored as bytes, nbits <= 8')
+        self.nlist = nlist
+        self.m = m
+        self.nbits = nbits
+        self.nprobe = nprobe
+
+        # [nlist, nz]
+        self.centroids = None
+        # [m, 2 ** nbits, nz // m]
+        self.codebooks = None
+
+        self.list_codes = [torch.zeros(0, m, dtype=torch.uint8, device=self.device) for _ in range(nlist)]
+        self.list_ids = [torch.zeros(0, dtype=torch.long, device=self.device) for _ in range(nlist)]
+
+    def __len__(self):
+        return sum(ids.size(0) for ids in self.list_ids)
+
+    def is_trained(self):
+        return self.centroids is not None
+
+    def _assign(self, x, chunk_size=65536):
+        return torch.cat([pairwise_sqdist(x[i:i + chunk_size], self.centroids).argmin(dim=1)
+                          for i in range(0, x.size(0), chunk_size)])
+
+    def _encode(self, residual):
+        dsub = self.nz // self.m
+        codes = [pairwise_sqdist(residual[:, j * dsub:(j + 1) * dsub], self.codebooks[j]).argmin(dim=1)
+                 for j in range(self.m)]
+        return torch.stack(codes, dim=1).to(torch.uint8)
+
+    def train(self, vectors, niter=20, max_train_size=None, seed=783435):
+        """learn the clusters and the sub-quantizers on sample codes
+        Args:
+            max_train_size: train on a random subset of this size, 256
+                points per centroid by default
+        """
+        x = self._prepare(vectors)
+        ksub = 2 ** self.nbits
+        if max_train_size is None:
+            max_train_size = 256 * max(self.nlist, ksub)
+        if x.size(0) > max_train_size:
+            generator = torch.Generator().manual_seed(seed)
+            x = x[torch.randperm(x.size(0), generator=generator)[:max_train_size].to(self.device)]
+
+        with torch.no_grad():
+            self.centroids = kmeans(x, self.nlist, niter, seed)
+            residual = x - self.centroids[self._assign(x)]
+
+            dsub = self.nz // self.m
+            self.codebooks = torch.stack([kmeans(residual[:, j * dsub:(j + 1) * dsub], ksub, niter, seed + j)
+                                          for j in range(self.m)])
+
+    def add(self, vectors, ids=None):
+        if not self.is_trained():
+            raise RuntimeError('the index must be trained before adding codes')
+        vectors = self._prepare(vectors)
+        ids = self._new_ids(vectors.size(0), ids)
+
+        with torch.no_grad():
+            assign = self._assign(vectors)
+            codes = self._encode(vectors - self.centroids[assign])
+
+        for l in assign.unique().tolist():
+            mask = assign == l
+            self.list_codes[l] = torch.cat([self.list_codes[l], codes[mask]], dim=0)
+            self.list_ids[l] = torch.cat([self.list_ids[l], ids[mask]], dim=0)
+        return ids
+
+    def search(self, queries, k, nprobe=None, batch_size=1024):
+        """find approximately the k nearest latent codes of every query,
+        see LatentIndex.search. The distances are computed from the
+        quantized codes
+        Args:
+            nprobe: the number of clusters scanned per query, self.nprobe
+                when None
+        """
+        if not self.is_trained():
+            raise RuntimeError('the index must be trained before searching codes')
+        queries = self._prepare(queries)
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        dsub = self.nz // self.m
+        # [m, ksub, dsub]
+        codebooks = self.codebooks
+        sub_idx = torch.arange(self.m, device=self.device)
+
+        all_dist, all_ids = [], []
+        with torch.no_grad():
+            for i in range(0, queries.size(0), batch_size):
+                query = queries[i:i + batch_size]
+                dist = query.new_full((query.size(0), k), float('inf'))
+                ids = torch.full((query.size(0), k), -1, dtype=torch.long, device=self.device)
+
+                # [batch, nprobe]
+                probe = pairwise_sqdist(query, self.centroids).topk(nprobe, dim=1, largest=False)[1]
+                for l in probe.unique().tolist():
+                    codes = self.list_codes[l]
+                    if codes.size(0) == 0:
+                        continue
+                    sel = (probe == l).any(dim=1).nonzero().squeeze(1)
+
+                    # distance tables of the residuals, [sel, m, ksub]
+                    residual = (query[sel] - self.centroids[l]).view(-1, self.m, 1, dsub)
+                    tables = (residual - codebooks.unsqueeze(0)).pow(2).sum(dim=-1)
+
+                    # [sel, list_size]
+                    list_dist = tables[:, sub_idx, codes.long()].sum(dim=-1)
+                    list_ids = self.list_ids[l].unsqueeze(0).expand_as(list_dist)
+                    dist[sel], ids[sel] = merge_topk(dist[sel], ids[sel], list_dist, list_ids, k)
+                all_dist.append(dist)
+                all_ids.append(ids)
+
+        return torch.cat(all_dist, dim=0), torch.cat(all_ids, dim=0)
+
+    def memory_bytes(self):
+        """the memory taken by the inverted lists and, once trained, by the
+        centroids and codebooks"""
+        num_bytes = sum(codes.numel() + ids.numel() * 8 for codes, ids in zip(self.list_codes, self.list_ids))
+        if self.centroids is not None:
+            num_bytes += self.centroids.numel() * 4 + self.codebooks.numel() * 4
+        return num_bytes
+
+    def state_dict(self):
+        """the centroids and codebooks are None before training"""
+        sizes = torch.tensor([ids.size(0) for ids in self.list_ids])
+        trained = self.is_trained()
+        return {'type': 'ivfpq', 'nz': self.nz, 'metric': self.metric, 'next_id': self.next_id,
+                'nlist': self.nlist, 'm': self.m, 'nbits': self.nbits, 'nprobe': self.nprobe,
+                'centroids': self.centroids.cpu() if trained else None,
+                'codebooks': self.codebooks.cpu() if trained else None,
+                'codes': torch.cat(self.list_codes).cpu(), 'ids': torch.cat(self.list_ids).cpu(),
+                'list_sizes': sizes}
+
+    def load_state_dict(self, state):
+        self.centroids = self.codebooks = None
+        if state['centroids'] is not None:
+            self.centroids = state['centroids'].to(self.device)
+            self.codebooks = state['codebooks'].to(self.device)
+        sizes = state['list_sizes'].tolist()
+        self.list_codes = list(state['codes'].to(self.device).split(sizes))
+        self.list_ids = list(state['ids'].to(self.device).split(sizes))
+        self.next_id = state['next_id']
+
+
+def load_latent_index(path, device='cpu'):
+    """load an index saved with LatentIndex.save or IVFPQLatentIndex.save
+    """
+    state = torch.load(path)
+    if state['type'] == 'exact':
+        index = LatentIndex(state['nz'], state['metric'], device)
+    else:
+        index = IVFPQLatentIndex(state['nz'], state['nlist'], state['m'], state['nbits'],
+                                 state['nprobe'], state['metric'], device)
+    index.load_state_dict(state)
+    return index
@@ -0,0 +1,123 @@
+import os
+import shutil
+import hashlib
+
+import numpy as np
+import torch
+
+
+def checkpoint_hash(path, chunk_size=1 << 20):
+    """hash the content of a saved checkpoint file
+    Returns: String
+        String: the first 16 hex digits of the sha1 of the file
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()[:16]
+
+
+def data_fingerprint(data_batch):
+    """hash a list of batched data tensors, the hash depends on the
+    content, the shape and the order of the batches
+    Returns: String
+        String: the first 16 hex digits of the sha1 of the batches
+    """
+    sha = hashlib.sha1()
+    for batch_data in data_batch:
+        batch_np = batch_data.cpu().numpy()
+        sha.update(str(batch_np.shape).encode())
+        sha.update(batch_np.tobytes())
+
+    return sha.hexdigest()[:16]
+
+
+class PosteriorCache(object):
+    """On-disk cache of the encoder posterior parameters (mu, logvar)
+    of every example in a dataset. The cache entry is keyed by the
+    checkpoint hash and the dataset fingerprint, and the parameters are
+    stored as .npy files that can be memory-mapped. Rows follow the
+    order of the batches the cache was built from.
+    """
+    def __init__(self, cache_dir, ckpt_hash, data_hash):
+        super(PosteriorCache, self).__init__()
+        self.path = os.path.join(cache_dir, '%s_%s' % (ckpt_hash, data_hash))
+
+    @classmethod
+    def from_checkpoint(cls, cache_dir, ckpt_path, data_batch):
+        return cls(cache_dir, checkpoint_hash(ckpt_path), data_fingerprint(data_batch))
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, 'logvar.npy'))
+
+    def load(self, mmap_mode='r'):
+        """
+        Returns: ndarray1, ndarray2
+            ndarray1: the mean of latent z with shape [N, nz]
+            ndarray2: the logvar of latent z with shape [N, nz]
+        """
+        mu = np.load(os.path.join(self.path, 'mu.npy'), mmap_mode=mmap_mode)
+        logvar = np.load(os.path.join(self.path, 'logvar.npy'), mmap_mode=mmap_mode)
+
+        return mu, logvar
+
+    def build(self, model, data_batch):
+        """encode every batch and write the posterior parameters to disk,
+        the model is expected to be in eval mode
+        """
+        num_examples = sum(batch_data.size(0) for batch_data in data_batch)
+
+        # write into a temporary directory first so that an interrupted
+        # build never leaves a partial entry behind
+        tmp_path = self.path + '.tmp'
+        if not os.path.exists(tmp_path):
+            os.makedirs(tmp_path)
+
+        mu_mm = logvar_mm = None
+        offset = 0
+        with torch.no_grad():
+            for batch_data in data_batch:
+                mu, logvar = model.encode_stats(batch_data)[:2]
+                if mu_mm is None:
+                    shape = (num_examples, mu.size(1))
+                    mu_mm = np.lib.format.open_memmap(os.path.join(tmp_path, 'mu.npy'),
+                        mode='w+', dtype=np.float32, shape=shape)
+                    logvar_mm = np.lib.format.open_memmap(os.path.join(tmp_path, 'logvar.npy'),
+                        mode='w+', dtype=np.float32, shape=shape)
+
+                batch_size = mu.size(0)
+                mu_mm[offset:offset + batch_size] = mu.cpu().numpy()
+                logvar_mm[offset:offset + batch_size] = logvar.cpu().numpy()
+                offset += batch_size
+
+        mu_mm.flush()
+        logvar_mm.flush()
+        del mu_mm, logvar_mm
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(tmp_path, self.path)
+
+    def get(self, model, data_batch, mmap_mode='r'):
+        """load the cached posterior parameters, encode the data and fill
+        the cache on a miss
+        """
+        if not self.exists():
+            self.build(model, data_batch)
+
+        return self.load(mmap_mode)
+
+
+def iter_batch_stats(stats, data_batch, device):
+    """split cached posterior parameters back into per-batch tensors
+    that are aligned with data_batch
+    """
+    mu, logvar = stats
+    offset = 0
+    for batch_data in data_batch:
+        batch_size = batch_data.size(0)
+        yield torch.from_numpy(np.array(mu[offset:offset + batch_size])).to(device), \
+              torch.from_numpy(np.array(logvar[offset:offset + batch_size])).to(device)
+        offset += batch_size
@@ -0,0 +1,29 @@
+import io
+import copy
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic
+
+
+def quantize_vae(vae):
+    """a copy of the vae for CPU inference whose nn.LSTM and nn.Linear
+    layers in the encoder and decoder are dynamically quantized to int8,
+    the weights are stored as int8 and the activations are quantized on
+    the fly
+    Returns: VAE
+        VAE: the quantized copy in eval mode, on CPU
+    """
+    vae = copy.deepcopy(vae).cpu().eval()
+    vae.prior = torch.distributions.normal.Normal(vae.prior.loc.cpu(), vae.prior.scale.cpu())
+    vae.encoder = quantize_dynamic(vae.encoder, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+    vae.decoder = quantize_dynamic(vae.decoder, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+    return vae
+
+def model_size(model):
+    """the number of bytes of the serialized state dict of a model,
+    which also counts the packed weights of quantized layers
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
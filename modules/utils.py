@@ -1,3 +1,5 @@
+import math
+import numpy as np
 import torch
 
 def log_sum_exp(value, dim=None, keepdim=False):
@@ -34,4 +36,230 @@ def generate_grid(zmin, zmax, dz, device, ndim=2):
         return torch.cat((x1.unsqueeze(-1), x2.unsqueeze(-1)), dim=-1).to(device), k
 
     elif ndim == 1:
-        return torch.arange(zmin, zmax, dz).unsqueeze(1).to(device)
\ No newline at end of file
+        return torch.arange(zmin, zmax, dz).unsqueeze(1).to(device)
+
+def generate_grid_chunks(zmin, zmax, dz, device, ndim=2, chunk_size=10000):
+    """lazily generate an ndim-dimensional grid in chunks, the full grid
+    of k^ndim points is never built. Points are in the same order as
+    generate_grid, i.e. the last dimension changes fastest
+    Returns: Iterator
+        Iterator: yields Tensor, float
+            Tensor: grid points with shape (<=chunk_size, ndim),
+                where k=(zmax - zmin)/dz
+            float: the volume of the grid cell of each point
+    """
+    axis = torch.arange(zmin, zmax, dz, device=device)
+    k = axis.size(0)
+    total = k ** ndim
+    volume = dz ** ndim
+
+    for start in range(0, total, chunk_size):
+        idx = torch.arange(start, min(start + chunk_size, total), device=device)
+        coords = [axis[(idx // k ** (ndim - 1 - d)) % k] for d in range(ndim)]
+
+        yield torch.stack(coords, dim=-1), volume
+
+
+class DiagnosticSubset(object):
+    """select a bounded number of examples for the in-training
+    diagnostics (MI, AU) computed every log_niter iterations
+    Args:
+        data_batch: list of batches to select from, each batch is either a
+            data tensor or a tuple whose first element is the data tensor
+        budget: the number of examples per diagnostic call
+        mode: 'fixed' always uses the same subset of data_batch,
+            'rotate' moves on to the next subset at every call,
+            'train' uses the most recent training batches passed to add()
+    """
+    def __init__(self, data_batch, budget, mode='rotate'):
+        super(DiagnosticSubset, self).__init__()
+        if mode not in ('fixed', 'rotate', 'train'):
+            raise ValueError('unknown mode: %s' % mode)
+
+        self.data_batch = data_batch
+        self.budget = budget
+        self.mode = mode
+
+        self.order = np.random.permutation(len(data_batch))
+        self.pos = 0
+        self.recent = []
+
+    @staticmethod
+    def _batch_size(batch):
+        if isinstance(batch, (tuple, list)):
+            return batch[0].size(0)
+
+        return batch.size(0)
+
+    def add(self, batch):
+        """record a training batch, only used in 'train' mode
+        """
+        if self.mode != 'train':
+            return
+
+        self.recent.append(batch)
+        num_examples = sum(self._batch_size(e) for e in self.recent)
+        while num_examples - self._batch_size(self.recent[0]) >= self.budget:
+            num_examples -= self._batch_size(self.recent.pop(0))
+
+    def next(self):
+        """
+        Returns: List
+            List: the batches for the next diagnostic call, holding at
+                least budget examples when enough data is available. In
+                'train' mode the fixed subset is used until add() is called
+        """
+        if self.mode == 'train' and len(self.recent) > 0:
+            return list(self.recent)
+
+        pos = self.pos if self.mode == 'rotate' else 0
+        selected = []
+        num_examples = 0
+        while num_examples < self.budget and len(selected) < len(self.order):
+            batch = self.data_batch[self.order[pos]]
+            selected.append(batch)
+            num_examples += self._batch_size(batch)
+            pos = (pos + 1) % len(self.order)
+
+        if self.mode == 'rotate':
+            self.pos = pos
+
+        return selected
+
+
+class DualAveraging(object):
+    """adapt the log step size of MCMC chains toward a target acceptance
+    rate during burn-in with the dual averaging scheme of Hoffman and
+    Gelman (2014). The adaptation gain decays with the iteration count, so
+    the step size settles instead of drifting, and the averaged iterate is
+    used once burn-in ends
+    Args:
+        log_step: the initial log step size, Tensor
+        target_accept: the target acceptance rate
+        gamma, t0, kappa: the shrinkage, the stabilization offset and the
+            averaging decay of the scheme
+    """
+    def __init__(self, log_step, target_accept, gamma=0.05, t0=10, kappa=0.75):
+        super(DualAveraging, self).__init__()
+        self.target_accept = target_accept
+        self.gamma = gamma
+        self.t0 = t0
+        self.kappa = kappa
+
+        # the iterates are shrunk toward a step size 10 times the initial one
+        self.mu = log_step + math.log(10)
+        self.log_step = log_step
+        self.log_step_avg = torch.zeros_like(log_step)
+        self.h_avg = torch.zeros_like(log_step)
+        self.iter = 0
+
+    def update(self, accept_prob):
+        """
+        Args:
+            accept_prob: the acceptance probability of the last iteration,
+                with the shape of log_step
+        Returns: Tensor
+            Tensor: the log step size of the next iteration
+        """
+        self.iter += 1
+        weight = 1. / (self.iter + self.t0)
+        self.h_avg = (1 - weight) * self.h_avg + weight * (self.target_accept - accept_prob)
+        self.log_step = self.mu - math.sqrt(self.iter) / self.gamma * self.h_avg
+
+        eta = self.iter ** (-self.kappa)
+        self.log_step_avg = eta * self.log_step + (1 - eta) * self.log_step_avg
+
+        return self.log_step
+
+    def final(self):
+        """
+        Returns: Tensor
+            Tensor: the averaged log step size, used after burn-in
+        """
+        return self.log_step if self.iter == 0 else self.log_step_avg
+
+
+def effective_sample_size(samples):
+    """estimate the effective sample size of MCMC chains from the
+    chain-averaged autocorrelation, truncated at the first
+    non-positive lag
+    Args:
+        samples: Tensor
+            samples with shape (batch, nchains, nsamples, nz)
+    Returns: Tensor
+        Tensor: the effective sample size with shape (batch, nz)
+    """
+    batch_size, nchains, nsamples, nz = samples.size()
+
+    # (batch, nchains, nz, nsamples)
+    dev = (samples - samples.mean(dim=2, keepdim=True)).permute(0, 1, 3, 2)
+
+    # autocovariance through FFT with zero padding
+    nfft = 2 * nsamples
+    freq = torch.fft.rfft(dev, n=nfft, dim=-1)
+    acov = torch.fft.irfft(freq * freq.conj(), n=nfft, dim=-1)[..., :nsamples] / nsamples
+
+    # (batch, nz, nsamples)
+    acov = acov.mean(dim=1)
+    rho = acov / acov[..., :1].clamp(min=1e-12)
+
+    # sum the autocorrelation up to the first non-positive lag
+    mask = (rho[..., 1:] > 0).float().cumprod(dim=-1)
+    tau = 1 + 2 * (rho[..., 1:] * mask).sum(dim=-1)
+
+    return nchains * nsamples / tau
+
+
+def qmc_normal(batch_size, nsamples, nz, device):
+    """randomized quasi-Monte Carlo standard normal noise, a scrambled
+    Sobol sequence along the nsamples axis mapped through the inverse
+    normal CDF. Every example gets an independent uniform random shift
+    (modulo 1) of the same point set, so each row is unbiased and the
+    rows are independent. Powers of 2 for nsamples balance the sequence
+    best.
+    Returns: Tensor
+        Tensor: the noise with shape (batch, nsamples, nz)
+    """
+    seed = torch.randint(2 ** 31 - 1, (1,)).item()
+    engine = torch.quasirandom.SobolEngine(nz, scramble=True, seed=seed)
+
+    # (1, nsamples, nz)
+    u = engine.draw(nsamples).to(device).unsqueeze(0)
+
+    u = torch.fmod(u + torch.rand(batch_size, 1, nz, device=device), 1.0)
+
+    # keep the inverse CDF finite at float32 precision
+    u = u.clamp(1e-6, 1 - 1e-6)
+
+    return math.sqrt(2) * torch.erfinv(2 * u - 1)
+
+
+def filter_logits(logits, top_k=0, top_p=1.0):
+    """keep the top_k most likely entries and the smallest set of
+    entries whose probability mass reaches top_p in every row, the rest
+    of the logits are set to -inf
+    Args:
+        logits: Tensor
+            the logits with shape (batch, vocab_size)
+        top_k: no top-k filtering when 0
+        top_p: no nucleus filtering when 1.0
+    Returns: Tensor
+        Tensor: the filtered logits with shape (batch, vocab_size)
+    """
+    if top_k > 0 and top_k < logits.size(-1):
+        # mask by index rather than by the k-th value, so that exactly
+        # top_k entries survive when there are ties
+        index = logits.topk(top_k, dim=-1)[1]
+        keep = torch.zeros_like(logits, dtype=torch.bool).scatter(-1, index, True)
+        logits = logits.masked_fill(~keep, -float('inf'))
+
+    if top_p < 1.0:
+        sorted_logits, sorted_index = logits.sort(dim=-1, descending=True)
+        cum_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        # drop the entries once the mass before them reaches top_p,
+        # the most likely entry is always kept
+        remove = (cum_probs - sorted_logits.softmax(dim=-1)) >= top_p
+        remove = remove.scatter(-1, sorted_index, remove)
+        logits = logits.masked_fill(remove, -float('inf'))
+
+    return logits
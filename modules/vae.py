@@ -2,7 +2,7 @@ import math
 import torch
 import torch.nn as nn
 
-from .utils import log_sum_exp
+from .utils import log_sum_exp, qmc_normal, effective_sample_size, DualAveraging
 from .lm import LSTM_LM
 
 
@@ -67,6 +67,71 @@ class VAE(nn.Module):
 
         return reconstruct_err + kl_weight * KL + mu_l2, reconstruct_err, KL, mu_l2
 
+    def refine_posterior(self, x, mu, logvar, kl_weight, nsteps=5, lr=1.0,
+                         max_grad_norm=5.0, nsamples=1):
+        """refine the Gaussian posterior parameters of every example with
+        a few batched gradient steps on its negative ELBO, the decoder is
+        kept fixed
+        Args:
+            mu: the initial mean with shape [batch, nz]
+            logvar: the initial logvar with shape [batch, nz]
+            max_grad_norm: the gradient of every example is clipped to
+                this norm
+        Returns: Tensor1, Tensor2
+            Tensor1: the refined mean, shape [batch, nz]
+            Tensor2: the refined logvar, shape [batch, nz]
+        """
+
+        mu = mu.detach().clone()
+        logvar = logvar.detach().clone()
+        with torch.enable_grad():
+            for _ in range(nsteps):
+                mu.requires_grad_(True)
+                logvar.requires_grad_(True)
+
+                # [batch, nsamples, nz]
+                z = self.encoder.reparameterize(mu, logvar, nsamples)
+                KL = 0.5 * (mu.pow(2) + logvar.exp() - logvar - 1).sum(dim=1)
+
+                # examples are independent, so the gradient of the sum is
+                # the gradient of every example's own loss
+                loss = self.decoder.reconstruct_error(x, z).mean(dim=1) + kl_weight * KL
+                grad_mu, grad_logvar = torch.autograd.grad(loss.sum(), [mu, logvar])
+
+                grad_norm = (grad_mu.pow(2).sum(dim=1) + grad_logvar.pow(2).sum(dim=1)).sqrt()
+                scale = (max_grad_norm / (grad_norm + 1e-6)).clamp(max=1.0).unsqueeze(1)
+
+                mu = (mu - lr * scale * grad_mu).detach()
+                logvar = (logvar - lr * scale * grad_logvar).detach()
+
+        return mu, logvar
+
+    def loss_refine(self, x, kl_weight, nsteps=5, lr=1.0, nsamples=1):
+        """semi-amortized loss, the encoder output is refined by
+        refine_posterior, the decoder is trained on the ELBO of the
+        refined posterior and the encoder is trained to match it through
+        KL(q_refined || q_encoder)
+
+        Returns: Tensor1, Tensor2, Tensor3, Tensor4
+            Tensor1: total loss [batch]
+            Tensor2: reconstruction loss of the refined posterior [batch]
+            Tensor3: KL loss of the refined posterior [batch]
+            Tensor4: the encoder matching loss [batch]
+        """
+
+        mu, logvar = self.encoder(x)[:2]
+        mu_r, logvar_r = self.refine_posterior(x, mu, logvar, kl_weight,
+                                               nsteps=nsteps, lr=lr, nsamples=nsamples)
+
+        z = self.encoder.reparameterize(mu_r, logvar_r, nsamples)
+        reconstruct_err = self.decoder.reconstruct_error(x, z).mean(dim=1)
+        KL = 0.5 * (mu_r.pow(2) + logvar_r.exp() - logvar_r - 1).sum(dim=1)
+
+        match = 0.5 * (logvar - logvar_r + (logvar_r.exp() + (mu_r - mu).pow(2)) / logvar.exp()
+                       - 1).sum(dim=1)
+
+        return reconstruct_err + kl_weight * KL + match, reconstruct_err, KL, match
+
     def nll_iw(self, x, nsamples, ns=100):
         """compute the importance weighting estimate of the log-likelihood
         Args:
@@ -75,18 +140,32 @@ class VAE(nn.Module):
                 the data tensor and length list
             nsamples: Int
                 the number of samples required to estimate marginal data likelihood
+            ns: Int
+                the number of samples decoded at once. With encoder.qmc one
+                point set of nsamples is drawn and split into chunks of ns,
+                so a power of 2 for nsamples balances it whatever ns is
         Returns: Tensor1
             Tensor1: the estimate of log p(x), shape [batch]
         """
 
+        # [batch, nsamples, nz], one point set shared by all the chunks,
+        # a point set of ns per chunk is unbalanced unless ns is a power of 2
+        eps = None
+        if getattr(self.encoder, 'qmc', False) and nsamples > 1:
+            eps = qmc_normal(x.size(0), nsamples, self.nz, x.device)
+
         # compute iw every ns samples to address the memory issue
         # nsamples = 500, ns = 100
         # nsamples = 500, ns = 10
         tmp = []
-        for _ in range(int(nsamples / ns)):
-            # [batch, ns, nz]
+        for i in range(0, nsamples, ns):
+            chunk_ns = min(ns, nsamples - i)
+            # [batch, chunk_ns, nz]
             # param is the parameters required to evaluate q(z|x)
-            z, param = self.encoder.sample(x, ns)
+            if eps is None:
+                z, param = self.encoder.sample(x, chunk_ns)
+            else:
+                z, param = self.encoder.sample(x, chunk_ns, eps=eps[:, i:i + chunk_ns])
 
             # [batch, ns]
             log_comp_ll = self.eval_complete_ll(x, z)
@@ -98,6 +177,75 @@ class VAE(nn.Module):
 
         return -ll_iw
 
+    def nll_iw_adaptive(self, x, target_err, max_nsamples, ns=100, max_decode=100):
+        """compute the importance weighting estimate of the log-likelihood
+        with an adaptive number of samples. Chunks of ns samples are drawn
+        until the standard error of the log-mean-exp estimate of an example
+        drops below target_err or max_nsamples is reached, converged
+        examples leave the active batch.
+        Args:
+            x: the data tensor with shape (batch, *)
+            target_err: Float
+                the target standard error of log p(x) per example
+            max_nsamples: Int
+                the maximum number of samples per example
+            max_decode: Int
+                the maximum number of sequences decoded at once, the active
+                examples are split into sub-batches of max_decode // ns
+                examples, at least one. The default matches nll_iw on
+                batches of size 1
+        Returns: Tensor1, Tensor2, Tensor3
+            Tensor1: the estimate of -log p(x), shape [batch]
+            Tensor2: the standard error of the estimate, shape [batch]
+            Tensor3: the number of samples used, shape [batch]
+        """
+
+        batch_size = x.size(0)
+
+        # running log sum of the weights and of the squared weights
+        log_sum = x.new_full((batch_size,), -float('inf'), dtype=torch.float)
+        log_sum_sq = log_sum.clone()
+        num_samples = x.new_zeros(batch_size, dtype=torch.float)
+        std_err = x.new_full((batch_size,), float('inf'), dtype=torch.float)
+
+        # every active example has drawn the same number of samples
+        drawn = 0
+        active = torch.arange(batch_size, device=x.device)
+        while active.numel() > 0:
+            chunk_ns = min(ns, max_nsamples - drawn)
+            sub_batch_size = max(1, max_decode // chunk_ns)
+            for i in range(0, active.numel(), sub_batch_size):
+                sub = active[i:i + sub_batch_size]
+                x_sub = x[sub]
+
+                # [sub, chunk_ns, nz]
+                z, param = self.encoder.sample(x_sub, chunk_ns)
+
+                # [sub, chunk_ns]
+                log_w = self.eval_complete_ll(x_sub, z) - \
+                        self.eval_inference_dist(x_sub, z, param)
+
+                log_sum[sub] = log_sum_exp(torch.stack(
+                    [log_sum[sub], log_sum_exp(log_w, dim=1)], dim=1), dim=1)
+                log_sum_sq[sub] = log_sum_exp(torch.stack(
+                    [log_sum_sq[sub], log_sum_exp(2 * log_w, dim=1)], dim=1), dim=1)
+
+            drawn += chunk_ns
+            num_samples[active] = drawn
+
+            # delta method: se(log mean(w)) = std(w) / (sqrt(n) * mean(w)),
+            # where E[w^2] / E[w]^2 = exp(log_sum_sq - 2 * log_sum + log n)
+            n = num_samples[active]
+            ratio = (log_sum_sq[active] - 2 * log_sum[active] + n.log()).exp()
+            std_err[active] = ((ratio - 1).clamp(min=0) / (n - 1)).sqrt()
+
+            done = (std_err[active] < target_err) | (n >= max_nsamples)
+            active = active[~done]
+
+        ll_iw = log_sum - num_samples.log()
+
+        return -ll_iw, std_err, num_samples
+
     def KL(self, x):
         _, KL,_ = self.encode(x, 1)
 
@@ -108,9 +256,13 @@ class VAE(nn.Module):
         Args:
             zrange: tensor
                 different z points that will be evaluated, with
-                shape (k^2, nz), where k=(zmax - zmin)/space
+                shape (k^2, nz), where k=(zmax - zmin)/space.
+                Chunks from generate_grid_chunks are also accepted
         """
 
+        if not torch.is_tensor(zrange):
+            return torch.cat([self.prior.log_prob(chunk).sum(dim=-1) for chunk, _ in zrange])
+
         # (k^2)
         return self.prior.log_prob(zrange).sum(dim=-1)
 
@@ -137,34 +289,84 @@ class VAE(nn.Module):
 
         return self.decoder.log_probability(x, z)
 
-    def eval_log_model_posterior(self, x, grid_z):
+    def eval_complete_ll_chunked(self, x, z, max_points=None):
+        """compute log p(z,x) in chunks along the nsamples dimension
+        Args:
+            x: Tensor
+                input with shape [batch, seq_len]
+            z: Tensor
+                evaluation points with shape [batch, nsamples, nz]
+            max_points: Int
+                the memory budget, i.e. the maximum number of
+                (example, z) pairs evaluated at once. No chunking when None
+        Returns: Tensor1
+            Tensor1: log p(z,x) Tensor with shape [batch, nsamples]
+        """
+        batch_size = x.size(0) if torch.is_tensor(x) else x[0].size(0)
+
+        if max_points is None:
+            return self.eval_complete_ll(x, z.contiguous())
+
+        chunk_size = max(1, max_points // batch_size)
+        log_comp = [self.eval_complete_ll(x, z_chunk.contiguous())
+                    for z_chunk in z.split(chunk_size, dim=1)]
+
+        return torch.cat(log_comp, dim=1)
+
+    def eval_log_model_posterior(self, x, grid_z, max_points=None):
         """perform grid search to calculate the true posterior
          this function computes p(z|x)
         Args:
             grid_z: tensor
                 different z points that will be evaluated, with
-                shape (k^2, nz), where k=(zmax - zmin)/pace
+                shape (k^2, nz), where k=(zmax - zmin)/pace.
+                Chunks from generate_grid_chunks are also accepted
+            max_points: Int
+                the memory budget, see eval_complete_ll_chunked
 
         Returns: Tensor
             Tensor: the log posterior distribution log p(z|x) with
-                    shape [batch_size, K^2]
+                    shape [batch_size, K^2]. The result holds the whole
+                    grid and must fit in memory, chunks only bound the
+                    working set of the evaluation. calc_model_posterior_mean
+                    streams the mean over chunks without it
         """
-        try:
-            batch_size = x.size(0)
-        except:
-            batch_size = x[0].size(0)
+        batch_size = x.size(0) if torch.is_tensor(x) else x[0].size(0)
+
+        if not torch.is_tensor(grid_z):
+            log_comp = []
+            log_norm = None
+            for chunk, _ in grid_z:
+                chunk = chunk.unsqueeze(0).expand(batch_size, *chunk.size())
+                log_comp.append(self.eval_complete_ll_chunked(x, chunk, max_points))
+
+                # running log-sum-exp of the normalizer, (batch_size, 1)
+                chunk_norm = log_sum_exp(log_comp[-1], dim=1, keepdim=True)
+                log_norm = chunk_norm if log_norm is None else \
+                    log_sum_exp(torch.cat([log_norm, chunk_norm], dim=1), dim=1, keepdim=True)
+
+            # (batch_size, k^nz), normalized in place
+            return torch.cat(log_comp, dim=1).sub_(log_norm)
 
         # (batch_size, k^2, nz)
-        grid_z = grid_z.unsqueeze(0).expand(batch_size, *grid_z.size()).contiguous()
+        grid_z = grid_z.unsqueeze(0).expand(batch_size, *grid_z.size())
 
         # (batch_size, k^2)
-        log_comp = self.eval_complete_ll(x, grid_z)
+        log_comp = self.eval_complete_ll_chunked(x, grid_z, max_points)
 
         # normalize to posterior
         log_posterior = log_comp - log_sum_exp(log_comp, dim=1, keepdim=True)
 
         return log_posterior
 
+    def sample_from_prior(self, nsamples):
+        """sampling from prior distribution, all samples are drawn at
+        once on the device of the prior
+        Returns: Tensor
+            Tensor: samples from prior with shape (nsamples, nz)
+        """
+        return self.prior.sample((nsamples,))
+
     def sample_from_inference(self, x, nsamples=1):
         """perform sampling from inference net
         Returns: Tensor
@@ -212,25 +414,339 @@ class VAE(nn.Module):
 
         return torch.cat(samples, dim=1)
 
-    def calc_model_posterior_mean(self, x, grid_z):
+    def sample_from_posterior_multichain(self, x, nsamples, nchains=4, burn_in=100,
+                                         thin=1, mh_std=0.1, target_accept=0.234):
+        """perform MH sampling from model posterior with nchains chains
+        per example, all chains are evaluated in one batched decoder call.
+        During burn-in the proposal std of each example is adapted toward
+        the target acceptance rate with DualAveraging, it is fixed to the
+        averaged value afterwards.
+        Args:
+            x: [batch, *]
+            nsamples: the number of samples kept per chain
+            nchains: the number of chains per example
+            burn_in: the number of burn-in iterations
+            thin: keep one sample every thin iterations
+            mh_std: the initial std of the gaussian random walk proposal
+            target_accept: the target acceptance rate of the adaptation
+
+        Returns: Tensor, Dict
+            Tensor: samples from model posterior with
+                shape (batch_size, nchains * nsamples, nz)
+            Dict: statistics of the chains, 'accept_rate' [batch_size] and
+                'mh_std' [batch_size] are the post burn-in acceptance rate
+                and the adapted proposal std, 'ess' [batch_size, nz] is the
+                effective sample size, 'num_evals' is the number of
+                evaluated (example, z) pairs per example
+        """
+
+        # initialize the chains with samples from the inference net
+        # [batch_size, nchains, nz]
+        cur, _ = self.encoder.sample(x, nchains)
+        cur_ll = self.eval_complete_ll(x, cur)
+
+        batch_size, _, nz = cur.size()
+
+        # [batch_size, 1, 1]
+        log_std = cur.new_full((batch_size, 1, 1), math.log(mh_std))
+        adapt = DualAveraging(log_std, target_accept)
+
+        samples = cur.new_empty(batch_size, nchains, nsamples, nz)
+        num_accept = cur.new_zeros(batch_size)
+
+        total_iter = burn_in + nsamples * thin
+        for iter_ in range(total_iter):
+            next = cur + torch.randn_like(cur) * log_std.exp()
+
+            # [batch_size, nchains]
+            next_ll = self.eval_complete_ll(x, next)
+            ratio = next_ll - cur_ll
+
+            # [batch_size, nchains]
+            mask = cur_ll.new_empty(cur_ll.size()).uniform_().log() < ratio
+
+            cur = torch.where(mask.unsqueeze(2), next, cur)
+            cur_ll = torch.where(mask, next_ll, cur_ll)
+
+            accept_rate = mask.float().mean(dim=1)
+            if iter_ < burn_in:
+                # the expected acceptance is less noisy than the accept mask
+                accept_prob = ratio.clamp(max=0).exp().mean(dim=1)
+                log_std = adapt.update(accept_prob.view(-1, 1, 1))
+                if iter_ == burn_in - 1:
+                    log_std = adapt.final()
+            else:
+                num_accept += accept_rate
+                if (iter_ - burn_in) % thin == 0:
+                    samples[:, :, (iter_ - burn_in) // thin] = cur
+
+        stats = {'accept_rate': num_accept / (nsamples * thin),
+                 'mh_std': log_std.exp().view(-1),
+                 'ess': effective_sample_size(samples),
+                 'num_evals': nchains * (total_iter + 1)}
+
+        return samples.view(batch_size, nchains * nsamples, nz), stats
+
+    def eval_complete_ll_grad(self, x, z):
+        """compute log p(z,x) and its gradient w.r.t. z
+        Returns: Tensor1, Tensor2
+            Tensor1: log p(z,x) with shape [batch, nsamples]
+            Tensor2: the gradient with shape [batch, nsamples, nz]
+        """
+
+        # cudnn only supports the backward pass of rnn in training mode
+        with torch.enable_grad(), torch.backends.cudnn.flags(enabled=False):
+            z = z.detach().requires_grad_(True)
+            log_comp = self.eval_complete_ll(x, z)
+            grad, = torch.autograd.grad(log_comp.sum(), z)
+
+        return log_comp.detach(), grad
+
+    def sample_from_posterior_hmc(self, x, nsamples, nchains=4, burn_in=100,
+                                  thin=1, step_size=0.1, nleapfrog=5,
+                                  target_accept=0.65):
+        """perform Hamiltonian Monte Carlo sampling from model posterior,
+        using the same batched chain layout as
+        sample_from_posterior_multichain. nleapfrog=1 gives MALA.
+        During burn-in the step size of each example is adapted toward
+        the target acceptance rate with DualAveraging, it is fixed to the
+        averaged value afterwards.
+        Args:
+            x: [batch, *]
+            nsamples: the number of samples kept per chain
+            nchains: the number of chains per example
+            burn_in: the number of burn-in iterations
+            thin: keep one sample every thin iterations
+            step_size: the initial leapfrog step size
+            nleapfrog: the number of leapfrog steps per iteration
+            target_accept: the target acceptance rate of the adaptation
+
+        Returns: Tensor, Dict
+            Tensor: samples from model posterior with
+                shape (batch_size, nchains * nsamples, nz)
+            Dict: statistics of the chains, see
+                sample_from_posterior_multichain, 'step_size' replaces 'mh_std'
+        """
+
+        # [batch_size, nchains, nz]
+        cur, _ = self.encoder.sample(x, nchains)
+        cur_ll, cur_grad = self.eval_complete_ll_grad(x, cur)
+
+        batch_size, _, nz = cur.size()
+
+        # [batch_size, 1, 1]
+        log_eps = cur.new_full((batch_size, 1, 1), math.log(step_size))
+        adapt = DualAveraging(log_eps, target_accept)
+
+        samples = cur.new_empty(batch_size, nchains, nsamples, nz)
+        num_accept = cur.new_zeros(batch_size)
+
+        total_iter = burn_in + nsamples * thin
+        for iter_ in range(total_iter):
+            eps = log_eps.exp()
+            momentum = torch.randn_like(cur)
+
+            # leapfrog integration
+            next, next_grad = cur, cur_grad
+            next_momentum = momentum + 0.5 * eps * next_grad
+            for step in range(nleapfrog):
+                next = next + eps * next_momentum
+                next_ll, next_grad = self.eval_complete_ll_grad(x, next)
+                if step < nleapfrog - 1:
+                    next_momentum = next_momentum + eps * next_grad
+            next_momentum = next_momentum + 0.5 * eps * next_grad
+
+            # [batch_size, nchains]
+            ratio = next_ll - cur_ll - 0.5 * (next_momentum ** 2).sum(-1) + \
+                    0.5 * (momentum ** 2).sum(-1)
+
+            # a diverged trajectory is rejected
+            ratio = torch.where(torch.isnan(ratio), ratio.new_tensor(-float('inf')), ratio)
+            mask = cur_ll.new_empty(cur_ll.size()).uniform_().log() < ratio
+
+            mask_ = mask.unsqueeze(2)
+            cur = torch.where(mask_, next, cur)
+            cur_grad = torch.where(mask_, next_grad, cur_grad)
+            cur_ll = torch.where(mask, next_ll, cur_ll)
+
+            accept_rate = mask.float().mean(dim=1)
+            if iter_ < burn_in:
+                accept_prob = ratio.clamp(max=0).exp().mean(dim=1)
+                log_eps = adapt.update(accept_prob.view(-1, 1, 1))
+                if iter_ == burn_in - 1:
+                    log_eps = adapt.final()
+            else:
+                num_accept += accept_rate
+                if (iter_ - burn_in) % thin == 0:
+                    samples[:, :, (iter_ - burn_in) // thin] = cur
+
+        stats = {'accept_rate': num_accept / (nsamples * thin),
+                 'step_size': log_eps.exp().view(-1),
+                 'ess': effective_sample_size(samples),
+                 'num_evals': nchains * (total_iter * nleapfrog + 1)}
+
+        return samples.view(batch_size, nchains * nsamples, nz), stats
+
+    def calc_model_posterior_mean(self, x, grid_z, max_points=None):
         """compute the mean value of model posterior, i.e. E_{z ~ p(z|x)}[z]
         Args:
             grid_z: different z points that will be evaluated, with
-                    shape (k^2, nz), where k=(zmax - zmin)/pace
+                    shape (k^2, nz), where k=(zmax - zmin)/pace.
+                    Chunks from generate_grid_chunks are also accepted,
+                    the mean is then accumulated chunk by chunk
             x: [batch, *]
+            max_points: the memory budget, see eval_complete_ll_chunked
 
         Returns: Tensor1
             Tensor1: the mean value tensor with shape [batch, nz]
 
         """
 
+        if not torch.is_tensor(grid_z):
+            return self._calc_model_posterior_mean_chunks(x, grid_z, max_points)
+
         # [batch, K^2]
-        log_posterior = self.eval_log_model_posterior(x, grid_z)
+        log_posterior = self.eval_log_model_posterior(x, grid_z, max_points)
         posterior = log_posterior.exp()
 
         # [batch, nz]
         return torch.mul(posterior.unsqueeze(2), grid_z.unsqueeze(0)).sum(1)
 
+    def _calc_model_posterior_mean_chunks(self, x, grid_chunks, max_points=None):
+        """streaming version of calc_model_posterior_mean over grid chunks,
+        only running sums with shape [batch, nz] are kept
+        """
+        batch_size = x.size(0) if torch.is_tensor(x) else x[0].size(0)
+
+        log_max = sum_w = sum_wz = None
+        for chunk, volume in grid_chunks:
+            chunk_expd = chunk.unsqueeze(0).expand(batch_size, *chunk.size())
+
+            # [batch, chunk_size], the cell volume turns the density into mass
+            log_w = self.eval_complete_ll_chunked(x, chunk_expd, max_points) + math.log(volume)
+
+            chunk_max = log_w.max(dim=1, keepdim=True)[0]
+            if log_max is None:
+                log_max = chunk_max
+                sum_w = log_w.new_zeros(chunk_max.size())
+                sum_wz = chunk.new_zeros(batch_size, chunk.size(1))
+            else:
+                new_max = torch.max(log_max, chunk_max)
+                scale = (log_max - new_max).exp()
+                sum_w, sum_wz = sum_w * scale, sum_wz * scale
+                log_max = new_max
+
+            w = (log_w - log_max).exp()
+            sum_w = sum_w + w.sum(dim=1, keepdim=True)
+            sum_wz = sum_wz + torch.matmul(w, chunk)
+
+        # [batch, nz]
+        return sum_wz / sum_w
+
+    def calc_model_posterior_mean_refine(self, x, grid_z, dz, nfine=20,
+                                         mass=0.999, max_points=None):
+        """compute the mean value of model posterior with a coarse-to-fine
+        grid search. The posterior is first evaluated on the coarse grid_z,
+        then a fine grid of nfine points per dimension is placed on the
+        bounding box of the coarse points that hold the given posterior
+        mass of each example
+        Args:
+            grid_z: the coarse grid with shape (k^nz, nz) and spacing dz
+            x: [batch, *]
+            nfine: the number of fine grid points per dimension
+            mass: the posterior mass covered by the refined region
+            max_points: the memory budget, see eval_complete_ll_chunked
+
+        Returns: Tensor1
+            Tensor1: the mean value tensor with shape [batch, nz]
+
+        """
+
+        # [batch, K]
+        posterior = self.eval_log_model_posterior(x, grid_z, max_points).exp()
+
+        # select the most probable coarse points until they hold the mass
+        sorted_prob, sorted_idx = posterior.sort(dim=1, descending=True)
+        sorted_mask = (sorted_prob.cumsum(dim=1) - sorted_prob) < mass
+        mask = sorted_mask.new_zeros(sorted_mask.size()).scatter_(1, sorted_idx, sorted_mask)
+
+        # [batch, K, nz]
+        mask = mask.unsqueeze(2)
+        grid_z_expd = grid_z.unsqueeze(0)
+
+        # the bounding box of the selected points, extended by one coarse cell
+        # [batch, 1, nz]
+        lower = torch.where(mask, grid_z_expd, grid_z.new_tensor(float('inf'))) \
+                     .min(dim=1, keepdim=True)[0] - dz
+        upper = torch.where(mask, grid_z_expd, grid_z.new_tensor(-float('inf'))) \
+                     .max(dim=1, keepdim=True)[0] + dz
+
+        # cell centers of the unit hypercube, [nfine^nz, nz]
+        nz = grid_z.size(1)
+        unit = (torch.arange(nfine, device=grid_z.device, dtype=grid_z.dtype) + 0.5) / nfine
+        unit = torch.stack(torch.meshgrid(*([unit] * nz), indexing='ij'), dim=-1).view(-1, nz)
+
+        # [batch, nfine^nz, nz], every example has its own fine grid with
+        # uniform cells, so the cell volume cancels in the normalization
+        fine_z = lower + unit.unsqueeze(0) * (upper - lower)
+
+        log_comp = self.eval_complete_ll_chunked(x, fine_z, max_points)
+        posterior = (log_comp - log_sum_exp(log_comp, dim=1, keepdim=True)).exp()
+
+        # [batch, nz]
+        return torch.mul(posterior.unsqueeze(2), fine_z).sum(1)
+
+    def calc_model_posterior_mean_is(self, x, nsamples, ns=100):
+        """compute the mean and variance of model posterior with self-normalized
+        importance sampling, using q(z|x) as the proposal. The cost is linear
+        in nsamples for any nz.
+        Args:
+            x: [batch, *]
+            nsamples: the number of importance samples per example
+            ns: the number of samples drawn at once
+
+        Returns: Tensor1, Tensor2, Tensor3
+            Tensor1: the mean value tensor with shape [batch, nz]
+            Tensor2: the variance tensor with shape [batch, nz]
+            Tensor3: the effective sample size of the importance
+                weights with shape [batch]
+        """
+
+        # running sums of w, w * z, w * z^2 and w^2, with the weights
+        # scaled by exp(-log_max) for numerical stability
+        log_max = sum_w = sum_wz = sum_wz2 = sum_w2 = None
+        for drawn in range(0, nsamples, ns):
+            # [batch, ns, nz], the last chunk draws the remaining samples
+            z, param = self.encoder.sample(x, min(ns, nsamples - drawn))
+
+            # [batch, ns]
+            log_w = self.eval_complete_ll(x, z) - self.eval_inference_dist(x, z, param)
+
+            # [batch, 1]
+            chunk_max = log_w.max(dim=1, keepdim=True)[0]
+            if log_max is None:
+                log_max = chunk_max
+                sum_w = sum_w2 = log_w.new_zeros(chunk_max.size())
+                sum_wz = sum_wz2 = z.new_zeros(z.size(0), z.size(2))
+            else:
+                new_max = torch.max(log_max, chunk_max)
+                scale = (log_max - new_max).exp()
+                sum_w, sum_wz, sum_wz2 = sum_w * scale, sum_wz * scale, sum_wz2 * scale
+                sum_w2 = sum_w2 * scale ** 2
+                log_max = new_max
+
+            w = (log_w - log_max).exp()
+            sum_w = sum_w + w.sum(dim=1, keepdim=True)
+            sum_w2 = sum_w2 + (w ** 2).sum(dim=1, keepdim=True)
+            sum_wz = sum_wz + (w.unsqueeze(2) * z).sum(dim=1)
+            sum_wz2 = sum_wz2 + (w.unsqueeze(2) * z ** 2).sum(dim=1)
+
+        mean = sum_wz / sum_w
+        var = (sum_wz2 / sum_w - mean ** 2).clamp(min=0)
+        ess = (sum_w ** 2 / sum_w2).squeeze(1)
+
+        return mean, var, ess
+
     def calc_infer_mean(self, x):
         """
         Returns: Tensor1
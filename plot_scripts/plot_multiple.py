@@ -3,14 +3,20 @@ import argparse
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
-import pickle
+
+from trajectory_log import load_trajectory_log
 
 plt.rcParams.update({'font.size': 20})
 plt.tight_layout()
 
-def load_data(fname):
-    data = pickle.load(open(fname, 'rb'))
-    return data['posterior'], data['inference']
+def load_data(fname, iter_):
+    data = load_trajectory_log(fname)
+    index = np.nonzero(data['iter'] == iter_)[0]
+    if len(index) == 0:
+        raise ValueError('iteration %d is not logged in %s, logged iterations: %s' % \
+                         (iter_, fname, data['iter'].tolist()))
+    record = data[index[-1]]
+    return record['posterior'], record['inference']
 
 def plot_multiple(x, y, scale=None, fname='', xmin=-3.0, xmax=3.0, ymin=-3.0, ymax=3.0, 
     dx=0.5, xlabel="mean of true model posterior", ylabel="mean of approximate posterior"):
@@ -83,8 +89,8 @@ if __name__ == '__main__':
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
-    data_path = "plot_data/multiple/aggr%d_iter%d_multiple.pickle" % (args.aggressive, args.iter)
+    data_path = "plot_data/multiple/aggr%d_multiple.trj" % args.aggressive
     save_path = os.path.join(save_dir, "aggr%d_iter%d_multiple.pdf" % (args.aggressive, args.iter))
-    data_model_p, data_infer_p = load_data(data_path)
+    data_model_p, data_infer_p = load_data(data_path, args.iter)
     plot_multiple(x=data_model_p, y=data_infer_p, scale=3.0, dx=1.0, fname=save_path)
 
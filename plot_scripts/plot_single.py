@@ -3,7 +3,8 @@ import argparse
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
-import pickle
+
+from trajectory_log import load_trajectory_log
 
 plt.rcParams.update({'font.size': 20})
 plt.tight_layout()
@@ -83,11 +84,12 @@ if __name__ == '__main__':
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
 
-    data_path = "plot_data/single/aggr%d_single.pickle" % args.aggressive
+    data_path = "plot_data/single/aggr%d_single.trj" % args.aggressive
     save_path = os.path.join(save_dir, "aggr%d_id%d_single.pdf" % (args.aggressive, args.id))
-    data = pickle.load(open(data_path, 'rb'))
+    data = load_trajectory_log(data_path)
 
-    plot_x = data["posterior"][args.id][11:20]
-    plot_y = data['inference'][args.id][11:20]
+    # records are in update order, [time, num_points]
+    plot_x = data["posterior"][11:20, args.id]
+    plot_y = data['inference'][11:20, args.id]
 
     plot_line(plot_x, plot_y, scale=3.0, fname=save_path)
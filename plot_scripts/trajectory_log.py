@@ -0,0 +1,106 @@
+"""
+Append-only log of the posterior mean trajectories tracked by toy.py.
+
+The file starts with a small header (magic, header length, json
+description of the record fields), followed by fixed-width records,
+one per logged iteration. Each record holds the iteration number, the
+scalar fields and one float32 value per example for every per-example
+field, so the whole file can be memory-mapped as a numpy structured
+array.
+"""
+
+import os
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b'TRJLOG01'
+
+
+def record_dtype(num_examples, example_fields, scalar_fields=()):
+    fields = [('iter', '<i8')]
+    fields += [(name, '<f4') for name in scalar_fields]
+    fields += [(name, '<f4', (num_examples,)) for name in example_fields]
+
+    return np.dtype(fields)
+
+
+class TrajectoryLog(object):
+    """Writer of the trajectory log, records are appended and flushed
+    one at a time so the file can be read while training runs
+    Args:
+        path: the log file
+        num_examples: the number of tracked examples
+        example_fields: names of the fields with one value per example
+        scalar_fields: names of the fields with one value per record
+        append: continue an existing log with the same fields instead
+            of starting a new one
+    """
+    def __init__(self, path, num_examples, example_fields, scalar_fields=(), append=False):
+        super(TrajectoryLog, self).__init__()
+        self.header = {'num_examples': num_examples,
+                       'example_fields': list(example_fields),
+                       'scalar_fields': list(scalar_fields)}
+        self.dtype = record_dtype(num_examples, example_fields, scalar_fields)
+
+        if append and os.path.exists(path) and os.path.getsize(path) > 0:
+            header, _ = read_header(path)
+            if header != self.header:
+                raise ValueError('%s was written with different fields: %s' % (path, header))
+            self.fout = open(path, 'ab')
+        else:
+            self.fout = open(path, 'wb')
+            header_bytes = json.dumps(self.header).encode()
+            self.fout.write(MAGIC)
+            self.fout.write(struct.pack('<I', len(header_bytes)))
+            self.fout.write(header_bytes)
+            self.fout.flush()
+
+    def append(self, iter_, **values):
+        """append one record, values are numpy arrays or floats keyed
+        by field name
+        """
+        record = np.zeros(1, dtype=self.dtype)
+        record['iter'] = iter_
+        for name in self.header['scalar_fields'] + self.header['example_fields']:
+            record[name] = values[name]
+
+        self.fout.write(record.tobytes())
+        self.fout.flush()
+
+    def close(self):
+        self.fout.close()
+
+
+def read_header(path):
+    """
+    Returns: Dict, Int
+        Dict: the header description
+        Int: the byte offset of the first record
+    """
+    with open(path, 'rb') as fin:
+        magic = fin.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError('%s is not a trajectory log' % path)
+        header_len, = struct.unpack('<I', fin.read(4))
+        header = json.loads(fin.read(header_len).decode())
+
+    return header, len(MAGIC) + 4 + header_len
+
+
+def load_trajectory_log(path):
+    """memory-map the records of a trajectory log, a partially written
+    last record is ignored
+    Returns: ndarray
+        ndarray: structured array with one element per record, e.g.
+            log['posterior'] has shape (num_records, num_examples)
+    """
+    header, offset = read_header(path)
+    dtype = record_dtype(header['num_examples'], header['example_fields'],
+                         header['scalar_fields'])
+    num_records = (os.path.getsize(path) - offset) // dtype.itemsize
+    if num_records == 0:
+        return np.zeros(0, dtype=dtype)
+
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(num_records,))
@@ -0,0 +1,196 @@
+import sys
+import math
+import time
+import importlib
+import argparse
+
+from collections import Counter
+
+import numpy as np
+
+import torch
+
+from data import MonoTextData
+from modules import quantize_vae
+
+from text import init_model
+
+def init_config():
+    parser = argparse.ArgumentParser(description='reconstruct a text corpus with a trained VAE')
+
+    parser.add_argument('--dataset', type=str, required=True, help='dataset to use')
+    parser.add_argument('--load_path', type=str, required=True, help='checkpoint to load')
+    parser.add_argument('--split', choices=['train', 'val', 'test'], default='test',
+                         help='split of the dataset to reconstruct')
+    parser.add_argument('--data_file', type=str, default='',
+                         help='corpus to reconstruct instead of the split, in the format of the dataset')
+    parser.add_argument('--output', type=str, default='reconstructions.txt',
+                         help='one reconstruction per line, in corpus order')
+
+    parser.add_argument('--chunk_size', type=int, default=10000,
+                         help='number of sentences reconstructed and written at a time')
+    parser.add_argument('--encode_batch_size', type=int, default=1000, help='number of sentences encoded at once')
+    parser.add_argument('--decode_batch_size', type=int, default=500, help='number of sentences decoded at once')
+    parser.add_argument('--sample_z', action='store_true', default=False,
+                         help='decode a sample of the posterior instead of its mean')
+
+    # decoding strategy
+    parser.add_argument('--decode', choices=['greedy', 'beam'], default='greedy',
+                         help='greedy: most likely word, beam: beam search')
+    parser.add_argument('--max_length', type=int, default=100, help='maximum number of words')
+    parser.add_argument('--beam_size', type=int, default=5, help='number of beams of beam search')
+    parser.add_argument('--length_penalty', type=float, default=1.0,
+                         help='length normalization exponent of beam search')
+    parser.add_argument('--quantize', action='store_true', default=False,
+                         help='run on CPU with the LSTM and linear layers dynamically quantized to int8')
+
+    parser.add_argument('--seed', type=int, default=783435, metavar='S', help='random seed')
+
+    args = parser.parse_args()
+    args.cuda = torch.cuda.is_available() and not args.quantize
+
+    # load config file into args
+    config_file = "config.config_%s" % args.dataset
+    params = importlib.import_module(config_file).params
+    args = argparse.Namespace(**vars(args), **params)
+
+    if 'label' in params:
+        args.label = params['label']
+    else:
+        args.label = False
+
+    if args.data_file == '':
+        args.data_file = vars(args)['%s_data' % args.split]
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    return args
+
+class BleuScorer(object):
+    """corpus-level BLEU with one reference per sentence, the n-gram
+    statistics are accumulated so that sentences can be added in a stream
+    """
+    def __init__(self, max_n=4):
+        super(BleuScorer, self).__init__()
+        self.max_n = max_n
+        self.matches = [0] * max_n
+        self.totals = [0] * max_n
+        self.ref_len = 0
+        self.hyp_len = 0
+        self.num_exact = 0
+        self.num_sents = 0
+
+    def add(self, reference, hypothesis):
+        """
+        Args:
+            reference, hypothesis: lists of words
+        """
+        for n in range(1, self.max_n + 1):
+            ref_ngrams = Counter(tuple(reference[i:i + n]) for i in range(len(reference) - n + 1))
+            hyp_ngrams = Counter(tuple(hypothesis[i:i + n]) for i in range(len(hypothesis) - n + 1))
+            # clipped counts
+            self.matches[n - 1] += sum(min(count, ref_ngrams[ngram]) for ngram, count in hyp_ngrams.items())
+            self.totals[n - 1] += max(len(hypothesis) - n + 1, 0)
+
+        self.ref_len += len(reference)
+        self.hyp_len += len(hypothesis)
+        self.num_exact += reference == hypothesis
+        self.num_sents += 1
+
+    def score(self):
+        """
+        Returns: Float
+            Float: BLEU in [0, 100], with the brevity penalty
+        """
+        if min(self.matches) == 0:
+            return 0.
+        log_precision = sum(math.log(m / t) for m, t in zip(self.matches, self.totals)) / self.max_n
+        brevity = min(0., 1. - self.ref_len / self.hyp_len)
+        return 100. * math.exp(log_precision + brevity)
+
+    def exact_match(self):
+        return self.num_exact / max(self.num_sents, 1)
+
+def reconstruct_chunk(vae, data, indices, args):
+    """encode the sentences of indices in batches of equal length and
+    decode them back in batches
+    Returns: List
+        List: the decoded sentences as word id lists, in the order of
+            indices
+    """
+    vocab = data.vocab
+    start_id, end_id, pad_id = vocab['<s>'], vocab['</s>'], vocab['<pad>']
+
+    # (chunk_size, nz), in the order of indices
+    z = torch.zeros(len(indices), args.nz, device=args.device)
+    position = {id_: i for i, id_ in enumerate(indices)}
+    for idx, batch_data in data.iter_data_batch(args.encode_batch_size, args.device,
+                                                batch_first=True, indices=indices):
+        mu, logvar = vae.encode_stats(batch_data)[:2]
+        z_batch = vae.encoder.reparameterize(mu, logvar, 1).squeeze(1) if args.sample_z else mu
+        z[torch.tensor([position[id_] for id_ in idx], device=args.device)] = z_batch
+
+    decoded = []
+    for i in range(0, len(indices), args.decode_batch_size):
+        z_batch = z[i:i + args.decode_batch_size]
+        if args.decode == 'beam':
+            sents, lengths, _ = vae.decoder.beam_search_decode(z_batch, start_id, end_id, pad_id,
+                beam_size=args.beam_size, max_length=args.max_length,
+                length_penalty=args.length_penalty)
+        else:
+            sents, lengths = vae.decoder.sample_text_batch(z_batch, start_id, end_id, pad_id,
+                max_length=args.max_length, greedy=True)
+        sents = sents.tolist()
+        decoded.extend(sent[:length] for sent, length in zip(sents, lengths.tolist()))
+
+    return decoded
+
+def main(args):
+    print(args)
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+    args.device = device
+
+    train_data = MonoTextData(args.train_data, label=args.label)
+    vocab = train_data.vocab
+    if args.data_file == args.train_data:
+        data = train_data
+    else:
+        del train_data
+        data = MonoTextData(args.data_file, label=args.label, vocab=vocab)
+    print('%d sentences read from %s, dropped sentences: %d' % (len(data), args.data_file, data.dropped))
+
+    vae = init_model(args, vocab)
+    vae.load_state_dict(torch.load(args.load_path, map_location=device))
+    vae.eval()
+    if args.quantize:
+        vae = quantize_vae(vae)
+
+    bleu = BleuScorer()
+    start = time.time()
+    with open(args.output, 'w') as fout, torch.no_grad():
+        for offset in range(0, len(data), args.chunk_size):
+            indices = np.arange(offset, min(offset + args.chunk_size, len(data)))
+            decoded = reconstruct_chunk(vae, data, indices, args)
+
+            for id_, sent in zip(indices, decoded):
+                hypothesis = [vocab.id2word(wid) for wid in sent]
+                reference = [vocab.id2word(wid) for wid in data.data[id_]]
+                bleu.add(reference, hypothesis)
+                fout.write(' '.join(hypothesis) + '\n')
+
+            done = indices[-1] + 1
+            print('%d/%d sentences, %.1f sentences/s, bleu: %.2f' % \
+                  (done, len(data), done / (time.time() - start), bleu.score()))
+            sys.stdout.flush()
+
+    elapsed = time.time() - start
+    print('%d sentences reconstructed to %s, time elapsed %.2fs, %.1f sentences/s' % \
+          (len(data), args.output, elapsed, len(data) / elapsed))
+    print('bleu: %.2f, exact match: %.2f%%, length ratio: %.3f' % \
+          (bleu.score(), 100. * bleu.exact_match(), bleu.hyp_len / max(bleu.ref_len, 1)))
+
+if __name__ == '__main__':
+    args = init_config()
+    main(args)
@@ -0,0 +1,129 @@
+import sys
+import time
+import importlib
+import argparse
+
+import numpy as np
+
+import torch
+
+from data import MonoTextData
+from modules import quantize_vae
+
+from text import init_model
+
+def init_config():
+    parser = argparse.ArgumentParser(description='sample sentences from a trained text VAE')
+
+    parser.add_argument('--dataset', type=str, required=True, help='dataset to use')
+    parser.add_argument('--load_path', type=str, required=True, help='checkpoint to load')
+    parser.add_argument('--output', type=str, default='samples.txt', help='one sentence per line')
+
+    parser.add_argument('--num_samples', type=int, default=100000,
+                         help='number of sentences sampled from the prior')
+    parser.add_argument('--z_file', type=str, default='',
+                         help='.npy file of latent codes with shape [N, nz] to decode instead of prior samples')
+    parser.add_argument('--decode_batch_size', type=int, default=500, help='number of sentences decoded at once')
+    parser.add_argument('--max_length', type=int, default=100, help='maximum number of words')
+
+    # decoding strategy
+    parser.add_argument('--decode', choices=['sample', 'greedy', 'beam'], default='sample',
+                         help='sample: temperature/top-k/top-p sampling, greedy: most likely word, \
+                         beam: beam search')
+    parser.add_argument('--temperature', type=float, default=1.0, help='softmax temperature of sampling')
+    parser.add_argument('--top_k', type=int, default=0, help='sample from the top k words, disabled when 0')
+    parser.add_argument('--top_p', type=float, default=1.0,
+                         help='sample from the smallest set of words with this much probability, disabled when 1.0')
+    parser.add_argument('--beam_size', type=int, default=5, help='number of beams of beam search')
+    parser.add_argument('--length_penalty', type=float, default=1.0,
+                         help='length normalization exponent of beam search')
+
+    parser.add_argument('--quantize', action='store_true', default=False,
+                         help='run on CPU with the LSTM and linear layers dynamically quantized to int8')
+
+    parser.add_argument('--seed', type=int, default=783435, metavar='S', help='random seed')
+
+    args = parser.parse_args()
+    args.cuda = torch.cuda.is_available() and not args.quantize
+
+    # load config file into args
+    config_file = "config.config_%s" % args.dataset
+    params = importlib.import_module(config_file).params
+    args = argparse.Namespace(**vars(args), **params)
+
+    if 'label' in params:
+        args.label = params['label']
+    else:
+        args.label = False
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    return args
+
+def main(args):
+    print(args)
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+    args.device = device
+
+    train_data = MonoTextData(args.train_data, label=args.label)
+    vocab = train_data.vocab
+    del train_data
+
+    vae = init_model(args, vocab)
+    vae.load_state_dict(torch.load(args.load_path, map_location=device))
+    vae.eval()
+    if args.quantize:
+        vae = quantize_vae(vae)
+
+    if args.z_file != '':
+        z_all = np.load(args.z_file, mmap_mode='r')
+        num_samples = z_all.shape[0]
+    else:
+        z_all = None
+        num_samples = args.num_samples
+
+    start_id, end_id, pad_id = vocab['<s>'], vocab['</s>'], vocab['<pad>']
+
+    if z_all is None:
+        # the codes are drawn at once, so that they do not depend on
+        # decode_batch_size
+        z_all = vae.sample_from_prior(num_samples).cpu().numpy()
+
+    start = time.time()
+    num_words = 0
+    with open(args.output, 'w') as fout, torch.no_grad():
+        for i, offset in enumerate(range(0, num_samples, args.decode_batch_size)):
+            batch_size = min(args.decode_batch_size, num_samples - offset)
+            z = torch.from_numpy(np.array(z_all[offset:offset + batch_size])).float().to(device)
+
+            if args.decode == 'beam':
+                sents, lengths, _ = vae.decoder.beam_search_decode(z, start_id, end_id, pad_id,
+                    beam_size=args.beam_size, max_length=args.max_length,
+                    length_penalty=args.length_penalty)
+            else:
+                # every sentence is seeded with its index, so that a job is
+                # reproducible whatever decode_batch_size
+                sents, lengths = vae.decoder.sample_text_batch(z, start_id, end_id, pad_id,
+                    max_length=args.max_length, greedy=args.decode == 'greedy',
+                    temperature=args.temperature, top_k=args.top_k, top_p=args.top_p,
+                    seed=list(range(args.seed + offset, args.seed + offset + batch_size)))
+
+            sents = sents.cpu()
+            for sent, length in zip(sents, lengths.tolist()):
+                fout.write(' '.join(vocab.decode_sentence(sent[:length])) + '\n')
+                num_words += length
+
+            if i % 20 == 0:
+                print('%d/%d sentences, %.1f sentences/s' % \
+                      (offset + batch_size, num_samples, (offset + batch_size) / (time.time() - start)))
+                sys.stdout.flush()
+
+    elapsed = time.time() - start
+    print('%d sentences (%d words) written to %s, time elapsed %.2fs, %.1f sentences/s' % \
+          (num_samples, num_words, args.output, elapsed, num_samples / elapsed))
+
+if __name__ == '__main__':
+    args = init_config()
+    main(args)
@@ -0,0 +1,391 @@
+import sys
+import json
+import time
+import queue
+import threading
+import importlib
+import argparse
+
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import torch
+
+from data import MonoTextData
+from modules import quantize_vae
+
+from text import init_model
+
+def init_config():
+    parser = argparse.ArgumentParser(description='local inference server of a trained text VAE')
+
+    parser.add_argument('--dataset', type=str, required=True, help='dataset to use')
+    parser.add_argument('--load_path', type=str, required=True, help='checkpoint to load')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+
+    # micro-batching
+    parser.add_argument('--max_batch_size', type=int, default=128,
+                         help='maximum number of sentences or latent codes computed at once')
+    parser.add_argument('--max_latency', type=float, default=10,
+                         help='milliseconds a request waits at most for other requests to join its batch')
+    parser.add_argument('--report_interval', type=float, default=60,
+                         help='seconds between statistics reports on stdout, disabled when 0')
+
+    # decoding strategy, see sample.py
+    parser.add_argument('--decode', choices=['sample', 'greedy', 'beam'], default='greedy',
+                         help='sample: temperature/top-k/top-p sampling, greedy: most likely word, \
+                         beam: beam search')
+    parser.add_argument('--max_length', type=int, default=100, help='maximum number of words')
+    parser.add_argument('--temperature', type=float, default=1.0, help='softmax temperature of sampling')
+    parser.add_argument('--top_k', type=int, default=0, help='sample from the top k words, disabled when 0')
+    parser.add_argument('--top_p', type=float, default=1.0,
+                         help='sample from the smallest set of words with this much probability, disabled when 1.0')
+    parser.add_argument('--beam_size', type=int, default=5, help='number of beams of beam search')
+    parser.add_argument('--length_penalty', type=float, default=1.0,
+                         help='length normalization exponent of beam search')
+
+    parser.add_argument('--quantize', action='store_true', default=False,
+                         help='run on CPU with the LSTM and linear layers dynamically quantized to int8')
+
+    parser.add_argument('--seed', type=int, default=783435, metavar='S', help='random seed')
+
+    args = parser.parse_args()
+    args.cuda = torch.cuda.is_available() and not args.quantize
+
+    # load config file into args
+    config_file = "config.config_%s" % args.dataset
+    params = importlib.import_module(config_file).params
+    args = argparse.Namespace(**vars(args), **params)
+
+    if 'label' in params:
+        args.label = params['label']
+    else:
+        args.label = False
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    return args
+
+def histogram(counter):
+    """format a histogram with power of 2 buckets
+    """
+    buckets = Counter()
+    for value, count in counter.items():
+        low = 1 << (value.bit_length() - 1) if value > 0 else 0
+        buckets[low] += count
+
+    total = max(sum(buckets.values()), 1)
+    lines = []
+    for low in sorted(buckets):
+        high = 2 * low - 1 if low > 1 else low
+        label = '%d' % low if high == low else '%d-%d' % (low, high)
+        lines.append('  %9s: %7d (%5.1f%%)' % (label, buckets[low], 100. * buckets[low] / total))
+    return '\n'.join(lines)
+
+class MicroBatcher(object):
+    """coalesce concurrent requests into micro-batches computed by one
+    worker thread. A batch is closed when it holds max_batch_size items
+    or when its oldest request has waited max_latency seconds
+    Args:
+        fn: function that maps a list of items to the list of results
+        max_batch_size: the maximum number of items of a batch, a larger
+            request is computed alone
+        max_latency: the deadline in seconds
+    """
+    def __init__(self, fn, max_batch_size, max_latency):
+        super(MicroBatcher, self).__init__()
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
+        self.queue = queue.Queue()
+        # a request that did not fit the previous batch
+        self.pending = None
+
+        self.lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.queue_depths = Counter()
+        self.num_requests = 0
+        self.num_items = 0
+        self.total_latency = 0.
+
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, items):
+        """compute fn on items within a micro-batch, blocks until done
+        Returns: List
+            List: the results of the items
+        """
+        request = {'items': items, 'time': time.time(), 'done': threading.Event()}
+        self.queue.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['results']
+
+    def _next_batch(self):
+        first = self.pending if self.pending is not None else self.queue.get()
+        self.pending = None
+        requests = [first]
+        size = len(first['items'])
+        deadline = first['time'] + self.max_latency
+
+        while size < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                request = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if size + len(request['items']) > self.max_batch_size:
+                self.pending = request
+                break
+            requests.append(request)
+            size += len(request['items'])
+
+        # the requests of this batch and the ones still waiting
+        depth = len(requests) + self.queue.qsize() + (self.pending is not None)
+        return requests, size, depth
+
+    def _run(self):
+        while True:
+            requests, size, depth = self._next_batch()
+            items = [item for request in requests for item in request['items']]
+            try:
+                results = self.fn(items)
+                offset = 0
+                for request in requests:
+                    request['results'] = results[offset:offset + len(request['items'])]
+                    offset += len(request['items'])
+            except Exception as e:
+                # one bad request must not fail the other requests of its
+                # batch, they are computed again one at a time
+                if len(requests) == 1:
+                    requests[0]['error'] = e
+                else:
+                    for request in requests:
+                        try:
+                            request['results'] = self.fn(request['items'])
+                        except Exception as e:
+                            request['error'] = e
+
+            now = time.time()
+            for request in requests:
+                request['done'].set()
+
+            with self.lock:
+                self.batch_sizes[size] += 1
+                self.queue_depths[depth] += 1
+                self.num_requests += len(requests)
+                self.num_items += size
+                self.total_latency += sum(now - request['time'] for request in requests)
+
+    def stats(self):
+        with self.lock:
+            num_batches = sum(self.batch_sizes.values())
+            return {'requests': self.num_requests,
+                    'items': self.num_items,
+                    'batches': num_batches,
+                    'avg_batch_size': self.num_items / max(num_batches, 1),
+                    'avg_latency_ms': 1000. * self.total_latency / max(self.num_requests, 1),
+                    'queue_depth': self.queue.qsize(),
+                    'batch_size_hist': dict(self.batch_sizes),
+                    'queue_depth_hist': dict(self.queue_depths)}
+
+    def report(self, name):
+        with self.lock:
+            num_batches = sum(self.batch_sizes.values())
+            print('%s --- requests: %d, items: %d, batches: %d, avg batch size: %.2f, avg latency: %.2fms' % \
+                  (name, self.num_requests, self.num_items, num_batches,
+                   self.num_items / max(num_batches, 1),
+                   1000. * self.total_latency / max(self.num_requests, 1)))
+            if num_batches > 0:
+                print('batch size histogram:\n%s' % histogram(self.batch_sizes))
+                print('queue depth histogram:\n%s' % histogram(self.queue_depths))
+
+class Service(object):
+    """encode and decode functions of a VAE on lists of items
+    """
+    def __init__(self, vae, vocab, args):
+        super(Service, self).__init__()
+        self.vae = vae
+        self.vocab = vocab
+        self.args = args
+
+    def encode(self, sentences):
+        """
+        Args:
+            sentences: list of whitespace tokenized sentences
+        Returns: List
+            List: (mu, logvar) lists of every sentence
+        """
+        vocab = self.vocab
+        batch_data = [[vocab['<s>']] + [vocab[word] for word in sent.split()] + [vocab['</s>']]
+                      for sent in sentences]
+
+        # the encoder reads the last hidden state, so sentences of the
+        # same length are batched together without padding
+        groups = defaultdict(list)
+        for i, sent in enumerate(batch_data):
+            groups[len(sent)].append(i)
+
+        results = [None] * len(sentences)
+        with torch.no_grad():
+            for idx in groups.values():
+                x = torch.tensor([batch_data[i] for i in idx], dtype=torch.long, device=self.args.device)
+                mu, logvar = self.vae.encode_stats(x)[:2]
+                for i, mu_i, logvar_i in zip(idx, mu.tolist(), logvar.tolist()):
+                    results[i] = (mu_i, logvar_i)
+
+        return results
+
+    def decode(self, items):
+        """
+        Args:
+            items: list of (z, seed) pairs, z is a float tensor with
+                shape [nz] and seed the sampling seed of that code
+        Returns: List
+            List: the decoded sentences
+        """
+        args = self.args
+        vocab = self.vocab
+        start_id, end_id, pad_id = vocab['<s>'], vocab['</s>'], vocab['<pad>']
+
+        with torch.no_grad():
+            z = torch.stack([z for z, _ in items]).to(args.device)
+            if args.decode == 'beam':
+                sents, lengths, _ = self.vae.decoder.beam_search_decode(z, start_id, end_id, pad_id,
+                    beam_size=args.beam_size, max_length=args.max_length,
+                    length_penalty=args.length_penalty)
+            else:
+                sents, lengths = self.vae.decoder.sample_text_batch(z, start_id, end_id, pad_id,
+                    max_length=args.max_length, greedy=args.decode == 'greedy',
+                    temperature=args.temperature, top_k=args.top_k, top_p=args.top_p,
+                    seed=[seed for _, seed in items])
+
+        sents = sents.cpu()
+        return [' '.join(vocab.decode_sentence(sent[:length])) for sent, length in zip(sents, lengths.tolist())]
+
+def make_handler(batchers, nz):
+    """request handler of the json protocol
+    POST /encode {"sentences": [str, ...]} -> {"mu": [[float]], "logvar": [[float]]}
+    POST /decode {"z": [[float]], "seed": int} -> {"text": [str, ...]}, the code i
+        is sampled with seed + i, so that the text does not depend on the
+        other requests of its micro-batch. seed is optional, random when missing
+    GET /stats -> the statistics of both batchers
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, obj):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/stats':
+                self._reply(404, {'error': 'unknown path %s' % self.path})
+                return
+            self._reply(200, {name: batcher.stats() for name, batcher in batchers.items()})
+
+        def do_POST(self):
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length).decode('utf-8'))
+                if self.path == '/encode':
+                    sentences = request['sentences']
+                    if not all(isinstance(sent, str) for sent in sentences):
+                        raise ValueError('sentences must be strings')
+                elif self.path == '/decode':
+                    # a malformed code is rejected here rather than failing
+                    # the micro-batch it would join
+                    z = torch.tensor(request['z'], dtype=torch.float)
+                    if z.dim() == 1 and z.numel() == 0:
+                        z = z.view(0, nz)
+                    if z.dim() != 2 or z.size(1) != nz:
+                        raise ValueError('latent codes must have %d dimensions' % nz)
+                    if not torch.isfinite(z).all():
+                        raise ValueError('latent codes must be finite')
+                    seed = request.get('seed')
+                    if seed is None:
+                        seed = torch.randint(2 ** 31 - 1, (1,)).item()
+                    elif not isinstance(seed, int) or isinstance(seed, bool):
+                        raise ValueError('seed must be an integer')
+                    z = [(z_i, seed + i) for i, z_i in enumerate(z)]
+                else:
+                    self._reply(404, {'error': 'unknown path %s' % self.path})
+                    return
+            except KeyError as e:
+                self._reply(400, {'error': 'missing field %s' % e})
+                return
+            except (ValueError, TypeError, RuntimeError) as e:
+                self._reply(400, {'error': str(e)})
+                return
+
+            try:
+                if self.path == '/encode':
+                    results = batchers['encode'].submit(sentences) if sentences else []
+                    self._reply(200, {'mu': [mu for mu, _ in results],
+                                      'logvar': [logvar for _, logvar in results]})
+                else:
+                    results = batchers['decode'].submit(z) if z else []
+                    self._reply(200, {'text': results})
+            except Exception as e:
+                self._reply(500, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            # the statistics reports replace per request logging
+            pass
+
+    return Handler
+
+def main(args):
+    print(args)
+
+    device = torch.device("cuda" if args.cuda else "cpu")
+    args.device = device
+
+    train_data = MonoTextData(args.train_data, label=args.label)
+    vocab = train_data.vocab
+    del train_data
+
+    vae = init_model(args, vocab)
+    vae.load_state_dict(torch.load(args.load_path, map_location=device))
+    vae.eval()
+    if args.quantize:
+        vae = quantize_vae(vae)
+
+    service = Service(vae, vocab, args)
+    batchers = {'encode': MicroBatcher(service.encode, args.max_batch_size, args.max_latency / 1000.),
+                'decode': MicroBatcher(service.decode, args.max_batch_size, args.max_latency / 1000.)}
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batchers, args.nz))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('serving %s on http://%s:%d' % (args.load_path, args.host, args.port))
+    sys.stdout.flush()
+
+    try:
+        while True:
+            if args.report_interval > 0:
+                time.sleep(args.report_interval)
+                for name, batcher in batchers.items():
+                    batcher.report(name)
+                sys.stdout.flush()
+            else:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+    server.shutdown()
+    for name, batcher in batchers.items():
+        batcher.report(name)
+
+if __name__ == '__main__':
+    args = init_config()
+    main(args)
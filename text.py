@@ -9,9 +9,12 @@ import numpy as np
 import torch
 from torch import nn, optim
 
-from data import MonoTextData
+from data import MonoTextData, VocabEntry
 from modules import VAE
 from modules import LSTMEncoder, LSTMDecoder
+from modules import PosteriorCache, iter_batch_stats
+from modules import DiagnosticSubset
+from modules import AsyncValidator
 
 clip_grad = 5.0
 decay_epoch = 2
@@ -31,10 +34,21 @@ def init_config():
     parser.add_argument('--nsamples', type=int, default=1, help='number of samples for training')
     parser.add_argument('--iw_nsamples', type=int, default=500,
                          help='number of samples to compute importance weighted estimate')
+    parser.add_argument('--iw_target_err', type=float, default=0,
+                         help='draw importance samples adaptively until the standard error of log p(x) \
+                         per example is below this value, iw_nsamples is the cap. Disabled when 0')
+
+    parser.add_argument('--qmc', action='store_true', default=False,
+                         help='draw the noise of multiple posterior samples from randomized quasi-Monte Carlo \
+                         points, reduces the variance of multi-sample training and iw nll, a power of 2 for \
+                         iw_nsamples balances the points best')
 
     # select mode
     parser.add_argument('--eval', action='store_true', default=False, help='compute iw nll')
     parser.add_argument('--load_path', type=str, default='')
+    parser.add_argument('--cache_dir', type=str, default='',
+                         help='cache the posterior parameters of the test data in this folder, \
+                         keyed by checkpoint and data, no caching when empty')
 
     # annealing paramters
     parser.add_argument('--warm_up', type=int, default=10, help="number of annealing epochs")
@@ -43,6 +57,24 @@ def init_config():
     # inference parameters
     parser.add_argument('--aggressive', type=int, default=0,
                          help='apply aggressive training when nonzero, reduce to vanilla VAE when aggressive is 0')
+    parser.add_argument('--refine_nsteps', type=int, default=0,
+                         help='semi-amortized training when nonzero: refine the posterior of every batch with \
+                         this many gradient steps on the ELBO, the encoder is trained to match the refined posterior. \
+                         Cannot be combined with aggressive')
+    parser.add_argument('--refine_lr', type=float, default=1.0, help='step size of the posterior refinement')
+    parser.add_argument('--target_loss', type=float, default=0,
+                         help='report the time elapsed until the val loss first reaches this value, disabled when 0')
+    parser.add_argument('--async_val', action='store_true', default=False,
+                         help='evaluate on val/test data in a background process while training continues, \
+                         the results of each epoch are applied at the end of the next epoch')
+
+    parser.add_argument('--diag_budget', type=int, default=0,
+                         help='number of examples used for the mi/au diagnostics every log_niter \
+                         iterations, the whole val data is used when 0')
+    parser.add_argument('--diag_mode', choices=['fixed', 'rotate', 'train'], default='rotate',
+                         help='fixed: always the same val subset, rotate: the next val subset at every log, \
+                         train: the most recent training batches')
+
     # others
     parser.add_argument('--seed', type=int, default=783435, metavar='S', help='random seed')
 
@@ -62,9 +94,14 @@ def init_config():
     seed_set = [783435, 101, 202, 303, 404, 505, 606, 707, 808, 909]
     args.seed = seed_set[args.taskid]
 
+    if args.aggressive and args.refine_nsteps > 0:
+        raise ValueError("aggressive training and posterior refinement cannot be combined")
+
     id_ = "%s_aggressive%d_kls%.2f_warm%d_%d_%d_%d" % \
             (args.dataset, args.aggressive, args.kl_start, 
              args.warm_up, args.jobid, args.taskid, args.seed)
+    if args.refine_nsteps > 0:
+        id_ += "_refine%d" % args.refine_nsteps
 
     save_path = os.path.join(save_dir, id_ + '.pt')
 
@@ -90,7 +127,7 @@ def init_config():
     return args
 
 
-def test(model, test_data_batch, mode, args, verbose=True):
+def test(model, test_data_batch, mode, args, verbose=True, stats=None):
     report_kl_loss = report_rec_loss = 0
     report_num_words = report_num_sents = 0
     for i in np.random.permutation(len(test_data_batch)):
@@ -114,7 +151,7 @@ def test(model, test_data_batch, mode, args, verbose=True):
         report_rec_loss += loss_rc.item()
         report_kl_loss += loss_kl.item()
 
-    mutual_info = calc_mi(model, test_data_batch)
+    mutual_info = calc_mi(model, test_data_batch, stats=stats)
 
     test_loss = (report_rec_loss  + report_kl_loss) / report_num_sents
 
@@ -130,7 +167,7 @@ def test(model, test_data_batch, mode, args, verbose=True):
     return test_loss, nll, kl, ppl, mutual_info
 
 def calc_iwnll(model, test_data_batch, args, ns=100):
-    report_nll_loss = 0
+    report_nll_loss = report_err = report_num_samples = 0
     report_num_words = report_num_sents = 0
     for id_, i in enumerate(np.random.permutation(len(test_data_batch))):
         batch_data = test_data_batch[i]
@@ -144,31 +181,57 @@ def calc_iwnll(model, test_data_batch, args, ns=100):
             print('iw nll computing %d0%%' % (id_/(round(len(test_data_batch) / 10))))
             sys.stdout.flush()
 
-        loss = model.nll_iw(batch_data, nsamples=args.iw_nsamples, ns=ns)
+        if args.iw_target_err > 0:
+            loss, std_err, num_samples = model.nll_iw_adaptive(batch_data, args.iw_target_err,
+                                                               max_nsamples=args.iw_nsamples, ns=ns)
+            report_err += std_err.sum().item()
+            report_num_samples += num_samples.sum().item()
+        else:
+            loss = model.nll_iw(batch_data, nsamples=args.iw_nsamples, ns=ns)
 
         report_nll_loss += loss.sum().item()
 
     nll = report_nll_loss / report_num_sents
     ppl = np.exp(nll * report_num_sents / report_num_words)
 
-    print('iw nll: %.4f, iw ppl: %.4f' % (nll, ppl))
+    if args.iw_target_err > 0:
+        print('iw nll: %.4f, iw ppl: %.4f, avg std err: %.4f, avg samples: %.1f' % \
+              (nll, ppl, report_err / report_num_sents, report_num_samples / report_num_sents))
+    else:
+        print('iw nll: %.4f, iw ppl: %.4f' % (nll, ppl))
     sys.stdout.flush()
     return nll, ppl
 
-def calc_mi(model, test_data_batch):
+def calc_mi(model, test_data_batch, stats=None):
+    """stats are the cached posterior parameters from PosteriorCache,
+    the encoder is not run when they are provided
+    """
     mi = 0
     num_examples = 0
+    if stats is not None:
+        device = next(model.parameters()).device
+        stats_iter = iter_batch_stats(stats, test_data_batch, device)
     for batch_data in test_data_batch:
         batch_size = batch_data.size(0)
         num_examples += batch_size
-        mutual_info = model.calc_mi_q(batch_data)
+        if stats is not None:
+            mu, logvar = next(stats_iter)
+            mutual_info = model.encoder.calc_mi_from_stats(mu, logvar)
+        else:
+            mutual_info = model.calc_mi_q(batch_data)
         mi += mutual_info * batch_size
 
     return mi / num_examples
 
-def calc_au(model, test_data_batch, delta=0.01):
+def calc_au(model, test_data_batch, delta=0.01, stats=None):
     """compute the number of active units
     """
+    if stats is not None:
+        # (N, nz)
+        means = torch.from_numpy(np.array(stats[0]))
+        au_var = means.var(dim=0)
+        return (au_var >= delta).sum().item(), au_var
+
     cnt = 0
     for batch_data in test_data_batch:
         mean, _,_,_ = model.encode_stats(batch_data)
@@ -196,61 +259,167 @@ def calc_au(model, test_data_batch, delta=0.01):
     return (au_var >= delta).sum().item(), au_var
 
 
-def sample_sentences(vae, vocab, device, num_sentences):
+def async_val_init(args, word2id):
+    """build the model and the val/test data of the AsyncValidator process
+    """
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    vocab = VocabEntry(word2id)
+    device = torch.device("cuda" if args.cuda else "cpu")
+    args.device = device
+    vae = init_model(args, vocab)
+    vae.encoder.qmc = args.qmc
+    vae.eval()
+
+    val_data = MonoTextData(args.val_data, label=args.label, vocab=vocab)
+    test_data = MonoTextData(args.test_data, label=args.label, vocab=vocab)
+    val_data_batch = val_data.create_data_batch(batch_size=args.batch_size,
+                                                device=device,
+                                                batch_first=True)
+    test_data_batch = test_data.create_data_batch(batch_size=args.batch_size,
+                                                  device=device,
+                                                  batch_first=True)
+
+    return vae, (args, val_data_batch, test_data_batch)
+
+def async_val_eval(vae, context, epoch, run_test):
+    """evaluate a weight snapshot in the AsyncValidator process
+    """
+    args, val_data_batch, test_data_batch = context
+    print('epoch: %d, async VAL' % epoch)
+    loss, nll, kl, ppl, mi = test(vae, val_data_batch, "VAL", args)
+    au, _ = calc_au(vae, val_data_batch)
+    print("%d active units" % au)
+    if run_test:
+        test(vae, test_data_batch, "TEST", args)
+
+    return loss, nll, kl, ppl, mi
+
+
+def sample_sentences(vae, vocab, device, num_sentences, batch_size=100, **kwargs):
+    """kwargs are the decoding strategy options of LSTMDecoder.sample_text_batch
+    """
     vae.eval()
     sampled_sents = []
-    for i in range(num_sentences):
-        z = vae.sample_from_prior(1)
-        z = z.view(1,1,-1)
-        start = vocab.word2id['<s>']
-        # START = torch.tensor([[[start]]])
-        START = torch.tensor([[start]])
-        end = vocab.word2id['</s>']
-        START = START.to(device)
-        z = z.to(device)
-        vae.eval()
-        sentence = vae.decoder.sample_text(START, z, end, device)
-        decoded_sentence = vocab.decode_sentence(sentence)
-        sampled_sents.append(decoded_sentence)
+    start = vocab.word2id['<s>']
+    end = vocab.word2id['</s>']
+    pad = vocab.word2id['<pad>']
+    with torch.no_grad():
+        for i in range(0, num_sentences, batch_size):
+            z = vae.sample_from_prior(min(batch_size, num_sentences - i)).to(device)
+            sents, lengths = vae.decoder.sample_text_batch(z, start, end, pad, **kwargs)
+            sents = sents.cpu()
+            for sent, length in zip(sents, lengths.tolist()):
+                sampled_sents.append(vocab.decode_sentence(sent[:length]))
     for i, sent in enumerate(sampled_sents):
         print(i,":",' '.join(sent))
 
+def export_latents(vae, data, output_dir, batch_size, device, report_interval=0,
+                   cache_dir='', ckpt_path=''):
+    """encode a whole corpus and stream the posterior parameters into
+    preallocated memory-mapped .npy files, rows follow the corpus order
+    Writes:
+        mu.npy, logvar.npy: float32 arrays with shape [N, nz]
+        labels.npy, label_names.txt: int64 label codes with shape [N] and
+            the label of every code, when the data has labels
+    Args:
+        report_interval: print progress every report_interval batches,
+            disabled when 0
+        cache_dir: read the posterior parameters from the PosteriorCache
+            entry of ckpt_path in this folder, the entry is built on a
+            miss. The batches are then held in memory at once. No caching
+            when empty
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    num_examples = len(data)
+    mu_mm = np.lib.format.open_memmap(os.path.join(output_dir, 'mu.npy'),
+        mode='w+', dtype=np.float32, shape=(num_examples, vae.encoder.nz))
+    logvar_mm = np.lib.format.open_memmap(os.path.join(output_dir, 'logvar.npy'),
+        mode='w+', dtype=np.float32, shape=(num_examples, vae.encoder.nz))
+
+    if data.labels is not None:
+        label_names = sorted(set(data.labels))
+        label_codes = {label: i for i, label in enumerate(label_names)}
+        labels_mm = np.lib.format.open_memmap(os.path.join(output_dir, 'labels.npy'),
+            mode='w+', dtype=np.int64, shape=(num_examples,))
+        labels_mm[:] = [label_codes[label] for label in data.labels]
+        labels_mm.flush()
+        del labels_mm
+        with open(os.path.join(output_dir, 'label_names.txt'), 'w') as fout:
+            for label in label_names:
+                fout.write('%s\n' % label)
+
+    start = time.time()
+    done = 0
+    batches = data.iter_data_batch(batch_size, device, batch_first=True)
+    if cache_dir:
+        batches = list(batches)
+        data_batch = [batch_data for _, batch_data in batches]
+        stats = PosteriorCache.from_checkpoint(cache_dir, ckpt_path, data_batch).get(vae, data_batch)
+        stats_iter = iter_batch_stats(stats, data_batch, device)
+    with torch.no_grad():
+        for i, (idx, batch_data) in enumerate(batches):
+            if cache_dir:
+                mu, logvar = next(stats_iter)
+            else:
+                mu, logvar = vae.encode_stats(batch_data)[:2]
+            mu_mm[idx] = mu.cpu().numpy()
+            logvar_mm[idx] = logvar.cpu().numpy()
+            done += len(idx)
+
+            if report_interval > 0 and i % report_interval == 0:
+                print('%d/%d examples, %.1f examples/s' % (done, num_examples, done / (time.time() - start)))
+                sys.stdout.flush()
+
+    mu_mm.flush()
+    logvar_mm.flush()
+    del mu_mm, logvar_mm
+
+    elapsed = time.time() - start
+    print('%d examples encoded to %s, time elapsed %.2fs, %.1f examples/s' % \
+          (num_examples, output_dir, elapsed, num_examples / elapsed))
+
 def visualize_latent(args, vae, device, test_data):
-    f = open('yelp_embeddings_z','w')
-    g = open('yelp_embeddings_labels','w')
+    """write the posterior means and labels of test_data for
+    visualization, see export_latents
+    """
+    export_latents(vae, test_data, 'yelp_embeddings', args.batch_size, device,
+                   cache_dir=args.cache_dir, ckpt_path=args.load_path)
 
-    test_data_batch, test_label_batch = test_data.create_data_batch_labels(batch_size=args.batch_size, device=device, batch_first=True)
-    for i in range(len(test_data_batch)):
-        batch_data = test_data_batch[i]
-        batch_label = test_label_batch[i]
-        batch_size, sent_len = batch_data.size()
-        means, _ = vae.encoder.forward(batch_data)
-        for i in range(batch_size):
-            mean = means[i,:].cpu().detach().numpy().tolist()
-            for val in mean:
-                f.write(str(val)+'\t')
-            f.write('\n')
-        for label in batch_label:
-            g.write(label+'\n')
-        fo
-        print(mean.size())
-        print(logvar.size())
-        fooo
 
+class uniform_initializer(object):
+    def __init__(self, stdv):
+        self.stdv = stdv
+    def __call__(self, tensor):
+        nn.init.uniform_(tensor, -self.stdv, self.stdv)
 
 
-def main(args):
+class xavier_normal_initializer(object):
+    def __call__(self, tensor):
+        nn.init.xavier_normal_(tensor)
+
+
+def init_model(args, vocab):
+    """build the text VAE specified by args on args.device
+    """
+    model_init = uniform_initializer(0.01)
+    emb_init = uniform_initializer(0.1)
 
-    class uniform_initializer(object):
-        def __init__(self, stdv):
-            self.stdv = stdv
-        def __call__(self, tensor):
-            nn.init.uniform_(tensor, -self.stdv, self.stdv)
+    if args.enc_type == 'lstm':
+        encoder = LSTMEncoder(args, len(vocab), model_init, emb_init)
+        args.enc_nh = args.dec_nh
+    else:
+        raise ValueError("the specified encoder type is not supported")
 
+    decoder = LSTMDecoder(args, vocab, model_init, emb_init)
 
-    class xavier_normal_initializer(object):
-        def __call__(self, tensor):
-            nn.init.xavier_normal_(tensor)
+    return VAE(encoder, decoder, args).to(args.device)
+
+
+def main(args):
 
     if args.cuda:
         print('using cuda')
@@ -274,20 +443,10 @@ def main(args):
 
     log_niter = (len(train_data)//args.batch_size)//10
 
-    model_init = uniform_initializer(0.01)
-    emb_init = uniform_initializer(0.1)
-
-    if args.enc_type == 'lstm':
-        encoder = LSTMEncoder(args, vocab_size, model_init, emb_init)
-        args.enc_nh = args.dec_nh
-    else:
-        raise ValueError("the specified encoder type is not supported")
-
-    decoder = LSTMDecoder(args, vocab, model_init, emb_init)
-
     device = torch.device("cuda" if args.cuda else "cpu")
     args.device = device
-    vae = VAE(encoder, decoder, args).to(device)
+    vae = init_model(args, vocab)
+    vae.encoder.qmc = args.qmc
 
     if args.eval:
         print('begin evaluation')
@@ -298,12 +457,20 @@ def main(args):
                                                           device=device,
                                                           batch_first=True)
 
-            test(vae, test_data_batch, "TEST", args)
-            au, au_var = calc_au(vae, test_data_batch)
+            stats = None
+            if args.cache_dir:
+                stats = PosteriorCache.from_checkpoint(args.cache_dir, args.load_path,
+                                                       test_data_batch).get(vae, test_data_batch)
+
+            test(vae, test_data_batch, "TEST", args, stats=stats)
+            au, au_var = calc_au(vae, test_data_batch, stats=stats)
             print("%d active units" % au)
             # print(au_var)
 
-            test_data_batch = test_data.create_data_batch(batch_size=1,
+            # the adaptive estimator batches examples, converged ones leave the batch,
+            # nll_iw_adaptive bounds the number of sequences decoded at once
+            iw_batch_size = args.batch_size if args.iw_target_err > 0 else 1
+            test_data_batch = test_data.create_data_batch(batch_size=iw_batch_size,
                                                           device=device,
                                                           batch_first=True)
             calc_iwnll(vae, test_data_batch, args)
@@ -319,6 +486,7 @@ def main(args):
     best_kl = best_nll = best_ppl = 0
     pre_mi = 0
     aggressive_flag = True if args.aggressive else False
+    target_time = None
     vae.train()
     start = time.time()
 
@@ -339,180 +507,239 @@ def main(args):
     print(len(train_data_batch))
     print(len(val_data_batch))
     print(len(test_data_batch))
-    if args.train:
-        for epoch in range(args.epochs):
-            report_kl_loss = report_rec_loss = 0
-            report_num_words = report_num_sents = 0
-            for i in np.random.permutation(len(train_data_batch)):
-                batch_data = train_data_batch[i]
-                batch_size, sent_len = batch_data.size()
-                if batch_size == 1:
-                    continue
-                # not predict start symbol
-                report_num_words += (sent_len - 1) * batch_size
-
-                report_num_sents += batch_size
-
-                # kl_weight = 1.0
-                kl_weight = min(1.0, kl_weight + anneal_rate)
-
-                sub_iter = 1
-                batch_data_enc = batch_data
-                burn_num_words = 0
-                burn_pre_loss = 1e4
-                burn_cur_loss = 0
-                while aggressive_flag and sub_iter < 100:
 
-                    enc_optimizer.zero_grad()
-                    dec_optimizer.zero_grad()
+    async_val = AsyncValidator(async_val_init, async_val_eval, (args, dict(vocab.word2id))) \
+        if args.async_val and args.train else None
+    diag_subset = DiagnosticSubset(val_data_batch, args.diag_budget, args.diag_mode) \
+                  if args.diag_budget > 0 else None
+    try:
+        if args.train:
+            for epoch in range(args.epochs):
+                report_kl_loss = report_rec_loss = 0
+                report_num_words = report_num_sents = 0
+                for i in np.random.permutation(len(train_data_batch)):
+                    batch_data = train_data_batch[i]
+                    batch_size, sent_len = batch_data.size()
+                    if batch_size == 1:
+                        continue
+                    if diag_subset is not None:
+                        diag_subset.add(batch_data)
 
-                    id_ = np.random.random_integers(0, len(train_data_batch) - 1)
+                    # not predict start symbol
+                    report_num_words += (sent_len - 1) * batch_size
 
-                    batch_data_enc = train_data_batch[id_]
+                    report_num_sents += batch_size
 
-                    burn_batch_size, burn_sents_len = batch_data_enc.size()
-                    if burn_batch_size == 1:
-                        continue
+                    # kl_weight = 1.0
+                    kl_weight = min(1.0, kl_weight + anneal_rate)
+
+                    sub_iter = 1
+                    batch_data_enc = batch_data
+                    burn_num_words = 0
+                    burn_pre_loss = 1e4
+                    burn_cur_loss = 0
+                    while aggressive_flag and sub_iter < 100:
+
+                        enc_optimizer.zero_grad()
+                        dec_optimizer.zero_grad()
+
+                        id_ = np.random.random_integers(0, len(train_data_batch) - 1)
+
+                        batch_data_enc = train_data_batch[id_]
+
+                        burn_batch_size, burn_sents_len = batch_data_enc.size()
+                        if burn_batch_size == 1:
+                            continue
                         
-                    burn_num_words += (burn_sents_len - 1) * burn_batch_size
+                        burn_num_words += (burn_sents_len - 1) * burn_batch_size
 
-                    loss, loss_rc, loss_kl,_ = vae.loss(batch_data_enc, kl_weight, nsamples=args.nsamples)
+                        loss, loss_rc, loss_kl,_ = vae.loss(batch_data_enc, kl_weight, nsamples=args.nsamples)
 
-                    burn_cur_loss += loss.sum().item()
-                    loss = loss.mean(dim=-1)
+                        burn_cur_loss += loss.sum().item()
+                        loss = loss.mean(dim=-1)
 
-                    loss.backward()
-                    torch.nn.utils.clip_grad_norm_(vae.parameters(), clip_grad)
+                        loss.backward()
+                        torch.nn.utils.clip_grad_norm_(vae.parameters(), clip_grad)
+
+                        enc_optimizer.step()
+
+                        if sub_iter % 15 == 0:
+                            burn_cur_loss = burn_cur_loss / burn_num_words
+                            if burn_pre_loss - burn_cur_loss < 0:
+                                break
+                            burn_pre_loss = burn_cur_loss
+                            burn_cur_loss = burn_num_words = 0
+
+                        sub_iter += 1
+
+                        # if sub_iter >= 30:
+                        #     break
 
-                    enc_optimizer.step()
+                    # print(sub_iter)
+
+                    enc_optimizer.zero_grad()
+                    dec_optimizer.zero_grad()
 
-                    if sub_iter % 15 == 0:
-                        burn_cur_loss = burn_cur_loss / burn_num_words
-                        if burn_pre_loss - burn_cur_loss < 0:
-                            break
-                        burn_pre_loss = burn_cur_loss
-                        burn_cur_loss = burn_num_words = 0
 
-                    sub_iter += 1
+                    if args.refine_nsteps > 0:
+                        loss, loss_rc, loss_kl, _ = vae.loss_refine(batch_data, kl_weight,
+                            nsteps=args.refine_nsteps, lr=args.refine_lr, nsamples=args.nsamples)
+                    else:
+                        loss, loss_rc, loss_kl, loss_mul2 = vae.loss(batch_data, kl_weight, nsamples=args.nsamples)
 
-                    # if sub_iter >= 30:
-                    #     break
+                    loss = loss.mean(dim=-1)
 
-                # print(sub_iter)
+                    loss.backward()
+                    torch.nn.utils.clip_grad_norm_(vae.parameters(), clip_grad)
 
-                enc_optimizer.zero_grad()
-                dec_optimizer.zero_grad()
+                    loss_rc = loss_rc.sum()
+                    loss_kl = loss_kl.sum()
 
+                    if not aggressive_flag:
+                        enc_optimizer.step()
 
-                loss, loss_rc, loss_kl, loss_mul2 = vae.loss(batch_data, kl_weight, nsamples=args.nsamples)
+                    dec_optimizer.step()
 
-                loss = loss.mean(dim=-1)
+                    report_rec_loss += loss_rc.item()
+                    report_kl_loss += loss_kl.item()
 
-                loss.backward()
-                torch.nn.utils.clip_grad_norm_(vae.parameters(), clip_grad)
+                    iter_ += 1
 
-                loss_rc = loss_rc.sum()
-                loss_kl = loss_kl.sum()
+                    if iter_ % log_niter == 0:
+                        train_loss = (report_rec_loss  + report_kl_loss) / report_num_sents
+                        if aggressive_flag or epoch == 0:
+                            vae.eval()
+                            with torch.no_grad():
+                                diag_batch = val_data_batch if diag_subset is None else diag_subset.next()
+                                mi = calc_mi(vae, diag_batch)
+                                au, _ = calc_au(vae, diag_batch)
+                            vae.train()
 
-                if not aggressive_flag:
-                    enc_optimizer.step()
+                            print('epoch: %d, iter: %d, avg_loss: %.4f, kl: %.4f, mi: %.4f, recon: %.4f,' \
+                                'au %d, time elapsed %.2fs' %
+                                (epoch, iter_, train_loss, report_kl_loss / report_num_sents, mi,
+                                report_rec_loss / report_num_sents, au, time.time() - start))
+                        else:
+                            print('epoch: %d, iter: %d, avg_loss: %.4f, kl: %.4f, recon: %.4f,' \
+                                'time elapsed %.2fs' %
+                                (epoch, iter_, train_loss, report_kl_loss / report_num_sents,
+                                report_rec_loss / report_num_sents, time.time() - start))
 
-                dec_optimizer.step()
+                        sys.stdout.flush()
 
-                report_rec_loss += loss_rc.item()
-                report_kl_loss += loss_kl.item()
+                        report_rec_loss = report_kl_loss = 0
+                        report_num_words = report_num_sents = 0
 
-                iter_ += 1
 
-                if iter_ % log_niter == 0:
-                    train_loss = (report_rec_loss  + report_kl_loss) / report_num_sents
-                    if aggressive_flag or epoch == 0:
+                    # in async mode the stop burning decision uses the mi of the
+                    # background validation instead
+                    if aggressive_flag and async_val is None and (iter_ % len(train_data_batch)) == 0:
                         vae.eval()
-                        with torch.no_grad():
-                            mi = calc_mi(vae, val_data_batch)
-                            au, _ = calc_au(vae, val_data_batch)
+                        cur_mi = calc_mi(vae, val_data_batch)
                         vae.train()
+                        print("pre mi:%.4f. cur mi:%.4f" % (pre_mi, cur_mi))
+                        if cur_mi - pre_mi < 0:
+                            aggressive_flag = False
+                            print("STOP BURNING")
+
+                        pre_mi = cur_mi
+
+                print('kl weight %.4f' % kl_weight)
+
+                vae.eval()
+                if async_val is not None:
+                    async_val.submit(epoch, vae, run_test=epoch % args.test_nepoch == 0)
+                    val_results = async_val.collect()
+                else:
+                    with torch.no_grad():
+                        loss, nll, kl, ppl, mi = test(vae, val_data_batch, "VAL", args)
+                        au, au_var = calc_au(vae, val_data_batch)
+                        print("%d active units" % au)
+                        # print(au_var)
+                    val_results = [(epoch, None, (loss, nll, kl, ppl, mi))]
+
+                # the validation results are applied in epoch order, in async
+                # mode the results of epoch e are applied at the end of epoch e+1
+                for val_epoch, snapshot, (loss, nll, kl, ppl, mi) in val_results:
+                    if async_val is not None and aggressive_flag:
+                        print("pre mi:%.4f. cur mi:%.4f" % (pre_mi, mi))
+                        if mi - pre_mi < 0:
+                            aggressive_flag = False
+                            print("STOP BURNING")
+
+                        pre_mi = mi
+
+                    if args.target_loss > 0 and target_time is None and loss <= args.target_loss:
+                        target_time = time.time() - start
+                        print('reach target val loss %.4f at epoch %d, time elapsed %.2fs' % \
+                              (args.target_loss, val_epoch, target_time))
+
+                    if loss < best_loss:
+                        print('update best loss')
+                        best_loss = loss
+                        best_nll = nll
+                        best_kl = kl
+                        best_ppl = ppl
+                        torch.save(vae.state_dict() if snapshot is None else snapshot, args.save_path)
+
+                    if loss > opt_dict["best_loss"]:
+                        opt_dict["not_improved"] += 1
+                        if opt_dict["not_improved"] >= decay_epoch and val_epoch >=15:
+                            opt_dict["best_loss"] = loss
+                            opt_dict["not_improved"] = 0
+                            opt_dict["lr"] = opt_dict["lr"] * lr_decay
+                            vae.load_state_dict(torch.load(args.save_path))
+                            print('new lr: %f' % opt_dict["lr"])
+                            decay_cnt += 1
+                            enc_optimizer = optim.SGD(vae.encoder.parameters(), lr=opt_dict["lr"], momentum=args.momentum)
+                            dec_optimizer = optim.SGD(vae.decoder.parameters(), lr=opt_dict["lr"], momentum=args.momentum)
 
-                        print('epoch: %d, iter: %d, avg_loss: %.4f, kl: %.4f, mi: %.4f, recon: %.4f,' \
-                            'au %d, time elapsed %.2fs' %
-                            (epoch, iter_, train_loss, report_kl_loss / report_num_sents, mi,
-                            report_rec_loss / report_num_sents, au, time.time() - start))
                     else:
-                        print('epoch: %d, iter: %d, avg_loss: %.4f, kl: %.4f, recon: %.4f,' \
-                            'time elapsed %.2fs' %
-                            (epoch, iter_, train_loss, report_kl_loss / report_num_sents,
-                            report_rec_loss / report_num_sents, time.time() - start))
-
-                    sys.stdout.flush()
-
-                    report_rec_loss = report_kl_loss = 0
-                    report_num_words = report_num_sents = 0
-
-
-                if aggressive_flag and (iter_ % len(train_data_batch)) == 0:
-                    vae.eval()
-                    cur_mi = calc_mi(vae, val_data_batch)
-                    vae.train()
-                    print("pre mi:%.4f. cur mi:%.4f" % (pre_mi, cur_mi))
-                    if cur_mi - pre_mi < 0:
-                        aggressive_flag = False
-                        print("STOP BURNING")
-
-                    pre_mi = cur_mi
-
-            print('kl weight %.4f' % kl_weight)
-
-            vae.eval()
-            with torch.no_grad():
-                loss, nll, kl, ppl, mi = test(vae, val_data_batch, "VAL", args)
-                au, au_var = calc_au(vae, val_data_batch)
-                print("%d active units" % au)
-                # print(au_var)
-
-            if loss < best_loss:
-                print('update best loss')
-                best_loss = loss
-                best_nll = nll
-                best_kl = kl
-                best_ppl = ppl
-                torch.save(vae.state_dict(), args.save_path)
-
-            if loss > opt_dict["best_loss"]:
-                opt_dict["not_improved"] += 1
-                if opt_dict["not_improved"] >= decay_epoch and epoch >=15:
-                    opt_dict["best_loss"] = loss
-                    opt_dict["not_improved"] = 0
-                    opt_dict["lr"] = opt_dict["lr"] * lr_decay
-                    vae.load_state_dict(torch.load(args.save_path))
-                    print('new lr: %f' % opt_dict["lr"])
-                    decay_cnt += 1
-                    enc_optimizer = optim.SGD(vae.encoder.parameters(), lr=opt_dict["lr"], momentum=args.momentum)
-                    dec_optimizer = optim.SGD(vae.decoder.parameters(), lr=opt_dict["lr"], momentum=args.momentum)
-                
-            else:
-                opt_dict["not_improved"] = 0
-                opt_dict["best_loss"] = loss
-
-            if decay_cnt == max_decay:
-                break
-
-            if epoch % args.test_nepoch == 0:
-                with torch.no_grad():
-                    loss, nll, kl, ppl, _ = test(vae, test_data_batch, "TEST", args)
-
-            vae.train()
+                        opt_dict["not_improved"] = 0
+                        opt_dict["best_loss"] = loss
+
+                if decay_cnt == max_decay:
+                    break
+
+                if async_val is None and epoch % args.test_nepoch == 0:
+                    with torch.no_grad():
+                        loss, nll, kl, ppl, _ = test(vae, test_data_batch, "TEST", args)
+
+                vae.train()
+
+        if async_val is not None:
+            # the snapshots still in flight can only update the best checkpoint
+            for val_epoch, snapshot, (loss, nll, kl, ppl, mi) in async_val.close():
+                if loss < best_loss:
+                    print('update best loss')
+                    best_loss = loss
+                    torch.save(snapshot, args.save_path)
+    finally:
+        # a failed run must not leave the validation process behind
+        if async_val is not None:
+            async_val.terminate()
+
+    if args.train and args.target_loss > 0 and target_time is None:
+        print('target val loss %.4f not reached, time elapsed %.2fs' % \
+              (args.target_loss, time.time() - start))
 
     # compute importance weighted estimate of log p(x)
     vae.load_state_dict(torch.load(args.save_path))
 
     vae.eval()
     with torch.no_grad():
-        loss, nll, kl, ppl, _ = test(vae, test_data_batch, "TEST", args)
-        au, au_var = calc_au(vae, test_data_batch)
+        stats = None
+        if args.cache_dir:
+            stats = PosteriorCache.from_checkpoint(args.cache_dir, args.save_path,
+                                                   test_data_batch).get(vae, test_data_batch)
+
+        loss, nll, kl, ppl, _ = test(vae, test_data_batch, "TEST", args, stats=stats)
+        au, au_var = calc_au(vae, test_data_batch, stats=stats)
         print("%d active units" % au)
         # print(au_var)
 
-    test_data_batch = test_data.create_data_batch(batch_size=1,
+    iw_batch_size = args.batch_size if args.iw_target_err > 0 else 1
+    test_data_batch = test_data.create_data_batch(batch_size=iw_batch_size,
                                                   device=device,
                                                   batch_first=True)
     with torch.no_grad():
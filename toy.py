@@ -1,5 +1,4 @@
 import sys
-import pickle
 import os
 import time
 import importlib
@@ -10,11 +9,13 @@ import numpy as np
 import torch
 from torch import nn, optim
 
-from data import MonoTextData
+from data import MonoTextData, synthetic_splits
 
 from modules import LSTMEncoder, LSTMDecoder
 from modules import VAE
-from modules import generate_grid
+from modules import generate_grid, generate_grid_chunks
+
+from plot_scripts.trajectory_log import TrajectoryLog
 
 clip_grad = 5.0
 decay_epoch = 2
@@ -30,6 +31,15 @@ def init_config():
     parser.add_argument('--iw_nsamples', type=int, default=500,
                          help='number of samples to compute importance weighted estimate')
 
+    # data parameters
+    parser.add_argument('--gen_data', action='store_true', default=False,
+        help="sample the synthetic corpus in process from a randomly initialized LSTM decoder \
+        with a 2-d prior (deterministic by seed) instead of reading datasets/synthetic_data")
+    parser.add_argument('--gen_ntrain', type=int, default=20000,
+        help="number of generated training sentences")
+    parser.add_argument('--gen_ntest', type=int, default=2000,
+        help="number of generated validation and test sentences each")
+
     # plotting parameters
     parser.add_argument('--plot_mode', choices=['multiple', 'single'], default='multiple',
         help="multiple denotes plotting multiple points, single denotes potting single point, \
@@ -41,6 +51,19 @@ def init_config():
         help="boundary to approximate mean of model posterior p(z|x)")
     parser.add_argument('--dz', type=float, default=0.1,
         help="granularity to approximate mean of model posterior p(z|x)")
+    parser.add_argument('--coarse_dz', type=float, default=0,
+        help="granularity of the coarse grid in coarse-to-fine search of the model posterior mean, \
+        the fine grid has nfine points around the posterior mass. Plain grid search with dz when 0")
+    parser.add_argument('--nfine', type=int, default=20,
+        help="number of fine grid points in coarse-to-fine search")
+    parser.add_argument('--is_nsamples', type=int, default=0,
+        help="estimate the mean of model posterior with this many importance samples from q(z|x) \
+        instead of grid search when nonzero")
+    parser.add_argument('--max_points', type=int, default=0,
+        help="maximum number of (example, z) pairs evaluated at once in grid search, unlimited when 0")
+    parser.add_argument('--grid_chunk_size', type=int, default=0,
+        help="stream the grid of plain grid search in chunks of this many points, the mean of model \
+        posterior is accumulated chunk by chunk and the full grid is never built. Disabled when 0")
 
     parser.add_argument('--num_plot', type=int, default=500,
         help='number of sampled points to be ploted')
@@ -185,8 +208,23 @@ def calc_mi(model, test_data_batch):
     return mi / num_examples
 
 
+def calc_posterior_mean(model, data, grid_z, args):
+    max_points = args.max_points if args.max_points > 0 else None
+    if args.is_nsamples > 0:
+        return model.calc_model_posterior_mean_is(data, args.is_nsamples)[0]
+
+    if args.coarse_dz > 0:
+        return model.calc_model_posterior_mean_refine(data, grid_z, args.coarse_dz,
+                                                      nfine=args.nfine, max_points=max_points)
+
+    if args.grid_chunk_size > 0:
+        grid_z = generate_grid_chunks(args.zmin, args.zmax, args.dz, grid_z.device,
+                                      ndim=args.nz, chunk_size=args.grid_chunk_size)
+
+    return model.calc_model_posterior_mean(data, grid_z, max_points)
+
 def plot_multiple(model, plot_data, grid_z,
-                  iter_, args):
+                  iter_, traj_log, args):
 
     plot_data, sents_len = plot_data
     plot_data_list = torch.chunk(plot_data, round(args.num_plot / args.batch_size))
@@ -199,37 +237,30 @@ def plot_multiple(model, plot_data, grid_z,
         report_mi += model.calc_mi_q(data) * data.size(0)
 
         # [batch, 1]
-        posterior_mean = model.calc_model_posterior_mean(data, grid_z)
+        posterior_mean = calc_posterior_mean(model, data, grid_z, args)
 
         infer_mean, infer_log_var = model.calc_infer_mean(data)
 
         infer_posterior_mean.append(torch.cat([posterior_mean, infer_mean, infer_log_var], 1))
 
-    # [*, 2]
-    infer_posterior_mean = torch.cat(infer_posterior_mean, 0)
-
-    save_path = os.path.join(args.plot_dir, 'aggr%d_iter%d_multiple.pickle' % (args.aggressive, iter_))
-
-    save_data = {'posterior': infer_posterior_mean[:,0].cpu().numpy(),
-                 'inference': infer_posterior_mean[:,1].cpu().numpy(),
-                 'logvar': infer_posterior_mean[:,2].cpu().numpy(),
-                 'kl': report_loss_kl / report_num_sample,
-                 'mi': report_mi / report_num_sample
-                 }
-    pickle.dump(save_data, open(save_path, 'wb'))
+    # [*, 3]
+    infer_posterior_mean = torch.cat(infer_posterior_mean, 0).cpu().numpy()
 
-def plot_single(infer_mean, posterior_mean, args):
+    traj_log.append(iter_,
+                    posterior=infer_posterior_mean[:,0],
+                    inference=infer_posterior_mean[:,1],
+                    logvar=infer_posterior_mean[:,2],
+                    kl=report_loss_kl / report_num_sample,
+                    mi=report_mi / report_num_sample)
 
-    # [batch, time]
-    infer_mean = torch.cat(infer_mean, 1)
-    posterior_mean = torch.cat(posterior_mean, 1)
+def plot_single(infer_mean, posterior_mean, iter_, traj_log):
+    """append the current means of the tracked points, one record per
+    update so that the trajectory is never held in memory
+    """
 
-
-    save_path = os.path.join(args.plot_dir, 'aggr%d_single.pickle' % args.aggressive)
-    save_data = {'posterior': posterior_mean.cpu().numpy(),
-                 'inference': infer_mean.cpu().numpy(),
-                 }
-    pickle.dump(save_data, open(save_path, 'wb'))
+    traj_log.append(iter_,
+                    posterior=posterior_mean.squeeze(1).cpu().numpy(),
+                    inference=infer_mean.squeeze(1).cpu().numpy())
 
 
 
@@ -253,14 +284,17 @@ def main(args):
 
     opt_dict = {"not_improved": 0, "lr": 1., "best_loss": 1e4}
 
-    train_data = MonoTextData(args.train_data)
+    if args.gen_data:
+        train_data, val_data, test_data = synthetic_splits(
+            [args.gen_ntrain, args.gen_ntest, args.gen_ntest], seed=args.seed)
+    else:
+        train_data = MonoTextData(args.train_data)
+        val_data = MonoTextData(args.val_data, vocab=train_data.vocab)
+        test_data = MonoTextData(args.test_data, vocab=train_data.vocab)
 
     vocab = train_data.vocab
     vocab_size = len(vocab)
 
-    val_data = MonoTextData(args.val_data, vocab=vocab)
-    test_data = MonoTextData(args.test_data, vocab=vocab)
-
     print('Train data: %d samples' % len(train_data))
     print('finish reading datasets, vocab size is %d' % len(vocab))
     print('dropped sentences: %d' % train_data.dropped)
@@ -303,18 +337,22 @@ def main(args):
 
     plot_data = train_data.data_sample(nsample=args.num_plot, device=device, batch_first=True)
 
+    grid_dz = args.coarse_dz if args.coarse_dz > 0 else args.dz
+    traj_path = os.path.join(args.plot_dir, 'aggr%d_%s.trj' % (args.aggressive, args.plot_mode))
     if args.plot_mode == 'multiple':
-        grid_z = generate_grid(args.zmin, args.zmax, args.dz, device, ndim=1)
-        plot_fn = plot_multiple
+        grid_z = generate_grid(args.zmin, args.zmax, grid_dz, device, ndim=1)
+        traj_log = TrajectoryLog(traj_path, args.num_plot,
+                                 ['posterior', 'inference', 'logvar'], ['kl', 'mi'])
 
     elif args.plot_mode == 'single':
-        grid_z = generate_grid(args.zmin, args.zmax, args.dz, device, ndim=1)
-        plot_fn = plot_single
-        posterior_mean = []
-        infer_mean = []
+        grid_z = generate_grid(args.zmin, args.zmax, grid_dz, device, ndim=1)
+        traj_log = TrajectoryLog(traj_path, args.num_plot, ['posterior', 'inference'])
 
-        posterior_mean.append(vae.calc_model_posterior_mean(plot_data[0], grid_z))
-        infer_mean.append(vae.calc_infer_mean(plot_data[0])[0])
+        # only the latest means are kept, the trajectory goes to traj_log
+        with torch.no_grad():
+            posterior_mean = calc_posterior_mean(vae, plot_data[0], grid_z, args)
+            infer_mean = vae.calc_infer_mean(plot_data[0])[0]
+            plot_single(infer_mean, posterior_mean, 0, traj_log)
 
     train_data_batch = train_data.create_data_batch(batch_size=args.batch_size,
                                                     device=device,
@@ -360,7 +398,7 @@ def main(args):
                 burn_batch_size, burn_sents_len = batch_data_enc.size()
                 burn_num_words += (burn_sents_len - 1) * burn_batch_size
 
-                loss, loss_rc, loss_kl = vae.loss(batch_data_enc, kl_weight, nsamples=args.nsamples)
+                loss, loss_rc, loss_kl, _ = vae.loss(batch_data_enc, kl_weight, nsamples=args.nsamples)
 
                 burn_cur_loss += loss.sum().item()
                 loss = loss.mean(dim=-1)
@@ -391,8 +429,8 @@ def main(args):
             if args.plot_mode == 'single' and epoch == 0 and aggressive_flag:
                 vae.eval()
                 with torch.no_grad():
-                    posterior_mean.append(posterior_mean[-1])
-                    infer_mean.append(vae.calc_infer_mean(plot_data[0])[0])
+                    infer_mean = vae.calc_infer_mean(plot_data[0])[0]
+                    plot_single(infer_mean, posterior_mean, iter_, traj_log)
                 vae.train()
 
 
@@ -417,12 +455,11 @@ def main(args):
             if args.plot_mode == 'single' and epoch == 0:
                 vae.eval()
                 with torch.no_grad():
-                    posterior_mean.append(vae.calc_model_posterior_mean(plot_data[0], grid_z))
+                    posterior_mean = calc_posterior_mean(vae, plot_data[0], grid_z, args)
 
-                    if aggressive_flag:
-                        infer_mean.append(infer_mean[-1])
-                    else:
-                        infer_mean.append(vae.calc_infer_mean(plot_data[0])[0])
+                    if not aggressive_flag:
+                        infer_mean = vae.calc_infer_mean(plot_data[0])[0]
+                    plot_single(infer_mean, posterior_mean, iter_, traj_log)
                 vae.train()
 
             report_rec_loss += loss_rc.item()
@@ -450,15 +487,11 @@ def main(args):
                 report_rec_loss = report_kl_loss = 0
                 report_num_words = report_num_sents = 0
 
-            if iter_ % args.plot_niter == 0 and epoch == 0:
+            if iter_ % args.plot_niter == 0 and epoch == 0 and args.plot_mode == 'multiple':
                 vae.eval()
                 with torch.no_grad():
-                    if args.plot_mode == 'single' and iter_ != 0:
-                        plot_fn(infer_mean, posterior_mean, args)
-                        #return
-                    elif args.plot_mode == "multiple":
-                        plot_fn(vae, plot_data, grid_z,
-                                iter_, args)
+                    plot_multiple(vae, plot_data, grid_z,
+                                  iter_, traj_log, args)
                 vae.train()
 
             iter_ += 1
@@ -479,8 +512,10 @@ def main(args):
         print('kl weight %.4f' % kl_weight)
         print('epoch: %d, VAL' % epoch)
 
-        with torch.no_grad():
-            plot_fn(vae, plot_data, grid_z, iter_, args)
+        if args.plot_mode == 'multiple':
+            vae.eval()
+            with torch.no_grad():
+                plot_multiple(vae, plot_data, grid_z, iter_, traj_log, args)
 
         vae.eval()
         with torch.no_grad():
@@ -522,6 +557,8 @@ def main(args):
 
         vae.train()
 
+    traj_log.close()
+
     print('best_loss: %.4f, kl: %.4f, nll: %.4f, ppl: %.4f' \
           % (best_loss, best_kl, best_nll, best_ppl))
 